@@ -0,0 +1,227 @@
+'''
+Benchmark Suite for LVIS Processing, on Synthetic Data
+'''
+
+# Import libraries
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+import shapely
+import subprocess
+import platform
+import argparse
+import json
+import time
+import glob
+import os
+from syntheticLVIS import write_synthetic
+from plotLVIS import plotLVIS, footprints_to_tiff
+from methodsDEM import filter_tiffs, mosaic_tiffs, clip_tiff, smooth_tiff, stream_change, zonal_stats
+from manageRAM import peak_rss, convert_bytes
+
+
+# surface lowering of the second synthetic year, in metres
+YEAR_CHANGE = -2.0
+
+
+###########################################
+
+class benchmarkLVIS():
+  '''Class to time each step of the LVIS to elevation change pipeline on synthetic files'''
+
+  ###########################################
+
+  def __init__(self, workDir, nWaves = 200000, nBins = 500, res = 30, repeat = 3, nWorkers = 2):
+    '''Class initialiser: Write the synthetic files of two years, once per size'''
+    self.workDir = workDir
+    self.nWaves = nWaves
+    self.nBins = nBins
+    self.res = res
+    self.repeat = repeat
+    self.nWorkers = nWorkers
+    self.results = {}
+    os.makedirs(workDir, exist_ok = True)
+    self.files = {}
+    for year, dz in [(2009, 0.0), (2015, YEAR_CHANGE)]:
+      self.files[year] = os.path.join(workDir, f'synthetic_{year}_{nWaves}_{nBins}.h5')
+      if not os.path.isfile(self.files[year]):
+        write_synthetic(self.files[year], nWaves = nWaves, nBins = nBins, dz = dz, seed = 0)
+
+  ###########################################
+
+  def time(self, name, items, func, *args, **kwargs):
+    '''Time the best of repeated calls of a step, and record it'''
+    try:
+      seconds = []
+      for i in range(self.repeat):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+      best = min(seconds)
+      self.results[name] = {'seconds': best, 'items': items, 'itemsPerSecond': items / best if best > 0 else 0.0}
+      print(f'{name:<16s} {best:9.3f} s  {self.results[name]["itemsPerSecond"]:14.0f} items/s')
+      return(out)
+    except Exception as error:
+      # a failing step is recorded rather than stopping the suite, and counts as a regression if the baseline ran it
+      self.results[name] = {'error': f'{type(error).__name__}: {error}'}
+      print(f'{name:<16s} failed: {self.results[name]["error"]}')
+      return(None)
+
+  ###########################################
+
+  def run(self):
+    '''Run every step, from reading waveforms to elevation change'''
+    # read, elevations, ground, reprojection and gridding of one file
+    self.time('read', self.nWaves, plotLVIS, self.files[2009])
+    LVIS = plotLVIS(self.files[2009])
+    self.time('set_elevations', self.nWaves, LVIS.set_elevations)
+    self.time('estimate_ground', self.nWaves, LVIS.estimate_ground)
+    self.time('reproject', self.nWaves, LVIS.reproject_coords, 3031)
+    dems = {}
+    for year in self.files:
+      if(year != 2009):
+        LVIS = plotLVIS(self.files[year], setElev = True)
+        LVIS.estimate_ground()
+        LVIS.reproject_coords(3031)
+      dems[year] = os.path.join(self.workDir, f'DEM_{year}.tif')
+      self.time(f'write_tiff_{year}', self.nWaves, footprints_to_tiff, LVIS.zG, LVIS.x, LVIS.y, self.res, dems[year], 3031)
+    # DEM steps, on subsets of each year as task3 writes them
+    subsets = self.dem_subsets(2009)
+    shape = self.study_area(dems[2009])
+    filtered = self.time('filter_tiffs', len(subsets), filter_tiffs, subsets, shape) or subsets
+    merged = os.path.join(self.workDir, 'DEM_2009_MOSAIC.tif')
+    self.time('mosaic_tiffs', len(filtered), mosaic_tiffs, filtered, merged, res = self.res, n_workers = self.nWorkers)
+    # the whole-file DEM stands in for the mosaic if it could not be made
+    merged = merged if os.path.isfile(merged) else dems[2009]
+    clipped = {year: os.path.join(self.workDir, f'DEM_{year}_CROP.tif') for year in dems}
+    self.time('clip_tiff', pixels(merged), clip_tiff, merged, shape, clipped[2009])
+    clip_tiff(dems[2015], shape, clipped[2015], reference_raster = clipped[2009])
+    smoothed = os.path.join(self.workDir, 'DEM_2009_SMOOTH.tif')
+    self.time('smooth_tiff', pixels(clipped[2009]), smooth_tiff, clipped[2009], smoothed, 1, max_distance = 20, n_workers = self.nWorkers)
+    change = os.path.join(self.workDir, 'CHANGE.tif')
+    stats = self.time('stream_change', pixels(clipped[2009]), stream_change, clipped[2009], clipped[2015], change)
+    self.time('zonal_stats', pixels(change), zonal_stats, change, shape, n_workers = self.nWorkers)
+    if stats is not None:
+      # the synthetic surface was lowered by a known amount
+      print(f'Mean change {stats["mean"]:.3f} m, synthetic change {YEAR_CHANGE} m')
+    self.results['peakRSS'] = peak_rss()
+    print(f'Peak RAM usage: {convert_bytes(self.results["peakRSS"])}')
+    return(self.results)
+
+  ###########################################
+
+  def dem_subsets(self, year, nTiles = 4):
+    '''Write DEM subsets of a file on a grid of tiles, as task3 does'''
+    for old in glob.glob(os.path.join(self.workDir, f'DEM_subset_{year}.*.tif')):
+      os.remove(old)
+    bounds = plotLVIS(self.files[year], onlyBounds = True).bounds
+    size = (bounds[2] - bounds[0]) / nTiles
+    for x0 in np.arange(bounds[0], bounds[2], size):
+      for y0 in np.arange(bounds[1], bounds[3], size):
+        LVIS = plotLVIS(self.files[year], minX = x0, minY = y0, maxX = x0 + size, maxY = y0 + size, setElev = True)
+        if LVIS.nWaves == 0:
+          continue
+        LVIS.estimate_ground()
+        LVIS.reproject_coords(3031)
+        footprints_to_tiff(LVIS.zG, LVIS.x, LVIS.y, self.res, os.path.join(self.workDir, f'DEM_subset_{year}.x.{x0}.y.{y0}.tif'), 3031)
+    return(sorted(glob.glob(os.path.join(self.workDir, f'DEM_subset_{year}.*.tif'))))
+
+  ###########################################
+
+  def study_area(self, dem):
+    '''Write a study area polygon over the middle of a DEM'''
+    with rio.open(dem) as src:
+      minX, minY, maxX, maxY = src.bounds
+    dx, dy = (maxX - minX) / 4.0, (maxY - minY) / 4.0
+    polygon = shapely.Polygon([(minX + dx, minY + dy), (maxX - dx, minY + 2 * dy), (maxX - 2 * dx, maxY - dy)])
+    shape = os.path.join(self.workDir, 'study_area.shp')
+    gpd.GeoDataFrame({'name': ['study_area']}, geometry = [polygon], crs = 'EPSG:3031').to_file(shape)
+    return(shape)
+
+###########################################
+
+def pixels(raster):
+  '''Function to return the number of pixels of a raster, or zero if it was not written'''
+  if not os.path.isfile(raster):
+    return(0)
+  with rio.open(raster) as src:
+    return(src.width * src.height)
+
+###########################################
+
+def git_commit():
+  '''Function to return the commit of the code being benchmarked, if known'''
+  try:
+    return(subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                   stderr = subprocess.DEVNULL).decode().strip())
+  except (OSError, subprocess.CalledProcessError):
+    return(None)
+
+###########################################
+
+def compare_results(results, baseline, tolerance = 0.2, minSeconds = 0.05):
+  '''Function to return the steps that are slower than a baseline run by more than a tolerance, or that fail where it ran'''
+  regressions = {}
+  for name, result in results.items():
+    base = baseline.get(name)
+    if (not isinstance(result, dict)) or (not isinstance(base, dict)) or ('seconds' not in base):
+      continue
+    if('seconds' not in result):
+      # a step that ran in the baseline but fails now is a regression of any size
+      print(f'{name:<16s} {base["seconds"]:9.3f} s -> failed: {result.get("error")}')
+      regressions[name] = np.inf
+      continue
+    ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+    print(f'{name:<16s} {base["seconds"]:9.3f} s -> {result["seconds"]:9.3f} s  ({ratio:5.2f}x)')
+    # very short steps are too noisy to judge
+    if (ratio > 1.0 + tolerance) & (result['seconds'] - base['seconds'] > minSeconds):
+      regressions[name] = ratio
+  return(regressions)
+
+###########################################
+
+def find_baseline(historyFile, params, label = None):
+  '''Function to return the latest recorded run with the same parameters, or with a given label'''
+  if not os.path.isfile(historyFile):
+    return(None)
+  with open(historyFile) as f:
+    runs = [json.loads(line) for line in f if line.strip()]
+  for run in reversed(runs):
+    if ((label is None) or (run.get('label') == label)) and (run['params'] == params):
+      return(run)
+  return(None)
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Benchmark the pipeline on synthetic files and catch regressions against earlier runs
+  parser = argparse.ArgumentParser(description = 'Benchmark LVIS processing on synthetic files')
+  parser.add_argument('--work_dir', default = 'benchmark', help = 'Directory for synthetic files and outputs')
+  parser.add_argument('--waves', type = int, default = 200000, help = 'Number of footprints per synthetic file')
+  parser.add_argument('--bins', type = int, default = 500, help = 'Number of bins per waveform')
+  parser.add_argument('--res', type = int, default = 30, help = 'Spatial resolution of DEMs in meters')
+  parser.add_argument('--repeat', type = int, default = 3, help = 'Number of timed calls per step, the fastest is kept')
+  parser.add_argument('--workers', type = int, default = 2, help = 'Number of processes for parallel steps')
+  parser.add_argument('--results', default = 'benchmark_results.jsonl', help = 'File of recorded runs, one JSON line each')
+  parser.add_argument('--label', help = 'Label of this run, eg. a version')
+  parser.add_argument('--baseline', help = 'Label of the run to compare with, otherwise the latest run with the same parameters')
+  parser.add_argument('--tolerance', type = float, default = 0.2, help = 'Allowed slowdown before a step counts as a regression')
+  args = parser.parse_args()
+  params = {'waves': args.waves, 'bins': args.bins, 'res': args.res, 'workers': args.workers}
+  baseline = find_baseline(args.results, params, label = args.baseline)
+  results = benchmarkLVIS(args.work_dir, nWaves = args.waves, nBins = args.bins, res = args.res, repeat = args.repeat, nWorkers = args.workers).run()
+  # record this run
+  run = {'label': args.label, 'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+         'python': platform.python_version(), 'params': params, 'results': results}
+  with open(args.results, 'a') as f:
+    f.write(json.dumps(run) + '\n')
+  print("Success recording benchmark to", args.results)
+  if baseline is None:
+    print('No earlier run to compare with')
+  else:
+    print(f'Compared with run of {baseline["time"]} ({baseline.get("label") or baseline.get("commit")}):')
+    regressions = compare_results(results, baseline['results'], tolerance = args.tolerance)
+    if len(regressions) > 0:
+      raise SystemExit(f'Performance regressions: {", ".join(f"{name} failed" if np.isinf(ratio) else f"{name} {ratio:.2f}x" for name, ratio in regressions.items())}')
+    print('No performance regressions')
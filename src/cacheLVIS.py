@@ -0,0 +1,83 @@
+'''
+Class to Cache LVIS Subsets as Memory-Mapped Arrays
+'''
+
+# Import libraries
+import numpy as np
+import hashlib
+import shutil
+import time
+import os
+
+
+# Define class
+class cacheLVIS():
+  '''Class to keep read LVIS subsets as uncompressed arrays that can be memory-mapped'''
+
+  ###########################################
+
+  def __init__(self, cacheDir, maxBytes = 10 * 1024**3):
+    '''Class initialiser: Set cache directory and size limit'''
+    self.cacheDir = cacheDir
+    self.maxBytes = maxBytes
+    os.makedirs(cacheDir, exist_ok = True)
+
+  ###########################################
+
+  def key(self, filename, minX, minY, maxX, maxY, dtype, epsg = 4326):
+    '''Return cache key of a subset, changing whenever the LVIS file changes'''
+    stat = os.stat(filename)
+    label = f'{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}|{minX!r}|{minY!r}|{maxX!r}|{maxY!r}|{np.dtype(dtype).str}|{epsg}'
+    return(hashlib.sha1(label.encode()).hexdigest())
+
+  ###########################################
+
+  def load(self, key):
+    '''Return read-only memory-mapped arrays of a cached subset, or None if not cached'''
+    entry = os.path.join(self.cacheDir, key)
+    if not os.path.isdir(entry):
+      return(None)
+    # mark as recently used, for eviction
+    os.utime(entry)
+    arrays = {}
+    for file in os.listdir(entry):
+      arrays[file[:-4]] = np.load(os.path.join(entry, file), mmap_mode = 'r')
+    print("Read subset from cache:", entry)
+    return(arrays)
+
+  ###########################################
+
+  def store(self, key, arrays):
+    '''Write the arrays of a subset to the cache, then evict old entries'''
+    entry = os.path.join(self.cacheDir, key)
+    # write to a temporary directory and rename, so readers never see a partial entry
+    tempEntry = entry + f'.tmp{os.getpid()}'
+    os.makedirs(tempEntry, exist_ok = True)
+    for name, data in arrays.items():
+      np.save(os.path.join(tempEntry, name + '.npy'), np.ascontiguousarray(data))
+    try:
+      os.rename(tempEntry, entry)
+    except OSError:
+      # another process cached the same subset first
+      shutil.rmtree(tempEntry, ignore_errors = True)
+    self.evict()
+
+  ###########################################
+
+  def evict(self):
+    '''Delete least recently used entries until the cache is within its size limit'''
+    entries = []
+    for key in os.listdir(self.cacheDir):
+      entry = os.path.join(self.cacheDir, key)
+      if(os.path.isdir(entry) and '.tmp' not in key):
+        nBytes = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), nBytes, entry))
+    total = sum(e[1] for e in entries)
+    for used, nBytes, entry in sorted(entries):
+      if(total <= self.maxBytes):
+        break
+      shutil.rmtree(entry, ignore_errors = True)
+      total -= nBytes
+      print("Evicted cache entry last used", time.ctime(used))
+
+###########################################
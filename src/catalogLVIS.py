@@ -0,0 +1,153 @@
+'''
+Class to Catalogue a Directory of LVIS Files
+'''
+
+# Import libraries
+import numpy as np
+import pandas as pd
+import h5py as h5
+import geopandas as gpd
+import shapely
+import argparse
+import os
+from indexLVIS import indexLVIS
+from readLVIS import coalesce_rows
+
+
+# Define class
+class catalogLVIS():
+  '''Class to cache bounds and contents of every LVIS file in a campaign directory'''
+
+  ###########################################
+
+  def __init__(self, directory, catalogFile = None, indexDir = None):
+    '''Class initialiser: Scan the directory, reusing cached rows for unchanged files'''
+    self.directory = directory
+    self.indexDir = indexDir
+    self.catalogFile = catalogFile if catalogFile is not None else catalog_name(directory, indexDir)
+    # a shared data directory is only written to if it is writable
+    if not os.access(os.path.dirname(os.path.abspath(self.catalogFile)), os.W_OK):
+      raise ValueError(f"Cannot write the catalogue {self.catalogFile}, give a catalogFile or indexDir in a writable directory")
+    self.scan()
+
+  ###########################################
+
+  def scan(self):
+    '''Open each new or changed LVIS file once and cache its summary'''
+    cached = pd.read_csv(self.catalogFile, dtype = {'lfids': str}) if os.path.isfile(self.catalogFile) else None
+    rows = []
+    for file in sorted(f for f in os.listdir(self.directory) if f.endswith('.h5')):
+      stat = os.stat(os.path.join(self.directory, file))
+      # keep cached summary if the file is unchanged
+      if cached is not None:
+        match = cached[(cached.filename == file) & (cached['size'] == stat.st_size) & (cached.mtime == stat.st_mtime_ns)]
+        if len(match) > 0:
+          rows.append(match.iloc[0].to_dict())
+          continue
+      rows.append(self.summarise(file, stat))
+    self.table = pd.DataFrame(rows, columns = ['filename', 'size', 'mtime', 'minX', 'minY', 'maxX', 'maxY', 'nWaves', 'nBins', 'lfids'])
+    self.table.to_csv(self.catalogFile, index = False)
+    print('Number of LVIS files in catalogue: ', len(self.table))
+
+  ###########################################
+
+  def summarise(self, file, stat):
+    '''Return bounds, footprint count, bins and flight IDs of one LVIS file'''
+    lvis_file = os.path.join(self.directory, file)
+    # the spatial index gives the bounds, and is needed for row queries later
+    index = indexLVIS(lvis_file, indexDir = self.indexDir)
+    f = h5.File(lvis_file, 'r')
+    lfids = np.unique(np.array(f['LFID']))
+    f.close()
+    return({'filename': file, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'minX': index.bounds[0], 'minY': index.bounds[1], 'maxX': index.bounds[2], 'maxY': index.bounds[3],
+            'nWaves': index.nWaves, 'nBins': index.nBins, 'lfids': ';'.join(str(l) for l in lfids)})
+
+  ###########################################
+
+  def bounds(self, file):
+    '''Return cached bounds of one LVIS file'''
+    row = self.table[self.table.filename == os.path.basename(file)].iloc[0]
+    return([row.minX, row.minY, row.maxX, row.maxY])
+
+  ###########################################
+
+  def query(self, minX, minY, maxX, maxY):
+    '''Return files and row ranges with footprints inside a box'''
+    shift = self.lon_shift(maxX)
+    t = self.table
+    # skip files whose bounds miss the box entirely
+    files = t[(t.minX < maxX + shift) & (t.maxX >= minX + shift) & (t.minY < maxY) & (t.maxY >= minY)].filename
+    hits = []
+    for file in files:
+      useInd, lon, lat = indexLVIS(os.path.join(self.directory, file), indexDir = self.indexDir).query(minX + shift, minY, maxX + shift, maxY)
+      if(len(useInd) > 0):
+        hits.append(self.hit(file, useInd))
+    print(f'LVIS files intersecting query: {len(hits)}')
+    return(hits)
+
+  ###########################################
+
+  def query_shape(self, shapefile):
+    '''Return files and row ranges with footprints inside the polygons of a shapefile'''
+    shape = gpd.read_file(shapefile).to_crs('EPSG:4326')
+    geometry = shape.geometry.union_all() if hasattr(shape.geometry, 'union_all') else shape.geometry.unary_union
+    minX, minY, maxX, maxY = geometry.bounds
+    shift = self.lon_shift(maxX)
+    t = self.table
+    files = t[(t.minX < maxX + shift) & (t.maxX >= minX + shift) & (t.minY < maxY) & (t.maxY >= minY)].filename
+    hits = []
+    for file in files:
+      index = indexLVIS(os.path.join(self.directory, file), indexDir = self.indexDir)
+      useInd, lon, lat = index.query(minX + shift, minY, maxX + shift + 1e-9, maxY + 1e-9)
+      # keep footprints inside the polygon, not just its bounding box
+      inside = shapely.contains_xy(geometry, lon - shift, lat)
+      if(np.any(inside)):
+        hits.append(self.hit(file, useInd[inside]))
+    print(f'LVIS files intersecting {os.path.basename(shapefile)}: {len(hits)}')
+    return(hits)
+
+  ###########################################
+
+  def lon_shift(self, maxX):
+    '''Return the shift from query longitudes to those of the files'''
+    # LVIS files may give longitude from 0 to 360 degrees
+    return(360.0 if ((self.table.maxX.max() > 180.0) & (maxX < 0.0)) else 0.0)
+
+  ###########################################
+
+  def hit(self, file, useInd):
+    '''Return a query result for one file'''
+    starts, stops = coalesce_rows(useInd)
+    return({'filename': os.path.join(self.directory, file), 'nWaves': len(useInd), 'rows': useInd,
+            'ranges': list(zip(starts.tolist(), stops.tolist()))})
+
+###########################################
+
+def catalog_name(directory, indexDir = None):
+  '''Function to return the default catalogue of a directory: with the index sidecars if they are kept elsewhere, otherwise with the data'''
+  if(indexDir is None):
+    return(os.path.join(directory, 'lvis_catalog.csv'))
+  # one index directory may serve several campaign directories
+  return(os.path.join(indexDir, f'lvis_catalog_{os.path.basename(os.path.normpath(directory))}.csv'))
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Catalogue a campaign directory and optionally query it
+  parser = argparse.ArgumentParser(description = 'Catalogue LVIS files and query them by box or shapefile')
+  parser.add_argument('directory', help = 'Directory of LVIS files')
+  parser.add_argument('--catalog', help = 'Path of the catalogue table, by default with the index sidecars, or in the LVIS directory without --index_dir')
+  parser.add_argument('--index_dir', help = 'Directory for spatial index sidecars, if not next to the LVIS files')
+  parser.add_argument('--bbox', type = float, nargs = 4, metavar = ('minX', 'minY', 'maxX', 'maxY'), help = 'Query box in degrees')
+  parser.add_argument('--shape', help = 'Query shapefile, eg. shapes/pine_island_glacier.shp')
+  args = parser.parse_args()
+  catalog = catalogLVIS(args.directory, catalogFile = args.catalog, indexDir = args.index_dir)
+  hits = []
+  if args.bbox is not None:
+    hits = catalog.query(*args.bbox)
+  elif args.shape is not None:
+    hits = catalog.query_shape(args.shape)
+  for hit in hits:
+    print(hit['filename'], hit['nWaves'], 'waves in', len(hit['ranges']), 'row ranges')
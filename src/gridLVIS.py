@@ -0,0 +1,267 @@
+'''
+Methods to Grid LVIS Footprints
+'''
+
+# Import libraries
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+import geopandas as gpd
+import json
+import os
+from projectLVIS import reproject_bounds
+from methodsDEM import cog_copy
+
+
+# statistics that can be gridded
+GRID_STATS = ['mean', 'median', 'min', 'max', 'count', 'std']
+
+
+###########################################
+
+def pixel_index(x, y, minX, maxY, res, nX, nY):
+  '''Function to return the row and column of the pixel holding each footprint'''
+  col = np.floor((x - minX) / res).astype(np.int64)
+  row = np.ceil((maxY - y) / res).astype(np.int64) - 1
+  # correct rounding at pixel edges, so footprints fall in the same pixel as the tests of the old pixel loop
+  col[x < (minX + col * res)] -= 1
+  col[x >= (minX + (col + 1) * res)] += 1
+  row[y < (maxY - (row + 1) * res)] += 1
+  row[y >= (maxY - row * res)] -= 1
+  valid = (col >= 0) & (col < nX) & (row >= 0) & (row < nY)
+  return(row, col, valid)
+
+###########################################
+
+def grid_footprints(data, x, y, res, stats = ['mean'], bounds = None, noData = -999.0):
+  '''Function to grid footprint values, mapping footprints to pixels once and reducing per pixel'''
+  # set bounds
+  if(bounds is None):
+    bounds = [np.min(x), np.min(y), np.max(x), np.max(y)]
+  minX, minY, maxX, maxY = bounds
+  # set image size
+  nX = int((maxX - minX) / res + 1)
+  nY = int((maxY - minY) / res + 1)
+  # find pixel of every footprint
+  row, col, valid = pixel_index(x, y, minX, maxY, res, nX, nY)
+  pixel = row[valid] * nX + col[valid]
+  values = np.asarray(data)[valid]
+  # sort footprints by pixel, keeping file order within a pixel
+  order = np.argsort(pixel, kind = 'stable')
+  pixel = pixel[order]
+  values = values[order]
+  starts = np.where(np.diff(pixel, prepend = -1) != 0)[0]
+  counts = np.diff(np.append(starts, len(pixel)))
+  # reduce each pixel and pack in to arrays
+  images = {}
+  for stat in stats:
+    image = np.full((nY * nX), noData)
+    if(len(pixel) > 0):
+      image[pixel[starts]] = reduce_pixels(values, pixel, starts, counts, stat)
+    images[stat] = image.reshape((nY, nX))
+  return(images, [minX, minY, maxX, maxY])
+
+###########################################
+
+def pixel_sums(values, starts, counts):
+  '''Function to sum footprint values sorted by pixel, in the same order as np.sum of each pixel'''
+  # bincount adds in footprint order, as numpy does for fewer than 8 values
+  segment = np.repeat(np.arange(len(starts)), counts)
+  sums = np.bincount(segment, weights = values, minlength = len(starts))
+  # numpy sums longer runs pairwise, so those few pixels are summed by numpy itself
+  for i in np.where(counts >= 8)[0]:
+    sums[i] = np.sum(values[starts[i]: starts[i] + counts[i]])
+  return(sums)
+
+###########################################
+
+def reduce_pixels(values, pixel, starts, counts, stat):
+  '''Function to reduce footprint values sorted by pixel to one value per pixel'''
+  if(stat == 'mean'):
+    return(pixel_sums(values, starts, counts) / counts)
+  elif(stat == 'count'):
+    return(counts)
+  elif(stat == 'min'):
+    return(np.minimum.reduceat(values, starts))
+  elif(stat == 'max'):
+    return(np.maximum.reduceat(values, starts))
+  elif(stat == 'std'):
+    # deviations from each pixel mean, as np.std
+    deviation = values - np.repeat(pixel_sums(values, starts, counts) / counts, counts)
+    return(np.sqrt(pixel_sums(deviation * deviation, starts, counts) / counts))
+  elif(stat == 'median'):
+    # sort values within each pixel, and take the middle one or two
+    ordered = values[np.lexsort((values, pixel))]
+    return((ordered[starts + (counts - 1) // 2] + ordered[starts + counts // 2]) / 2.0)
+  raise ValueError(f"Unknown statistic {stat}, expected one of {GRID_STATS}")
+
+###########################################
+
+class mosaicGrid():
+  '''Class to accumulate footprints of many tiles and files onto one fixed grid'''
+
+  ###########################################
+
+  def __init__(self, bounds, res = 30, epsg = 3031, workDir = None, resume = False, noData = -999.0):
+    '''Class initialiser: Snap the grid to whole pixels and allocate running sum and count'''
+    self.res = res
+    self.epsg = epsg
+    self.noData = noData
+    self.workDir = workDir
+    # origin at the top left corner, as the DEM subsets
+    self.minX = np.floor(bounds[0] / res) * res
+    self.maxY = np.ceil(bounds[3] / res) * res
+    self.nX = int(np.ceil((bounds[2] - self.minX) / res)) + 1
+    self.nY = int(np.ceil((self.maxY - bounds[1]) / res)) + 1
+    print(f"Mosaic grid of {self.nX} x {self.nY} pixels at {res} m")
+    self.grid = {'minX': float(self.minX), 'maxY': float(self.maxY), 'res': float(res), 'nX': self.nX, 'nY': self.nY, 'epsg': int(epsg)}
+    self.done = []        # files already in the grid
+    self.pending = []     # pixel sums of the file being added, kept until it is committed
+    if(workDir is None):
+      self.sum = np.zeros((self.nY, self.nX), dtype = np.float64)
+      self.count = np.zeros((self.nY, self.nX), dtype = np.uint32)
+      return
+    # otherwise keep sum and count on disk, so the grid is not limited by RAM
+    self.stateFile = os.path.join(workDir, 'mosaic_grid.json')
+    self.journal = os.path.join(workDir, 'mosaic_journal.npz')
+    resume = resume and os.path.isfile(self.stateFile) and os.path.isfile(os.path.join(workDir, 'mosaic_sum.npy'))
+    if(resume):
+      with open(self.stateFile) as f:
+        state = json.load(f)
+      if(state['grid'] != self.grid):
+        raise ValueError(f"Mosaic grid in {workDir} was made for {state['grid']}, not {self.grid}; resume with the same res and bounds, or start a new grid")
+      self.done = state['files']
+    mode = 'r+' if resume else 'w+'
+    self.sum = np.lib.format.open_memmap(os.path.join(workDir, 'mosaic_sum.npy'), mode = mode, dtype = np.float64, shape = (self.nY, self.nX))
+    self.count = np.lib.format.open_memmap(os.path.join(workDir, 'mosaic_count.npy'), mode = mode, dtype = np.uint32, shape = (self.nY, self.nX))
+    if(resume):
+      self.rollback()
+      print(f"Resuming mosaic grid with {len(self.done)} files already added")
+    else:
+      self.write_state()
+
+  ###########################################
+
+  def add(self, x, y, z):
+    '''Add footprint values to the running sum and count of their pixels, once the file is committed if kept on disk'''
+    x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+    row, col, valid = pixel_index(x, y, self.minX, self.maxY, self.res, self.nX, self.nY)
+    # footprints without a ground estimate are left out of the average
+    valid &= (z != self.noData)
+    pixel = row[valid] * self.nX + col[valid]
+    if(len(pixel) == 0):
+      return
+    # only the pixels touched are updated
+    cells, inverse = np.unique(pixel, return_inverse = True)
+    sums, counts = np.bincount(inverse, weights = z[valid]), np.bincount(inverse).astype(np.uint32)
+    if(self.workDir is None):
+      self.apply(cells, sums, counts)
+    else:
+      self.pending.append((cells, sums, counts))
+
+  ###########################################
+
+  def apply(self, cells, sums, counts):
+    '''Add sums and counts to their pixels'''
+    self.sum.reshape(-1)[cells] += sums
+    self.count.reshape(-1)[cells] += counts
+
+  ###########################################
+
+  def is_done(self, filename):
+    '''Check whether a file was already added to the grid, eg. before a crash'''
+    return(os.path.abspath(filename) in self.done)
+
+  ###########################################
+
+  def commit(self, filename):
+    '''Add the pending footprints of a file to the grid and record the file, so a resumed run never adds it twice'''
+    self.done.append(os.path.abspath(filename))
+    if(self.workDir is None):
+      return
+    if(len(self.pending) > 0):
+      cells = np.concatenate([p[0] for p in self.pending])
+      cells, inverse = np.unique(cells, return_inverse = True)
+      sums = np.bincount(inverse, weights = np.concatenate([p[1] for p in self.pending]))
+      counts = np.bincount(inverse, weights = np.concatenate([p[2] for p in self.pending])).astype(np.uint32)
+      # the old values of the pixels are journalled first, so a crash while adding can be undone
+      np.savez(self.journal + '.tmp.npz', cells = cells, sum = self.sum.reshape(-1)[cells], count = self.count.reshape(-1)[cells],
+               filename = self.done[-1])
+      os.replace(self.journal + '.tmp.npz', self.journal)
+      self.apply(cells, sums, counts)
+      self.flush()
+    self.pending = []
+    self.write_state()
+    if os.path.isfile(self.journal):
+      os.remove(self.journal)
+
+  ###########################################
+
+  def rollback(self):
+    '''Undo a file that was being added when a run crashed, so it is added again from scratch'''
+    if not os.path.isfile(self.journal):
+      return
+    with np.load(self.journal) as journal:
+      # a file recorded as done was added in full before the crash
+      if(str(journal['filename']) not in self.done):
+        self.sum.reshape(-1)[journal['cells']] = journal['sum']
+        self.count.reshape(-1)[journal['cells']] = journal['count']
+        self.flush()
+        print("Undid partly added file", str(journal['filename']))
+    os.remove(self.journal)
+
+  ###########################################
+
+  def write_state(self):
+    '''Write the grid definition and the files added, replacing the state file in one step'''
+    with open(self.stateFile + '.tmp', 'w') as f:
+      json.dump({'grid': self.grid, 'files': self.done}, f, indent = 2)
+    os.replace(self.stateFile + '.tmp', self.stateFile)
+
+  ###########################################
+
+  def write(self, filename, countBand = False, blockRows = 1024, cog = False):
+    '''Write the mean of each pixel to GeoTIFF, a block of rows at a time'''
+    if(len(self.pending) > 0):
+      raise ValueError("Footprints of a file are still pending, commit the file before writing the mosaic")
+    transform = from_origin(self.minX, self.maxY, self.res, self.res)
+    # a COG is copied from a tiled GeoTIFF once the mean is written
+    outName = filename + '.tmp.tif' if cog else filename
+    with rio.open(outName, 'w', driver = 'GTiff', height = self.nY, width = self.nX, count = 2 if countBand else 1, dtype = 'float32',
+                  crs = f'EPSG:{self.epsg}', transform = transform, nodata = self.noData, tiled = True, blockxsize = 256, blockysize = 256) as dst:
+      for start in range(0, self.nY, blockRows):
+        stop = min(start + blockRows, self.nY)
+        count = self.count[start: stop]
+        mean = np.full(count.shape, self.noData, dtype = np.float32)
+        np.divide(self.sum[start: stop], count, out = mean, where = count > 0, casting = 'unsafe')
+        window = Window(0, start, self.nX, stop - start)
+        dst.write(mean, 1, window = window)
+        if(countBand):
+          dst.write(count.astype(np.float32), 2, window = window)
+    if cog:
+      cog_copy(outName, filename)
+      os.remove(outName)
+    print("Success writing mosaic to", filename)
+
+  ###########################################
+
+  def flush(self):
+    '''Flush a disk-backed grid, so a later run can resume from it'''
+    for array in [self.sum, self.count]:
+      if(isinstance(array, np.memmap)):
+        array.flush()
+
+###########################################
+
+def shape_bounds(shapefile, epsg = 3031):
+  '''Function to return the bounds of a shapefile in a projected coordinate system'''
+  return(list(gpd.read_file(shapefile).to_crs(f'EPSG:{epsg}').total_bounds))
+
+###########################################
+
+def lonlat_bounds(bounds, epsg = 3031):
+  '''Function to return projected bounds of a longitude/latitude box, following its edges'''
+  return(reproject_bounds(bounds, 4326, epsg))
+
+###########################################
@@ -0,0 +1,180 @@
+'''
+Class to Index LVIS Files
+'''
+
+# Import libraries
+import numpy as np
+import h5py as h5
+import argparse
+import os
+from projectLVIS import lonlat_boxes, inside_box
+
+
+# Define class
+class indexLVIS():
+  '''Class to build and query a spatial index sidecar for a LVIS file'''
+
+  ###########################################
+
+  def __init__(self, filename, nCells = 64, indexDir = None, rebuild = False):
+    '''Class initialiser: Build the sidecar if missing or stale, then read its cell table'''
+    self.filename = filename
+    self.sidecar = index_name(filename, indexDir)
+    if(rebuild or not self.is_current()):
+      self.build_index(nCells)
+    self.read_index()
+
+  ###########################################
+
+  def is_current(self):
+    '''Check the sidecar exists and matches the LVIS file it indexes'''
+    if not os.path.isfile(self.sidecar):
+      return(False)
+    stat = os.stat(self.filename)
+    with h5.File(self.sidecar, 'r') as f:
+      return((f.attrs['mtime'] == stat.st_mtime_ns) and (f.attrs['size'] == stat.st_size))
+
+  ###########################################
+
+  def build_index(self, nCells):
+    '''Build sidecar of footprint midpoints grouped into a grid of cells'''
+    f = h5.File(self.filename, 'r')
+    nBins = f['RXWAVE'].shape[1]
+    # find a single coordinate per footprint, as in readLVIS
+    lon = (np.array(f['LON0']) + np.array(f['LON' + str(nBins -1)])) / 2.0
+    lat = (np.array(f['LAT0']) + np.array(f['LAT' + str(nBins -1)])) / 2.0
+    f.close()
+    bounds = [np.min(lon), np.min(lat), np.max(lon), np.max(lat)]
+    # assign each footprint to a grid cell
+    xCell = cell_number(lon, bounds[0], bounds[2], nCells)
+    yCell = cell_number(lat, bounds[1], bounds[3], nCells)
+    cell = yCell * nCells + xCell
+    # sort footprints by cell, so each cell is a contiguous row range
+    order = np.argsort(cell, kind = 'stable')
+    counts = np.bincount(cell, minlength = nCells * nCells)
+    cellStart = np.concatenate(([0], np.cumsum(counts)))
+    sortLon = lon[order]
+    sortLat = lat[order]
+    # bounds of the footprints in each cell, no data for empty cells
+    cellBounds = np.full((nCells * nCells, 4), np.nan)
+    full = np.where(counts > 0)[0]
+    starts = cellStart[full]
+    cellBounds[full, 0] = np.minimum.reduceat(sortLon, starts)
+    cellBounds[full, 1] = np.minimum.reduceat(sortLat, starts)
+    cellBounds[full, 2] = np.maximum.reduceat(sortLon, starts)
+    cellBounds[full, 3] = np.maximum.reduceat(sortLat, starts)
+    # write to a temporary file and rename, so a crash never leaves a broken sidecar
+    stat = os.stat(self.filename)
+    tempName = self.sidecar + '.tmp'
+    with h5.File(tempName, 'w') as out:
+      out.create_dataset('ROWS', data = order)
+      out.create_dataset('LON', data = sortLon)
+      out.create_dataset('LAT', data = sortLat)
+      out.create_dataset('CELLSTART', data = cellStart)
+      out.create_dataset('CELLBOUNDS', data = cellBounds)
+      out.attrs['bounds'] = bounds
+      out.attrs['nCells'] = nCells
+      out.attrs['nBins'] = nBins
+      out.attrs['nWaves'] = len(lon)
+      out.attrs['mtime'] = stat.st_mtime_ns
+      out.attrs['size'] = stat.st_size
+    os.replace(tempName, self.sidecar)
+    print("Success writing index to", self.sidecar)
+
+  ###########################################
+
+  def read_index(self):
+    '''Read the cell table of the sidecar, leaving footprints on disk'''
+    with h5.File(self.sidecar, 'r') as f:
+      self.bounds = list(f.attrs['bounds'])
+      self.nCells = int(f.attrs['nCells'])
+      self.nBins = int(f.attrs['nBins'])
+      self.nWaves = int(f.attrs['nWaves'])
+      self.cellStart = np.array(f['CELLSTART'])
+      self.cellBounds = np.array(f['CELLBOUNDS'])
+
+  ###########################################
+
+  def query(self, minX, minY, maxX, maxY):
+    '''Return sorted row indices and midpoint coordinates of footprints inside a box'''
+    cb = self.cellBounds
+    # cells whose footprints overlap the box (empty cells are NaN, so never hit)
+    cells = np.where((cb[:, 0] < maxX) & (cb[:, 2] >= minX) & (cb[:, 1] < maxY) & (cb[:, 3] >= minY))[0]
+    if(len(cells) == 0):
+      return(np.array([], dtype = np.int64), np.array([]), np.array([]))
+    # neighbouring cells are neighbouring row ranges, so read them as one slice
+    breaks = np.where(np.diff(cells) > 1)[0]
+    firstCells = np.concatenate(([cells[0]], cells[breaks + 1]))
+    lastCells = np.concatenate((cells[breaks], [cells[-1]]))
+    rows, lon, lat = [], [], []
+    with h5.File(self.sidecar, 'r') as f:
+      for c0, c1 in zip(firstCells, lastCells):
+        start, stop = self.cellStart[c0], self.cellStart[c1 + 1]
+        tempLon = f['LON'][start:stop]
+        tempLat = f['LAT'][start:stop]
+        # same test as readLVIS, on the candidates only
+        useInd = np.where((tempLon >= minX) & (tempLon < maxX) & (tempLat >= minY) & (tempLat < maxY))[0]
+        rows.append(f['ROWS'][start:stop][useInd])
+        lon.append(tempLon[useInd])
+        lat.append(tempLat[useInd])
+    rows = np.concatenate(rows)
+    # return in file order, as np.where would
+    order = np.argsort(rows)
+    return(rows[order], np.concatenate(lon)[order], np.concatenate(lat)[order])
+
+  ###########################################
+
+  def query_projected(self, minX, minY, maxX, maxY, epsg):
+    '''Return sorted row indices and midpoint coordinates of footprints inside a projected box'''
+    # candidates from the longitude/latitude boxes covering the projected box
+    wrap360 = self.bounds[2] > 180.0
+    found = [self.query(*box) for box in lonlat_boxes(minX, minY, maxX, maxY, epsg, wrap360 = wrap360)]
+    rows, first = np.unique(np.concatenate([r[0] for r in found]), return_index = True)
+    lon = np.concatenate([r[1] for r in found])[first]
+    lat = np.concatenate([r[2] for r in found])[first]
+    # exact test in the projected coordinates
+    useInd = np.where(inside_box(lon, lat, minX, minY, maxX, maxY, epsg = epsg))[0]
+    return(rows[useInd], lon[useInd], lat[useInd])
+
+  ###########################################
+
+  def dump_coords(self):
+    '''Return midpoint coordinates of all footprints in file order'''
+    with h5.File(self.sidecar, 'r') as f:
+      rows = np.array(f['ROWS'])
+      lon = np.empty(self.nWaves)
+      lat = np.empty(self.nWaves)
+      lon[rows] = np.array(f['LON'])
+      lat[rows] = np.array(f['LAT'])
+    return(lon, lat)
+
+###########################################
+
+def index_name(filename, indexDir = None):
+  '''Function to return the sidecar name of a LVIS file'''
+  # sidecars sit next to the file unless the data directory is read-only
+  if(indexDir is None):
+    return(filename + '.idx')
+  return(os.path.join(indexDir, os.path.basename(filename) + '.idx'))
+
+###########################################
+
+def cell_number(coord, minCoord, maxCoord, nCells):
+  '''Function to return the grid cell of each coordinate along one axis'''
+  width = (maxCoord - minCoord) / nCells
+  if(width <= 0):
+    return(np.zeros(len(coord), dtype = np.int64))
+  return(np.clip(((coord - minCoord) / width).astype(np.int64), 0, nCells - 1))
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Build sidecar indexes for a list of LVIS files
+  parser = argparse.ArgumentParser(description = 'Build spatial index sidecars for LVIS files')
+  parser.add_argument('lvis_files', nargs = '+', help = 'Paths to LVIS files')
+  parser.add_argument('--nCells', type = int, default = 64, help = 'Number of index cells along each axis')
+  parser.add_argument('--index_dir', help = 'Directory for sidecars, if not next to the LVIS files')
+  args = parser.parse_args()
+  for lvis_file in args.lvis_files:
+    indexLVIS(lvis_file, nCells = args.nCells, indexDir = args.index_dir, rebuild = True)
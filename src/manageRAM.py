@@ -4,6 +4,28 @@ Methods for RAM Management
 
 # Import libraries
 import os
+import sys
+import time
+import json
+import threading
+import functools
+import resource
+import psutil
+
+
+# profiling is off unless LVIS_PROFILE=1
+ENABLED = os.environ.get('LVIS_PROFILE', '0') not in ('', '0')
+
+# seconds between memory samples of running stages
+SAMPLE_INTERVAL = 0.05
+
+# calls of each stage in this process, and the stages currently running in each thread
+_RECORDS = []
+_ACTIVE = threading.local()
+_START = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'time': time.time()}
+
+# one memory sampler per process, shared by the stages running in any thread
+_SAMPLER = {'pid': None, 'running': [], 'busy': threading.Condition()}
 
 
 ###########################################
@@ -27,3 +49,178 @@ def file_size(file):
 
 ###########################################
 
+def bytes_read():
+    '''Function to return the bytes read by this process so far, where the platform counts them'''
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return 0
+    # read_chars counts reads served from the page cache too
+    return getattr(counters, 'read_chars', counters.read_bytes)
+
+###########################################
+
+def peak_rss():
+    '''Function to return the peak resident memory of this process so far, in bytes'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS gives bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+###########################################
+
+class stage():
+    '''Class to record wall time, CPU time, peak RSS, bytes read and items processed by a stage, as a context manager or decorator'''
+
+    ###########################################
+
+    def __init__(self, name, items = 0):
+        '''Class initialiser: Name the stage'''
+        self.name = name
+        self.items = items
+
+    ###########################################
+
+    def __call__(self, func):
+        '''Decorate a function, recording each call as one run of the stage'''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with stage(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    ###########################################
+
+    def __enter__(self):
+        '''Start timers and memory sampling'''
+        if not ENABLED:
+            return self
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self.startPeak = peak_rss()
+        self.startBytes = bytes_read()
+        self.startCPU = time.process_time()
+        self.startWall = time.perf_counter()
+        # sample RSS in the background, as the process peak may have been set by an earlier stage
+        start_sampler(self)
+        active_stages().append(self)
+        return self
+
+    ###########################################
+
+    def __exit__(self, *args):
+        '''Stop timers and record the stage'''
+        if not ENABLED:
+            return
+        wall = time.perf_counter() - self.startWall
+        cpu = time.process_time() - self.startCPU
+        stop_sampler(self)
+        active_stages().remove(self)
+        # the process peak is exact if it rose during this stage
+        endPeak = peak_rss()
+        peak = endPeak if endPeak > self.startPeak else max(self.peak, self.process.memory_info().rss)
+        _RECORDS.append({'stage': self.name, 'wall': wall, 'cpu': cpu, 'peakRSS': peak,
+                         'bytesRead': bytes_read() - self.startBytes, 'items': self.items})
+
+    ###########################################
+
+    def add(self, items):
+        '''Count items processed by the stage, eg. waveforms or pixels'''
+        self.items += items
+
+###########################################
+
+def active_stages():
+    '''Function to return the stages running in this thread, innermost last'''
+    if not hasattr(_ACTIVE, 'stages'):
+        _ACTIVE.stages = []
+    return _ACTIVE.stages
+
+###########################################
+
+def start_sampler(running):
+    '''Function to add a stage to those sampled, starting the sampler if this process has none'''
+    with _SAMPLER['busy']:
+        if _SAMPLER['pid'] != os.getpid():
+            _SAMPLER['pid'] = os.getpid()
+            threading.Thread(target = sample, daemon = True).start()
+        _SAMPLER['running'].append(running)
+        _SAMPLER['busy'].notify()
+
+###########################################
+
+def stop_sampler(running):
+    '''Function to remove a stage from those sampled'''
+    with _SAMPLER['busy']:
+        if running in _SAMPLER['running']:
+            _SAMPLER['running'].remove(running)
+
+###########################################
+
+def sample():
+    '''Sample resident memory into the running stages, waiting while none are running'''
+    process = psutil.Process()
+    while True:
+        with _SAMPLER['busy']:
+            while len(_SAMPLER['running']) == 0:
+                _SAMPLER['busy'].wait()
+        rss = process.memory_info().rss
+        with _SAMPLER['busy']:
+            for running in _SAMPLER['running']:
+                running.peak = max(running.peak, rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+###########################################
+
+def reset_sampler():
+    '''Function to give a forked process a sampler of its own, as it inherits the sampler state but not its thread'''
+    _SAMPLER.update({'pid': None, 'running': [], 'busy': threading.Condition()})
+
+os.register_at_fork(after_in_child = reset_sampler)
+
+###########################################
+
+def count_items(items):
+    '''Function to count items processed by the innermost running stage'''
+    stages = active_stages()
+    if ENABLED and (len(stages) > 0):
+        stages[-1].add(int(items))
+
+###########################################
+
+def report():
+    '''Function to return a summary of every stage run by this process, with rates'''
+    stages = {}
+    for record in _RECORDS:
+        total = stages.setdefault(record['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peakRSS': 0, 'bytesRead': 0, 'items': 0})
+        total['calls'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['peakRSS'] = max(total['peakRSS'], record['peakRSS'])
+        total['bytesRead'] += record['bytesRead']
+        total['items'] += record['items']
+    for total in stages.values():
+        total['itemsPerSecond'] = total['items'] / total['wall'] if total['wall'] > 0 else 0.0
+        total['bytesPerSecond'] = total['bytesRead'] / total['wall'] if total['wall'] > 0 else 0.0
+    return {'script': os.path.basename(sys.argv[0]), 'argv': sys.argv[1:], 'started': time.ctime(_START['time']),
+            'wall': time.perf_counter() - _START['wall'], 'cpu': time.process_time() - _START['cpu'],
+            'peakRSS': peak_rss(), 'stages': stages}
+
+###########################################
+
+def write_report(filename):
+    '''Function to print the stage summary and write it as a JSON report, when profiling is on'''
+    if not ENABLED:
+        return None
+    summary = report()
+    for name, total in sorted(summary['stages'].items(), key = lambda s: -s[1]['wall']):
+        print(f"{name:<20s} calls: {total['calls']:<6d} wall: {total['wall']:9.2f} s  cpu: {total['cpu']:9.2f} s  "
+              f"peak RSS: {convert_bytes(total['peakRSS'])}  read: {convert_bytes(total['bytesRead'])}  items/s: {total['itemsPerSecond']:.0f}")
+    print(f"Wall runtime: {round(summary['wall'] / 60, 2)} minutes, peak RAM usage: {convert_bytes(summary['peakRSS'])}")
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent = 2)
+    print("Success writing profile to", filename)
+    return summary
+
+###########################################
@@ -11,16 +11,33 @@ from osgeo import gdal, gdal_array
 import os
 import numpy as np
 import geopandas as gpd
+import pandas as pd
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
 from shapely.geometry import box
 import rasterio as rio
 from rasterio.mask import mask
 from rasterio.enums import Resampling
 from rasterio.plot import show
-from rasterio.features import geometry_mask
+from rasterio.features import geometry_mask, geometry_window
 from rasterio.windows import from_bounds, Window
 from rasterio.warp import reproject, Resampling
 from rasterio.vrt import WarpedVRT
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+import rasterio.shutil
 from scipy.interpolate import griddata
+from scipy.ndimage import distance_transform_edt
+from manageRAM import stage, count_items
+
+
+# raster opened once by each worker process
+_WORKER = {}
+
+# creation options of cloud optimized GeoTIFFs: float32 tiles, compressed, with overviews
+COG_PROFILE = {'driver': 'COG', 'compress': 'DEFLATE', 'predictor': 'FLOATING_POINT', 'blocksize': 512,
+               'overviews': 'AUTO', 'overview_resampling': 'AVERAGE', 'bigtiff': 'IF_SAFER'}
 
 
 # Define class
@@ -73,10 +90,14 @@ class methodsDEM():
   
   ###########################################
 
-  def write_tiff(self, data, filename, epsg):
+  def write_tiff(self, data, filename, epsg, cog = False):
     '''Write a geotiff from a raster layer'''
     # set geolocation information
     geotransform = (self.xOrigin, self.pixelWidth, 0, self.yOrigin, 0, self.pixelHeight)
+    # tiled, compressed and with overviews if wanted
+    if cog:
+      write_cog([data], filename, Affine.from_gdal(*geotransform), epsg)
+      return
     # load data into geotiff object
     dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.nX, self.nY, 1, gdal.GDT_Float32)
     dst_ds.SetGeoTransform(geotransform)    # Specify coords
@@ -91,28 +112,263 @@ class methodsDEM():
 
 ###########################################
 
-def filter_tiffs(geotiff_list, shapefile):
+def change_windows(old, new, blockRows = 512):
+  '''Function to return the windows to walk two aligned rasters, following their tiles'''
+  # native tiles when both rasters share them, otherwise strips of whole rows
+  if (old.profile.get('tiled', False)) & (old.block_shapes == new.block_shapes):
+    return([window for ij, window in old.block_windows(1)])
+  return([Window(0, row, old.width, min(blockRows, old.height - row)) for row in range(0, old.height, blockRows)])
+
+###########################################
+
+@stage('stream_change')
+def stream_change(old_file, new_file, output_file = None, nodata = -999, histRange = (-75, 75), histBins = 30, blockRows = 512, cog = False):
+  '''Function to difference two aligned DEMs block by block, returning running statistics of the change'''
+  stats = {'count': 0, 'sum': 0.0, 'histEdges': np.linspace(histRange[0], histRange[1], histBins + 1), 'histCounts': np.zeros(histBins, dtype = np.int64)}
+  with rio.open(old_file) as old, rio.open(new_file) as new:
+    # check dimensions of geotiffs match
+    if (old.shape != new.shape) | (old.transform != new.transform):
+      raise ValueError("GeoTIFFs have different dimensions.")
+    stats['nX'], stats['nY'] = old.width, old.height
+    count_items(old.width * old.height)
+    oldNoData = nodata if old.nodata is None else old.nodata
+    newNoData = nodata if new.nodata is None else new.nodata
+    dst = None
+    if output_file is not None:
+      # a COG is copied from a tiled GeoTIFF once every block is written
+      outName = output_file + '.tmp.tif' if cog else output_file
+      dst = rio.open(outName, 'w', driver = 'GTiff', height = old.height, width = old.width, count = 1, dtype = 'float32',
+                     crs = old.crs, transform = old.transform, nodata = nodata, tiled = True, blockxsize = 256, blockysize = 256)
+    for window in change_windows(old, new, blockRows):
+      oldData = old.read(1, window = window)
+      newData = new.read(1, window = window)
+      # change where both DEMs have data
+      valid = np.isfinite(oldData) & np.isfinite(newData) & (oldData != oldNoData) & (newData != newNoData)
+      change = np.full(oldData.shape, nodata, dtype = np.float32)
+      change[valid] = newData[valid] - oldData[valid]
+      # accumulate statistics on the fly
+      values = change[valid].astype(np.float64)
+      stats['count'] += len(values)
+      stats['sum'] += np.sum(values)
+      stats['histCounts'] += np.histogram(values, bins = stats['histEdges'])[0]
+      if dst is not None:
+        dst.write(change, 1, window = window)
+    if dst is not None:
+      dst.close()
+      if cog:
+        cog_copy(outName, output_file)
+        os.remove(outName)
+      print("Success writing image to", output_file)
+  stats['mean'] = stats['sum'] / stats['count'] if stats['count'] > 0 else np.nan
+  return(stats)
+
+###########################################
+
+@stage('zonal_stats')
+def zonal_stats(change_file, shapefile, zone_field = None, block_size = 1024, n_workers = 1, hist_range = (-500, 500), hist_bins = 20000,
+                percentiles = (5, 25, 50, 75, 95), ice_density = 917.0, years = None):
+  '''Function to return a table of change statistics, volume and mass for each polygon of a shapefile, in one block-wise pass'''
+  with rio.open(change_file) as src:
+    zones = gpd.read_file(shapefile).to_crs(src.crs)
+    # area of one pixel from the raster itself, in square metres
+    pixel_area = abs(src.transform.a * src.transform.e)
+    # only blocks under the zones are read
+    extent = geometry_window(src, list(zones.geometry.values))
+    windows = [Window(col, row, min(block_size, extent.col_off + extent.width - col), min(block_size, extent.row_off + extent.height - row))
+               for row in range(int(extent.row_off), int(extent.row_off + extent.height), block_size)
+               for col in range(int(extent.col_off), int(extent.col_off + extent.width), block_size)]
+  names = zones[zone_field].values if zone_field is not None else zones.index.values
+  count_items(sum(window.width * window.height for window in windows))
+  edges = np.linspace(hist_range[0], hist_range[1], hist_bins + 1)
+  # blocks are reduced on a pool of workers, and their sums merged as they return
+  totals = None
+  with mp.Pool(n_workers, initializer = open_worker, initargs = (change_file, list(zones.geometry.values))) as pool:
+    for part in pool.imap_unordered(zone_block, [(window, edges) for window in windows]):
+      totals = part if totals is None else merge_zones(totals, part)
+  # one row per zone
+  rows = []
+  for z, name in enumerate(names):
+    count = totals['count'][z]
+    mean = totals['sum'][z] / count if count > 0 else np.nan
+    row = {'zone': name, 'count': count, 'area': count * pixel_area, 'mean': mean,
+           'std': np.sqrt(max(totals['sumsq'][z] / count - mean * mean, 0.0)) if count > 0 else np.nan,
+           'min': totals['min'][z] if count > 0 else np.nan, 'max': totals['max'][z] if count > 0 else np.nan}
+    for p in percentiles:
+      row[f'p{p}'] = hist_percentile(totals['hist'][z], edges, p, row['min'], row['max'])
+    row['volume'] = totals['sum'][z] * pixel_area
+    row['mass'] = row['volume'] * ice_density
+    if years is not None:
+      row['massPerYear'] = row['mass'] / years
+    rows.append(row)
+  return(pd.DataFrame(rows))
+
+###########################################
+
+def zone_block(task):
+  '''Function to return the running sums of every zone over one block of the worker raster'''
+  window, edges = task
+  src, zones = _WORKER['src'], _WORKER['zones']
+  nZones = len(zones)
+  part = {'count': np.zeros(nZones, dtype = np.int64), 'sum': np.zeros(nZones), 'sumsq': np.zeros(nZones),
+          'min': np.full(nZones, np.inf), 'max': np.full(nZones, -np.inf), 'hist': np.zeros((nZones, len(edges) - 1), dtype = np.int64)}
+  data = src.read(1, window = window)
+  valid = np.isfinite(data) if src.nodata is None else np.isfinite(data) & (data != src.nodata)
+  if not valid.any():
+    return(part)
+  transform = src.window_transform(window)
+  block = box(*rio.windows.bounds(window, src.transform))
+  for z, geometry in enumerate(zones):
+    if not block.intersects(geometry):
+      continue
+    # rasterize each zone once per block
+    inside = valid & ~geometry_mask([geometry], out_shape = data.shape, transform = transform)
+    values = data[inside].astype(np.float64)
+    if len(values) == 0:
+      continue
+    part['count'][z] = len(values)
+    part['sum'][z] = np.sum(values)
+    part['sumsq'][z] = np.sum(values * values)
+    part['min'][z] = np.min(values)
+    part['max'][z] = np.max(values)
+    # values beyond the histogram range fall in its end bins
+    part['hist'][z] = np.histogram(np.clip(values, edges[0], edges[-1]), bins = edges)[0]
+  return(part)
+
+###########################################
+
+def merge_zones(totals, part):
+  '''Function to merge the running sums of two sets of blocks'''
+  merged = {key: totals[key] + part[key] for key in ['count', 'sum', 'sumsq', 'hist']}
+  merged['min'] = np.minimum(totals['min'], part['min'])
+  merged['max'] = np.maximum(totals['max'], part['max'])
+  return(merged)
+
+###########################################
+
+def hist_percentile(hist, edges, percentile, minimum, maximum):
+  '''Function to return a percentile from a histogram, interpolating within its bin'''
+  count = hist.sum()
+  if count == 0:
+    return(np.nan)
+  cumulative = np.cumsum(hist)
+  target = percentile / 100.0 * count
+  i = min(np.searchsorted(cumulative, target), len(hist) - 1)
+  below = cumulative[i - 1] if i > 0 else 0
+  value = edges[i] + (target - below) / max(hist[i], 1) * (edges[i + 1] - edges[i])
+  return(float(np.clip(value, minimum, maximum)))
+
+###########################################
+
+def write_cog(bands, filename, transform, epsg, nodata = -999, descriptions = None):
+  '''Function to write a list of 2-D arrays as a cloud optimized GeoTIFF'''
+  nY, nX = bands[0].shape
+  # write a float32 image in memory, then copy it to the COG layout with overviews
+  with MemoryFile() as memfile:
+    with memfile.open(driver = 'GTiff', height = nY, width = nX, count = len(bands), dtype = 'float32', crs = f'EPSG:{epsg}',
+                      transform = transform, nodata = nodata) as dst:
+      for band, data in enumerate(bands):
+        dst.write(np.asarray(data, dtype = np.float32), band + 1)
+        if descriptions is not None:
+          dst.set_band_description(band + 1, descriptions[band])
+    cog_copy(memfile.name, filename)
+  print("Success writing COG to", filename)
+
+###########################################
+
+def cog_copy(input_file, output_file):
+  '''Function to copy any raster to a cloud optimized GeoTIFF'''
+  rasterio.shutil.copy(input_file, output_file, **COG_PROFILE)
+
+###########################################
+
+@stage('filter_tiffs')
+def filter_tiffs(geotiff_list, shapefile, index_file = None, n_workers = 8, valid_extent = False):
   '''Function to return list of geotiffs in range of study area'''
-  # read shape and define bounding box
+  # read headers of new or changed geotiffs only, in parallel
+  index = index_tiffs(geotiff_list, index_file = index_file, n_workers = n_workers, valid_extent = valid_extent)
+  # test against the glacier polygon, not just its bounding box
   gdf = gpd.read_file(shapefile)
-  bounding_box = gdf.total_bounds
-  # read subsets
-  filtered_list = []
-  for tiff in geotiff_list:
-      ds = gdal.Open(tiff)
-      dem_bbox = [ds.GetGeoTransform()[0], ds.GetGeoTransform()[3] + ds.RasterYSize * ds.GetGeoTransform()[5],
-                  ds.GetGeoTransform()[0] + ds.RasterXSize * ds.GetGeoTransform()[1], ds.GetGeoTransform()[3]]
-      # retrieve data within bounding box
-      dem_geom = box(dem_bbox[0], dem_bbox[1], dem_bbox[2], dem_bbox[3])
-      shapefile_geom = box(bounding_box[0], bounding_box[1], bounding_box[2], bounding_box[3])
-      # add to filtered list if data intersects with box
-      if dem_geom.intersects(shapefile_geom):
-          filtered_list.append(tiff)
+  if len(index) > 0:
+    gdf = gdf.to_crs(index.crs.iloc[0])
+  polygon = gdf.geometry.union_all() if hasattr(gdf.geometry, 'union_all') else gdf.geometry.unary_union
+  filtered_list = query_tiffs(index, polygon, valid_extent = valid_extent)
+  count_items(len(geotiff_list))
   print(f'Subsets in range of study area: {len(filtered_list)}')
   return filtered_list
 
+###########################################
+
+def tiff_header(tiff, valid_extent = False):
+  '''Function to return the footprint of a geotiff from its header, and optionally the extent of its valid data'''
+  stat = os.stat(tiff)
+  with rio.open(tiff) as ds:
+    header = {'filename': os.path.abspath(tiff), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'crs': ds.crs.to_string(),
+              'minX': ds.bounds.left, 'minY': ds.bounds.bottom, 'maxX': ds.bounds.right, 'maxY': ds.bounds.top,
+              'validMinX': np.nan, 'validMinY': np.nan, 'validMaxX': np.nan, 'validMaxY': np.nan, 'validChecked': bool(valid_extent)}
+    if valid_extent:
+      # rows and columns holding data, walked along the internal blocks
+      rows, cols = [], []
+      for ij, window in ds.block_windows(1):
+        data = ds.read(1, window = window)
+        valid = np.isfinite(data) if ds.nodata is None else np.isfinite(data) & (data != ds.nodata)
+        r, c = np.where(valid)
+        if len(r) > 0:
+          rows += [window.row_off + r.min(), window.row_off + r.max()]
+          cols += [window.col_off + c.min(), window.col_off + c.max()]
+      if len(rows) > 0:
+        left, bottom, right, top = rio.windows.bounds(Window(min(cols), min(rows), max(cols) - min(cols) + 1, max(rows) - min(rows) + 1), ds.transform)
+        header.update({'validMinX': left, 'validMinY': bottom, 'validMaxX': right, 'validMaxY': top})
+  return(header)
+
+###########################################
+
+def index_tiffs(geotiff_list, index_file = None, n_workers = 8, valid_extent = False):
+  '''Function to return a table of geotiff footprints, reusing the cached rows of unchanged files'''
+  cached = pd.read_csv(index_file) if (index_file is not None) and os.path.isfile(index_file) else None
+  rows, todo = {}, []
+  for tiff in geotiff_list:
+    name = os.path.abspath(tiff)
+    stat = os.stat(name)
+    if cached is not None:
+      match = cached[(cached.filename == name) & (cached['size'] == stat.st_size) & (cached.mtime == stat.st_mtime_ns)]
+      # a cached row whose data was never scanned is read again if a valid extent is needed,
+      # while a scanned file without valid data keeps its empty extent (rows of older indexes have no flag)
+      if (len(match) > 0) and ((not valid_extent) or (match.iloc[0].get('validChecked', False) == True)):
+        rows[name] = match.iloc[0].to_dict()
+        continue
+    todo.append(name)
+  # headers are small reads, so threads overlap the file system latency
+  with ThreadPoolExecutor(max_workers = max(1, n_workers)) as pool:
+    for header in pool.map(lambda tiff: tiff_header(tiff, valid_extent), todo):
+      rows[header['filename']] = header
+  index = pd.DataFrame([rows[os.path.abspath(tiff)] for tiff in geotiff_list],
+                       columns = ['filename', 'size', 'mtime', 'crs', 'minX', 'minY', 'maxX', 'maxY', 'validMinX', 'validMinY', 'validMaxX', 'validMaxY', 'validChecked'])
+  if index_file is not None:
+    # keep rows of files not in this list, so one index can serve many lists
+    if cached is not None:
+      index = pd.concat([cached[~cached.filename.isin(index.filename)], index], ignore_index = True)
+    index.to_csv(index_file, index = False)
+    index = index[index.filename.isin([os.path.abspath(tiff) for tiff in geotiff_list])]
+  print(f'Geotiff headers read: {len(todo)}, cached: {len(geotiff_list) - len(todo)}')
+  return(index)
+
+###########################################
+
+def query_tiffs(index, geometry, valid_extent = False):
+  '''Function to return the geotiffs of an index whose footprint, or valid extent, intersects a geometry'''
+  if len(index) == 0:
+    return []
+  cols = ['validMinX', 'validMinY', 'validMaxX', 'validMaxY'] if valid_extent else ['minX', 'minY', 'maxX', 'maxY']
+  # tiles without any valid data have no extent, so never hit
+  use = index.dropna(subset = cols)
+  boxes = shapely.box(use[cols[0]].values, use[cols[1]].values, use[cols[2]].values, use[cols[3]].values)
+  tree = shapely.STRtree(boxes)
+  hits = np.sort(tree.query(geometry, predicate = 'intersects'))
+  return list(use.filename.values[hits])
+
   ###########################################
 
+@stage('merge_tiffs')
 def merge_tiffs(filtered_list, output_dir, step_size, label):
   '''Function to batch process / merge geotiffs'''
   # systematically iterate through subsets
@@ -136,40 +392,94 @@ def merge_tiffs(filtered_list, output_dir, step_size, label):
 
 ###########################################
 
-def clip_tiff(input_file, shapefile, output_file, reference_raster = None):
+@stage('mosaic_tiffs')
+def mosaic_tiffs(geotiff_list, output_file, res = 30, compress = 'DEFLATE', n_workers = 4, tile_size = 2048, nodata = -999, cog = False):
+  '''Function to mosaic geotiffs in one pass, reading output windows of one virtual dataset on a pool of workers'''
+  # virtual mosaic of all inputs, kept as XML in memory rather than written out
+  options = gdal.BuildVRTOptions(xRes = res, yRes = res, resolution = 'user', srcNodata = nodata, VRTNodata = nodata)
+  vrt = gdal.BuildVRT('/vsimem/mosaic.vrt', geotiff_list, options = options)
+  vrt_xml = vrt.GetMetadata('xml:VRT')[0]
+  vrt = None
+  gdal.Unlink('/vsimem/mosaic.vrt')
+  with rio.open(vrt_xml) as src:
+    profile = {'driver': 'GTiff', 'height': src.height, 'width': src.width, 'count': 1, 'dtype': src.dtypes[0], 'crs': src.crs,
+               'transform': src.transform, 'nodata': nodata, 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'bigtiff': 'IF_SAFER'}
+  if compress is not None:
+    profile.update({'compress': compress, 'predictor': 3 if np.dtype(profile['dtype']).kind == 'f' else 2, 'num_threads': n_workers})
+  count_items(profile['width'] * profile['height'])
+  # whole output tiles, so no two windows share a block
+  tile_size = max(512, (tile_size // 512) * 512)
+  windows = [Window(col, row, min(tile_size, profile['width'] - col), min(tile_size, profile['height'] - row))
+             for row in range(0, profile['height'], tile_size) for col in range(0, profile['width'], tile_size)]
+  out_name = output_file + '.tmp.tif' if cog else output_file
+  with rio.open(out_name, 'w', **profile) as dst, mp.Pool(n_workers, initializer = open_worker, initargs = (vrt_xml,)) as pool:
+    # a few windows per worker at a time, so memory is bounded by the tile size
+    step = 2 * n_workers
+    for i in range(0, len(windows), step):
+      for window, data in zip(windows[i:i + step], pool.map(read_mosaic, windows[i:i + step])):
+        dst.write(data, 1, window = window)
+  if cog:
+    cog_copy(out_name, output_file)
+    os.remove(out_name)
+  print(f'------------SUCCESS: {len(geotiff_list)} LVIS DEMS MOSAICKED------------:\t {output_file}')
+
+###########################################
+
+def open_worker(filename, zones = None):
+  '''Function to open a raster, or virtual mosaic, once in each worker process'''
+  _WORKER['src'] = rio.open(filename)
+  _WORKER['zones'] = zones
+
+###########################################
+
+def read_mosaic(window):
+  '''Function to read one output window of the virtual mosaic'''
+  return(_WORKER['src'].read(1, window = window))
+
+###########################################
+
+@stage('clip_tiff')
+def clip_tiff(input_file, shapefile, output_file, reference_raster = None, block_size = 1024, nodata = -999):
   '''Function to clip a geotiff to study area'''
-  # read input raster and shapefile
-  glacier = gpd.read_file(shapefile)
-  dem = rio.open(input_file)
-  # align raster and shape geometry
-  glacier = glacier.to_crs(dem.crs)
-  geometry = glacier.geometry.values[0]
-  geoms = [geometry]
-  # use reference raster dimensions if provided
-  if reference_raster:
-      reference = rio.open(reference_raster)
-      vrt_options = {'resampling': Resampling.nearest, 'src_crs': dem.crs, 'src_transform': dem.transform, 'crs': reference.crs,
-                      'transform': reference.transform, 'width': reference.width, 'height': reference.height}
-      vrt = WarpedVRT(dem, **vrt_options)
-      dem = rio.MemoryFile().open(driver = 'GTiff', count = 1, width = reference.width, height = reference.height, 
-                                  transform = reference.transform, dtype = vrt.read(1).dtype)
-      dem.write(vrt.read(1), 1)
-  # clip dem to shapefile
-  dem_glacier, transform = rio.mask.mask(dataset = dem, shapes = geoms, crop = True)
-  # update metadata with epsg and no-data value
-  metadata = dem.meta.copy()
-  metadata.update({'driver': 'GTiff', 'crs': 'EPSG:3031', 'height': dem_glacier.shape[1], 'width': dem_glacier.shape[2], 
-                    'transform': transform, 'nodata': -999})
-  # write the clipped DEM as geotiff
-  with rio.open(output_file, 'w', **metadata) as dst:
-      dst.write(dem_glacier)
-  dem.close()
+  with rio.open(input_file) as dem:
+    # warp to the reference grid on the fly, window by window, if one is given
+    if reference_raster:
+      with rio.open(reference_raster) as reference:
+        grid = {'crs': reference.crs, 'transform': reference.transform, 'width': reference.width, 'height': reference.height}
+      src = WarpedVRT(dem, resampling = Resampling.nearest, nodata = nodata, **grid)
+    else:
+      src = dem
+    # align shape geometry with the output grid
+    glacier = gpd.read_file(shapefile).to_crs(src.crs)
+    geometry = glacier.geometry.values[0]
+    # crop to the pixels covering the shape, as rio.mask.mask does
+    crop = geometry_window(src, [geometry])
+    src_nodata = nodata if src.nodata is None else src.nodata
+    metadata = {'driver': 'GTiff', 'count': 1, 'dtype': src.dtypes[0], 'crs': 'EPSG:3031', 'height': int(crop.height), 'width': int(crop.width),
+                'transform': src.window_transform(crop), 'nodata': nodata, 'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+    count_items(metadata['width'] * metadata['height'])
+    with rio.open(output_file, 'w', **metadata) as dst:
+      for row in range(0, metadata['height'], block_size):
+        for col in range(0, metadata['width'], block_size):
+          window = Window(col, row, min(block_size, metadata['width'] - col), min(block_size, metadata['height'] - row))
+          data = src.read(1, window = Window(crop.col_off + col, crop.row_off + row, window.width, window.height))
+          # rasterize the shape once per window, and blank pixels outside it
+          outside = geometry_mask([geometry], out_shape = data.shape, transform = dst.window_transform(window))
+          data[outside | (data == src_nodata)] = nodata
+          dst.write(data, 1, window = window)
+    if src is not dem:
+      src.close()
   print(f'------------SUCCESS: LVIS DEM CLIPPED------------:\t {output_file}')
 
 ###########################################
 
-def smooth_tiff(input_file, output_file, window_size):
+@stage('smooth_tiff')
+def smooth_tiff(input_file, output_file, window_size, max_distance = None, tile_size = 1024, n_workers = 1):
   '''Gap fill no data values in geotiff'''
+  # fill only the holes, tile by tile, if a search distance is given
+  if max_distance is not None:
+    fill_gaps(input_file, output_file, max_distance, tile_size = tile_size, n_workers = n_workers)
+    return
   # read input raster data
   with rio.open(input_file) as src:
       data = src.read(1)
@@ -190,4 +500,111 @@ def smooth_tiff(input_file, output_file, window_size):
 ###########################################
     
 
+@stage('fill_gaps')
+def fill_gaps(input_file, output_file, max_distance, tile_size = 1024, n_workers = 1, min_value = 20):
+  '''Function to gap fill no data pixels within max_distance pixels of data, in halo-overlapped tiles'''
+  # the halo holds the far side of holes up to twice the search distance across
+  halo = 2 * int(np.ceil(max_distance)) + 1
+  with rio.open(input_file) as src:
+    profile = src.profile.copy()
+    nodata = -999 if src.nodata is None else src.nodata
+    windows = [Window(col, row, min(tile_size, src.width - col), min(tile_size, src.height - row))
+               for row in range(0, src.height, tile_size) for col in range(0, src.width, tile_size)]
+  profile.update({'nodata': nodata, 'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+  count_items(profile['width'] * profile['height'])
+  tasks = [(window, halo, max_distance, nodata, min_value) for window in windows]
+  print('Smoothing geotiff...')
+  with rio.open(output_file, 'w', **profile) as dst, mp.Pool(n_workers, initializer = open_worker, initargs = (input_file,)) as pool:
+    # a few tiles per worker at a time, so memory is bounded by the tile size
+    step = 2 * n_workers
+    for i in range(0, len(tasks), step):
+      for window, filled in zip(windows[i:i + step], pool.map(fill_tile, tasks[i:i + step])):
+        dst.write(filled, 1, window = window)
+  print(f'------------SUCCESS: LVIS DEM SMOOTHED------------:\t {output_file}')
+
+###########################################
 
+def fill_tile(task):
+  '''Function to gap fill one tile of the worker raster, returning the tile without its halo'''
+  window, halo, max_distance, nodata, min_value = task
+  src = _WORKER['src']
+  # read the tile with its halo, clipped to the raster, and nothing more
+  box = grow_box(src, window.row_off, window.col_off, window.row_off + window.height, window.col_off + window.width, halo)
+  data = src.read(1, window = Window(box[1], box[0], box[3] - box[1], box[2] - box[0])).astype(np.float64)
+  nodata_mask = ~np.isfinite(data) | (data == nodata) | (data < min_value)
+  # core of the tile, in halo coordinates
+  core = (slice(window.row_off - box[0], window.row_off - box[0] + window.height), slice(window.col_off - box[1], window.col_off - box[1] + window.width))
+  filled = np.where(nodata_mask, nodata, data)
+  if nodata_mask.all() or not nodata_mask[core].any():
+    return(filled[core].astype(src.dtypes[0]))
+  # holes within the search distance of data, exact in the core as the halo holds all data within it
+  gaps = nodata_mask & (distance_transform_edt(nodata_mask) <= max_distance)
+  # each pixel only uses data within the halo of it, so every tile gives it the same value
+  values = line_fill(np.where(nodata_mask, 0.0, data), ~nodata_mask, halo)
+  fill = gaps & np.isfinite(values)
+  filled[fill] = values[fill]
+  return(filled[core].astype(src.dtypes[0]))
+
+###########################################
+
+def grow_box(src, row0, col0, row1, col1, margin):
+  '''Function to return a box of pixel rows and columns grown by a margin, clipped to the raster'''
+  return((max(0, row0 - margin), max(0, col0 - margin), min(src.height, row1 + margin), min(src.width, col1 + margin)))
+
+###########################################
+
+def line_fill(data, valid, limit):
+  '''Function to interpolate every pixel between the nearest data either side of it along rows, columns and diagonals, within limit pixels'''
+  total = np.zeros(data.shape)
+  weight = np.zeros(data.shape)
+  nY, nX = data.shape
+  # lines as the columns of a view of the box: columns, rows, and the two diagonals sheared into columns
+  lines = [(lambda a: a, lambda a: a, 1.0),
+           (lambda a: a.T, lambda a: a.T, 1.0),
+           (shear, lambda a: unshear(a, nY, nX), np.sqrt(2.0)),
+           (lambda a: shear(a[:, ::-1]), lambda a: unshear(a, nY, nX)[:, ::-1], np.sqrt(2.0))]
+  for to_lines, from_lines, step in lines:
+    before, after, vBefore, vAfter = nearest_along(to_lines(data), to_lines(valid))
+    before, after, vBefore, vAfter = from_lines(before), from_lines(after), from_lines(vBefore), from_lines(vAfter)
+    # only pixels without data, spanned by data on both sides within the limit
+    use = ~valid & (before <= limit) & (after <= limit)
+    span = (before + after)[use]
+    # linear along the line, and short spans weigh more than long ones
+    w = 1.0 / (span * step)**2
+    total[use] += w * (vBefore[use] * after[use] + vAfter[use] * before[use]) / span
+    weight[use] += w
+  values = np.full(data.shape, np.nan)
+  np.divide(total, weight, out = values, where = weight > 0)
+  return(values)
+
+###########################################
+
+def nearest_along(data, valid):
+  '''Function to return the distance and value of the nearest valid pixel before and after every pixel, down each column'''
+  n = data.shape[0]
+  idx = np.arange(n)[:, np.newaxis]
+  # no valid pixel gives a distance longer than the column
+  last = np.maximum.accumulate(np.where(valid, idx, -2 * n), axis = 0)
+  first = np.minimum.accumulate(np.where(valid, idx, 3 * n)[::-1], axis = 0)[::-1]
+  vBefore = np.take_along_axis(data, np.clip(last, 0, n - 1), axis = 0)
+  vAfter = np.take_along_axis(data, np.clip(first, 0, n - 1), axis = 0)
+  return(idx - last, first - idx, vBefore, vAfter)
+
+###########################################
+
+def shear(a):
+  '''Function to shear an array so its down-right diagonals are columns, padding with zeros'''
+  nY, nX = a.shape
+  rows, cols = np.mgrid[0:nY, 0:nX]
+  out = np.zeros((nY, nX + nY - 1), dtype = a.dtype)
+  out[rows, cols - rows + nY - 1] = a
+  return(out)
+
+###########################################
+
+def unshear(a, nY, nX):
+  '''Function to undo shear()'''
+  rows, cols = np.mgrid[0:nY, 0:nX]
+  return(a[rows, cols - rows + nY - 1])
+
+###########################################
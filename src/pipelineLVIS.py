@@ -0,0 +1,397 @@
+'''
+Class to Run the LVIS Pipeline as Cached Stages
+'''
+
+# Import libraries
+import argparse
+import hashlib
+import inspect
+import shutil
+import json
+import glob
+import time
+import sys
+import os
+from catalogLVIS import catalogLVIS
+from streamLVIS import stream_file, read_footprints
+from plotLVIS import footprints_to_tiff
+from methodsDEM import filter_tiffs, mosaic_tiffs, clip_tiff, smooth_tiff, stream_change
+
+
+# manifest written once a stage has finished, marking its artifact complete
+MANIFEST = 'stage.json'
+
+
+###########################################
+
+class stageRef():
+  '''Class to refer to the outputs of a declared stage, as the input of a later one'''
+
+  ###########################################
+
+  def __init__(self, name):
+    '''Class initialiser: Name the stage referred to'''
+    self.name = name
+
+###########################################
+
+class pipelineLVIS():
+  '''Class to run declared stages, caching each output under a hash of its code, inputs and parameters'''
+
+  ###########################################
+
+  def __init__(self, workDir, force = False):
+    '''Class initialiser: Set the artifact directory'''
+    self.workDir = workDir
+    self.force = force      # rerun every stage, replacing cached artifacts
+    self.stages = {}        # declared stages, in declaration order
+    self.keys = {}          # hash of each stage, once found
+    self.outputs = {}       # output files of each stage, once run or loaded
+    os.makedirs(workDir, exist_ok = True)
+
+  ###########################################
+
+  def add(self, name, func, inputs = {}, params = {}, options = {}):
+    '''Declare a stage, called as func(outDir, **inputs, **params, **options), returning its output files'''
+    if(name in self.stages):
+      raise ValueError(f"Stage {name} is already declared")
+    for ref in stage_refs(inputs):
+      if(ref.name not in self.stages):
+        raise ValueError(f"Stage {name} needs {ref.name}, which must be declared first")
+    # options, eg. numbers of workers, do not change the outputs so are left out of the hash
+    self.stages[name] = {'func': func, 'inputs': dict(inputs), 'params': dict(params), 'options': dict(options)}
+    return(stageRef(name))
+
+  ###########################################
+
+  def key(self, name):
+    '''Return the hash of a stage, from its code, parameters, input files and the hashes of the stages it uses'''
+    if(name in self.keys):
+      return(self.keys[name])
+    stage = self.stages[name]
+    label = {'stage': name, 'code': code_hash(stage['func']), 'params': stage['params'],
+             'inputs': {arg: self.fingerprint(value) for arg, value in sorted(stage['inputs'].items())}}
+    self.keys[name] = hashlib.sha1(json.dumps(label, sort_keys = True, default = repr).encode()).hexdigest()
+    return(self.keys[name])
+
+  ###########################################
+
+  def fingerprint(self, value):
+    '''Return what identifies an input: the hash of a stage, or the path, size and modification time of files'''
+    if(isinstance(value, stageRef)):
+      return(self.key(value.name))
+    if(isinstance(value, (list, tuple))):
+      return([self.fingerprint(v) for v in value])
+    if(isinstance(value, str) and os.path.exists(value)):
+      return(file_fingerprint(value))
+    return(value)
+
+  ###########################################
+
+  def needed(self, targets = None):
+    '''Return the stages that targets depend on, in declaration order'''
+    if(targets is None):
+      return(list(self.stages))
+    needed = set()
+    todo = list(targets)
+    while(len(todo) > 0):
+      name = todo.pop()
+      if(name in needed):
+        continue
+      if(name not in self.stages):
+        raise ValueError(f"Unknown stage {name}")
+      needed.add(name)
+      todo.extend(ref.name for ref in stage_refs(self.stages[name]['inputs']))
+    return([name for name in self.stages if name in needed])
+
+  ###########################################
+
+  def run(self, targets = None):
+    '''Run the stages targets depend on, loading stages whose hash is unchanged from the cache'''
+    ran, cached = [], []
+    for name in self.needed(targets):
+      entry = self.entry(name)
+      if((not self.force) and os.path.isfile(os.path.join(entry, MANIFEST))):
+        with open(os.path.join(entry, MANIFEST)) as f:
+          self.outputs[name] = resolve_outputs(entry, json.load(f)['outputs'])
+        cached.append(name)
+        continue
+      self.run_stage(name, entry)
+      ran.append(name)
+    print(f"Pipeline ran {len(ran)} stages and reused {len(cached)} from the cache:", ran)
+    return(self.outputs)
+
+  ###########################################
+
+  def run_stage(self, name, entry):
+    '''Run one stage into a temporary directory, then rename it to its artifact directory'''
+    stage = self.stages[name]
+    inputs = {arg: self.resolve(value) for arg, value in stage['inputs'].items()}
+    # readers never see a partial artifact, and a failed stage leaves nothing behind
+    tempEntry = entry + f'.tmp{os.getpid()}'
+    shutil.rmtree(tempEntry, ignore_errors = True)
+    os.makedirs(tempEntry)
+    print(f"-----------------STAGE {name}-----------------")
+    start = time.perf_counter()
+    try:
+      outputs = stage['func'](tempEntry, **inputs, **stage['params'], **stage['options'])
+    except BaseException:
+      shutil.rmtree(tempEntry, ignore_errors = True)
+      raise
+    # outputs are kept relative to the artifact, so the rename keeps them valid
+    relative = relative_outputs(tempEntry, outputs)
+    manifest = {'stage': name, 'key': self.key(name), 'params': stage['params'], 'outputs': relative,
+                'inputs': {arg: self.fingerprint(value) for arg, value in stage['inputs'].items()},
+                'seconds': time.perf_counter() - start, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(os.path.join(tempEntry, MANIFEST), 'w') as f:
+      json.dump(manifest, f, indent = 2, default = repr)
+    shutil.rmtree(entry, ignore_errors = True)
+    os.rename(tempEntry, entry)
+    self.outputs[name] = resolve_outputs(entry, relative)
+
+  ###########################################
+
+  def resolve(self, value):
+    '''Replace references to stages with their output files'''
+    if(isinstance(value, stageRef)):
+      return(self.outputs[value.name])
+    if(isinstance(value, list)):
+      return([self.resolve(v) for v in value])
+    return(value)
+
+  ###########################################
+
+  def entry(self, name):
+    '''Return the artifact directory of a stage for its current hash'''
+    return(os.path.join(self.workDir, name, self.key(name)))
+
+  ###########################################
+
+  def prune(self):
+    '''Delete artifacts of declared stages that no longer match their hash'''
+    for name in self.stages:
+      current = self.key(name)
+      for old in glob.glob(os.path.join(self.workDir, name, '*')):
+        if(os.path.basename(old) != current):
+          shutil.rmtree(old, ignore_errors = True)
+          print("Deleted stale artifact", old)
+
+###########################################
+
+def stage_refs(inputs):
+  '''Function to return the stage references among stage inputs, including in lists'''
+  refs = []
+  for value in inputs.values():
+    for v in (value if isinstance(value, (list, tuple)) else [value]):
+      if(isinstance(v, stageRef)):
+        refs.append(v)
+  return(refs)
+
+###########################################
+
+def code_hash(func):
+  '''Function to return a hash of the source of a stage function and of the modules of this project it uses, so editing either reruns the stage'''
+  try:
+    source = inspect.getsource(func)
+  except (OSError, TypeError):
+    source = f'{func.__module__}.{func.__qualname__}'
+  digest = hashlib.sha1(source.encode())
+  for path in local_modules(func):
+    digest.update(os.path.basename(path).encode())
+    with open(path, 'rb') as f:
+      digest.update(f.read())
+  return(digest.hexdigest())
+
+###########################################
+
+def local_modules(func):
+  '''Function to return the files of the modules in this directory that a function uses, directly or through each other'''
+  srcDir = os.path.dirname(os.path.abspath(__file__))
+  def local(value):
+    # the module a value is, or was defined in, if it is a file of this directory
+    module = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None) or '')
+    path = getattr(module, '__file__', None)
+    if((path is None) or (os.path.dirname(os.path.abspath(path)) != srcDir)):
+      return(None)
+    return(module)
+  # names the function refers to, including in functions defined inside it
+  names, codes = set(), [func.__code__]
+  while(len(codes) > 0):
+    code = codes.pop()
+    names.update(code.co_names)
+    codes.extend(c for c in code.co_consts if inspect.iscode(c))
+  # the module of the function itself is left out, as only its own source counts
+  skip = sys.modules.get(func.__module__)
+  todo = [local(func.__globals__[name]) for name in names if name in func.__globals__]
+  found = {}
+  while(len(todo) > 0):
+    module = todo.pop()
+    if((module is None) or (module is skip) or (module.__name__ in found)):
+      continue
+    found[module.__name__] = os.path.abspath(module.__file__)
+    todo.extend(local(value) for value in vars(module).values())
+  return(sorted(found.values()))
+
+###########################################
+
+def file_fingerprint(path):
+  '''Function to return the path, size and modification time of a file, with the sidecars of a shapefile'''
+  # a shapefile is several files sharing a name
+  paths = sorted(glob.glob(os.path.splitext(path)[0] + '.*')) if path.endswith('.shp') else [path]
+  fingerprint = []
+  for p in paths:
+    stat = os.stat(p)
+    fingerprint.append([os.path.abspath(p), stat.st_size, stat.st_mtime_ns])
+  return(fingerprint)
+
+###########################################
+
+def relative_outputs(entry, outputs):
+  '''Function to return output files relative to the artifact directory'''
+  if(outputs is None):
+    return(None)
+  if(isinstance(outputs, (list, tuple))):
+    return([relative_outputs(entry, o) for o in outputs])
+  return(os.path.relpath(outputs, entry))
+
+###########################################
+
+def resolve_outputs(entry, outputs):
+  '''Function to return output files as paths inside the artifact directory'''
+  if(outputs is None):
+    return(None)
+  if(isinstance(outputs, list)):
+    return([resolve_outputs(entry, o) for o in outputs])
+  return(os.path.join(entry, outputs))
+
+###########################################
+
+def ground_stage(outDir, lvis_file, sigThresh = 5, dtype = 'float64', blockSize = 50000, memBudget = None, nWorkers = 1, indexDir = None):
+  '''Stage to read and ground a LVIS file, writing its footprints'''
+  outName = os.path.join(outDir, os.path.basename(lvis_file).replace('.h5', '_footprints.h5'))
+  stream_file(lvis_file, outName, blockSize = blockSize, useIndex = True, indexDir = indexDir, dtype = dtype,
+              sigThresh = sigThresh, memBudget = memBudget, nWorkers = nWorkers)
+  return(outName)
+
+###########################################
+
+def grid_stage(outDir, footprints, res = 30, epsg = 3031, cog = False):
+  '''Stage to grid the footprints of a LVIS file to a DEM subset, or none if it has no ground estimates'''
+  data = read_footprints(footprints)
+  if(len(data['ZG']) == 0):
+    return([])
+  outName = os.path.join(outDir, os.path.basename(footprints).replace('_footprints.h5', '_DEM.tif'))
+  footprints_to_tiff(data['ZG'], data['X'], data['Y'], res, outName, epsg, cog = cog)
+  return([outName])
+
+###########################################
+
+def merge_stage(outDir, dems, shapefile, year, res = 30, compress = 'DEFLATE', nWorkers = 4):
+  '''Stage to mosaic the DEM subsets inside the study area'''
+  subsets = [dem for file_dems in dems for dem in file_dems]
+  filtered = filter_tiffs(subsets, shapefile, n_workers = nWorkers)
+  outName = os.path.join(outDir, f'LVIS_DEM_{year}_RAW.tif')
+  mosaic_tiffs(filtered, outName, res = res, compress = compress, n_workers = nWorkers)
+  return(outName)
+
+###########################################
+
+def clip_stage(outDir, dem, shapefile, year):
+  '''Stage to clip a mosaicked DEM to the study area'''
+  outName = os.path.join(outDir, f'LVIS_DEM_{year}_CROP.tif')
+  clip_tiff(dem, shapefile, outName)
+  return(outName)
+
+###########################################
+
+def smooth_stage(outDir, dem, shapefile, year, window_size = 1, max_distance = 100, tile_size = 1024, nWorkers = 1):
+  '''Stage to gap fill a DEM and clip it to the study area again'''
+  smoothName = os.path.join(outDir, f'LVIS_DEM_{year}_SMOOTH.tif')
+  smooth_tiff(dem, smoothName, window_size, max_distance = max_distance, tile_size = tile_size, n_workers = nWorkers)
+  outName = os.path.join(outDir, f'LVIS_DEM_{year}_FINAL.tif')
+  clip_tiff(smoothName, shapefile, outName)
+  # only the final DEM is kept
+  os.remove(smoothName)
+  return(outName)
+
+###########################################
+
+def change_stage(outDir, old_dem, new_dem, shapefile, histRange = (-75, 75), histBins = 30, cog = False):
+  '''Stage to clip both DEMs to their overlap and difference them, writing the change and its statistics'''
+  overlap = [os.path.join(outDir, os.path.basename(dem).replace('.tif', '_OVERLAP.tif')) for dem in [old_dem, new_dem]]
+  clip_tiff(old_dem, shapefile, overlap[0], reference_raster = new_dem)
+  clip_tiff(new_dem, shapefile, overlap[1], reference_raster = new_dem)
+  outName = os.path.join(outDir, 'LVIS_ELEVATION_CHANGE.tif')
+  stats = stream_change(overlap[0], overlap[1], outName, histRange = histRange, histBins = histBins, cog = cog)
+  statsName = os.path.join(outDir, 'change_stats.json')
+  with open(statsName, 'w') as f:
+    json.dump(stats, f, indent = 2, default = lambda v: v.tolist())
+  return([outName, statsName] + overlap)
+
+###########################################
+
+def declare_pipeline(pipe, lvis_files, shapefile, res = 30, sigThresh = 5, dtype = 'float64', memBudget = None, window_size = 1,
+                     max_distance = 100, tile_size = 1024, nWorkers = 1, indexDir = None, cog = False):
+  '''Function to declare the read, ground, grid, merge, clip, smooth and change stages of two years of LVIS files'''
+  finals = []
+  for year in sorted(lvis_files):
+    dems = []
+    for lvis_file in lvis_files[year]:
+      name = os.path.basename(lvis_file).replace('.h5', '')
+      footprints = pipe.add(f'ground_{year}_{name}', ground_stage, inputs = {'lvis_file': lvis_file},
+                            params = {'sigThresh': sigThresh, 'dtype': dtype},
+                            options = {'memBudget': memBudget, 'nWorkers': nWorkers, 'indexDir': indexDir})
+      dems.append(pipe.add(f'grid_{year}_{name}', grid_stage, inputs = {'footprints': footprints}, params = {'res': res, 'cog': cog}))
+    merged = pipe.add(f'merge_{year}', merge_stage, inputs = {'dems': dems, 'shapefile': shapefile}, params = {'year': year, 'res': res},
+                      options = {'nWorkers': nWorkers})
+    clipped = pipe.add(f'clip_{year}', clip_stage, inputs = {'dem': merged, 'shapefile': shapefile}, params = {'year': year})
+    finals.append(pipe.add(f'smooth_{year}', smooth_stage, inputs = {'dem': clipped, 'shapefile': shapefile},
+                           params = {'year': year, 'window_size': window_size, 'max_distance': max_distance},
+                           options = {'tile_size': tile_size, 'nWorkers': nWorkers}))
+  # the earliest year is differenced from the latest
+  return(pipe.add('change', change_stage, inputs = {'old_dem': finals[0], 'new_dem': finals[-1], 'shapefile': shapefile}, params = {'cog': cog}))
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Run the whole pipeline, rerunning only stages whose code, inputs or parameters changed
+  parser = argparse.ArgumentParser(description = 'Run the LVIS pipeline from waveforms to elevation change, caching every stage')
+  parser.add_argument('--lvis_dir', default = '/geos/netdata/oosa/assignment/lvis/', help = 'Directory holding a folder of LVIS files per year')
+  parser.add_argument('--years', nargs = 2, default = ['2009', '2015'], help = 'Earlier and later year to difference')
+  parser.add_argument('--shape', default = '.../shapes/pine_island_glacier.shp', help = 'Shapefile of the study area')
+  parser.add_argument('--work_dir', default = 'pipeline', help = 'Directory of cached stage artifacts')
+  parser.add_argument('--index_dir', help = 'Directory for spatial index sidecars, by default lvis_index in the work directory')
+  parser.add_argument('--res', type = int, default = 30, help = 'Spatial resolution of DEMs in meters')
+  parser.add_argument('--sig_thresh', type = float, default = 5, help = 'Noise threshold of ground estimation, in standard deviations')
+  parser.add_argument('--dtype', default = 'float64', choices = ['float32', 'float64'], help = 'Working precision of ground estimation')
+  parser.add_argument('--mem_budget', type = float, help = 'Memory budget for denoising in MB')
+  parser.add_argument('--window_size', type = int, default = 1, help = 'Window size of smoothing')
+  parser.add_argument('--max_distance', type = float, default = 100, help = 'Only gap fill pixels within this many pixels of data')
+  parser.add_argument('--tile_size', type = int, default = 1024, help = 'Size of tiles gap filled in parallel, in pixels')
+  parser.add_argument('--workers', type = int, default = 1, help = 'Number of processes of parallel steps')
+  parser.add_argument('--cog', action = 'store_true', help = 'Write DEM subsets and the change as cloud optimized GeoTIFFs')
+  parser.add_argument('--targets', nargs = '+', help = 'Only run these stages and those they depend on, eg. smooth_2009')
+  parser.add_argument('--force', action = 'store_true', help = 'Rerun every stage, ignoring cached artifacts')
+  parser.add_argument('--prune', action = 'store_true', help = 'Delete artifacts that no longer match their stage')
+  args = parser.parse_args()
+  # sidecars and catalogues are kept with the artifacts, so the shared data directory is never written to
+  if args.index_dir is None:
+    args.index_dir = os.path.join(args.work_dir, 'lvis_index')
+  os.makedirs(args.index_dir, exist_ok = True)
+  # only files with footprints in the study area are processed
+  lvis_files = {}
+  for year in args.years:
+    catalog = catalogLVIS(os.path.join(args.lvis_dir, year), catalogFile = os.path.join(args.work_dir, f'lvis_catalog_{year}.csv'), indexDir = args.index_dir)
+    lvis_files[year] = [hit['filename'] for hit in catalog.query_shape(args.shape)]
+  pipe = pipelineLVIS(args.work_dir, force = args.force)
+  memBudget = None if args.mem_budget is None else int(args.mem_budget * 1024**2)
+  declare_pipeline(pipe, lvis_files, args.shape, res = args.res, sigThresh = args.sig_thresh, dtype = args.dtype, memBudget = memBudget,
+                   window_size = args.window_size, max_distance = args.max_distance, tile_size = args.tile_size, nWorkers = args.workers,
+                   indexDir = args.index_dir, cog = args.cog)
+  outputs = pipe.run(targets = args.targets)
+  if args.prune:
+    pipe.prune()
+  if 'change' in outputs:
+    with open(outputs['change'][1]) as f:
+      print('Average Elevation Change: ', round(json.load(f)['mean'], 3), 'metres')
@@ -3,7 +3,6 @@ Class to Visualise LVIS data
 '''
 
 # Import libraries
-from pyproj import Proj, transform
 import matplotlib.pyplot as plt
 import numpy as np
 from osgeo import gdal, osr
@@ -17,6 +16,10 @@ from rasterio.mask import mask
 from shapely.geometry import mapping, Point
 import geopandas as gpd
 from processLVIS import processLVIS
+from gridLVIS import grid_footprints
+from projectLVIS import reproject, reproject_bounds
+from methodsDEM import write_cog
+from manageRAM import stage, count_items
 
 
 # Define class
@@ -25,20 +28,19 @@ class plotLVIS(processLVIS):
 
   ###########################################
 
-  def reproject_coords(self, outEPSG):
+  @stage('reproject_coords')
+  def reproject_coords(self, outEPSG, nThreads = 1):
     '''Reproject footprint coordinates'''
-    inProj = self.projection
-    outProj = Proj("epsg:" + str(outEPSG))
-    self.outProj = outProj
-    self.x, self.y = transform(inProj, self.outProj, self.lat, self.lon)
+    count_items(len(self.lon))
+    # the transformer is set up once per process, not per subset
+    self.outEPSG = outEPSG
+    self.x, self.y = reproject(self.lon, self.lat, 4326, outEPSG, nThreads = nThreads)
 
   ###########################################
 
   def reproject_bounds(self, outEPSG):
     '''Reproject the file bounds'''
-    inProj = Proj(self.projection)
-    outProj = Proj("epsg:" + str(outEPSG))
-    self.bounds[0,2], self.bounds[1,3] = transform(inProj, outProj, self.bounds[0,2], self.bounds[1,3])
+    self.bounds = reproject_bounds(self.bounds, 4326, outEPSG)
 
   ###########################################
       
@@ -54,35 +56,32 @@ class plotLVIS(processLVIS):
 
   ###########################################
   
-  def write_tiff(self, data, x, y, res, filename, epsg):
+  def write_tiff(self, data, x, y, res, filename, epsg, stat = 'mean', extraBands = False, cog = False):
       '''Write array to GeoTIFF using rasterio'''
-      # set bounds
-      minX = np.min(x)
-      maxX = np.max(x)
-      minY = np.min(y)
-      maxY = np.max(y)
-      # set image size
-      nX = int((maxX - minX) / res + 1)
-      nY = int((maxY - minY) / res + 1)
-      # pack in to array
-      imageArr = np.full((nY, nX), -999.0)
-      # iterate over each pixel
-      for i in range(nY):
-          for j in range(nX):
-              # calculate the raster pixel index in x and y
-              xInds = np.where((x >= (minX + j * res)) & (x < (minX + (j + 1) * res)))[0]
-              yInds = np.where((y >= (maxY - (i + 1) * res)) & (y < (maxY - i * res)))[0]
-              # find intersecting footprints
-              pixel_footprints = data[np.intersect1d(xInds, yInds)]
-              # calculate the mean of intersecting footprints
-              if len(pixel_footprints) > 0:
-                  pixel_mean = np.mean(pixel_footprints)
-                  imageArr[i, j] = pixel_mean
-      # set geolocation information (note GeoTIFFs count down from top edge in Y)
-      transform = from_origin(minX, maxY, res, res)
-      # write data to GeoTIFF using rasterio
-      with rio.open(filename, 'w', driver = 'GTiff', height = nY, width = nX, count = 1, dtype = imageArr.dtype, crs = f'EPSG:{epsg}', transform = transform, nodata = -999) as dst:
-            dst.write(imageArr, 1)
-      print("Success:", filename)
+      footprints_to_tiff(data, x, y, res, filename, epsg, stat = stat, extraBands = extraBands, cog = cog)
 
-  ###########################################
+###########################################
+
+@stage('write_tiff')
+def footprints_to_tiff(data, x, y, res, filename, epsg, stat = 'mean', extraBands = False, cog = False):
+  '''Function to grid footprint values and write to GeoTIFF using rasterio'''
+  # grid footprints once, with count and standard deviation bands if wanted
+  stats = [stat, 'count', 'std'] if extraBands else [stat]
+  images, bounds = grid_footprints(data, x, y, res, stats = stats)
+  minX, minY, maxX, maxY = bounds
+  nY, nX = images[stat].shape
+  count_items(nX * nY)
+  # set geolocation information (note GeoTIFFs count down from top edge in Y)
+  transform = from_origin(minX, maxY, res, res)
+  # tiled, compressed float32 with overviews if wanted
+  if cog:
+    write_cog([images[name] for name in stats], filename, transform, epsg, descriptions = stats)
+    return
+  # write data to GeoTIFF using rasterio
+  with rio.open(filename, 'w', driver = 'GTiff', height = nY, width = nX, count = len(stats), dtype = 'float64', crs = f'EPSG:{epsg}', transform = transform, nodata = -999) as dst:
+        for band, name in enumerate(stats):
+            dst.write(images[name].astype('float64'), band + 1)
+            dst.set_band_description(band + 1, name)
+  print("Success:", filename)
+
+###########################################
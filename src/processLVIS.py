@@ -4,10 +4,21 @@ Class to Process LVIS Data
 
 # Import libraries
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter1d
+from scipy.ndimage import gaussian_filter1d
 from tqdm import tqdm
+from multiprocessing import shared_memory
+import multiprocessing as mp
 import argparse
-from readLVIS import readLVIS
+from readLVIS import readLVIS, elevationAxis
+from manageRAM import stage, count_items
+
+
+# copies of a waveform row held while denoising
+WORK_COPIES = 3
+# working memory of each block of the batch engine, when no budget is given
+BLOCK_BYTES = 256 * 1024**2
+# shared arrays and block buffer of a worker process
+_WORKER = {}
 
 
 # Define class
@@ -16,16 +27,114 @@ class processLVIS(readLVIS):
 
   ###########################################
   
-  def estimate_ground(self, sigThresh = 5, statsLen = 10, minWidth = 3, sWidth = 0.5):
+  @stage('estimate_ground')
+  def estimate_ground(self, sigThresh = 5, statsLen = 10, minWidth = 3, sWidth = 0.5, memBudget = None, engine = 'batch', nWorkers = 1, triage = True):
     '''Return ground estimate from waveform'''
+    count_items(self.nWaves)
     # find noise statistics
-    self.find_stats(statsLen = statsLen)
+    self.find_stats(statsLen = statsLen, engine = engine)
     # set noise threshold
     threshold = self.set_threshold(sigThresh)
-    # remove background noise
-    self.denoise(threshold, minWidth = minWidth, sWidth = sWidth)
-    # find centre of gravity of remaining signal
-    self.centre_gravity()
+    # only waveforms with signal above the threshold go through the expensive stages
+    self.triage_waves(threshold, triage = triage)
+    if(nWorkers > 1):
+      # denoise blocks across processes, the denoised array is never gathered
+      self.parallel_ground(threshold, sWidth = sWidth, memBudget = memBudget, nWorkers = nWorkers)
+      self.denoised = None
+      return
+    if(memBudget is None):
+      # remove background noise
+      self.denoise(threshold, minWidth = minWidth, sWidth = sWidth, engine = engine)
+      # find centre of gravity of remaining signal
+      self.centre_gravity(engine = engine)
+      return
+    # otherwise denoise blocks of waveforms into one reused buffer, sized to the memory budget
+    blockSize = self.block_size(memBudget)
+    buffer = np.zeros((blockSize, self.nBins), dtype = self.denoised_dtype(memBudget))
+    self.zG = np.full((self.nWaves), -999.0, dtype = self.dtype)
+    for rows, nRows in tqdm(self.row_blocks(blockSize)):
+      self.denoise_block(rows, threshold, buffer[0: nRows], minWidth = minWidth, sWidth = sWidth, engine = engine)
+      self.zG[rows] = self.centre_gravity_block(rows, buffer[0: nRows], engine = engine)
+    # the full denoised array is never held in this mode
+    self.denoised = None
+
+  ###########################################
+
+  def triage_waves(self, threshold, triage = True):
+    '''Flag waveforms that can never give a ground estimate, eg. empty or cloud-contaminated returns'''
+    if(not triage):
+      self.survivors = np.arange(self.nWaves)
+      self.rejected = {}
+      return(self.survivors)
+    # the peak of each waveform above the noise, a cheap pass with no per-bin temporaries
+    signal = np.empty(self.nWaves, dtype = self.dtype)
+    blockSize = self.block_size(BLOCK_BYTES)
+    for start in range(0, self.nWaves, blockSize):
+      stop = min(start + blockSize, self.nWaves)
+      np.subtract(np.max(self.waves[start: stop], axis = 1), self.meanNoise[start: stop], out = signal[start: stop])
+    # no bins would survive thresholding, so denoising gives an empty waveform
+    badNoise = ~np.isfinite(self.meanNoise) | ~np.isfinite(threshold)
+    noSignal = ~badNoise & ~((signal >= threshold) & (signal > 0.0))
+    self.survivors = np.where(~(badNoise | noSignal))[0]
+    self.rejected = {'badNoise': int(np.sum(badNoise)), 'noSignal': int(np.sum(noSignal))}
+    print(f"Pre-screen kept {len(self.survivors)} of {self.nWaves} waveforms, rejected:", self.rejected)
+    return(self.survivors)
+
+  ###########################################
+
+  def denoised_dtype(self, memBudget = None):
+    '''Type of denoised waveforms: whole numbers by default, as the original code, or the working precision with a budget or float32'''
+    if((memBudget is None) and (self.dtype == np.float64)):
+      return(np.dtype(np.int64))
+    return(self.dtype)
+
+  ###########################################
+
+  def row_blocks(self, blockSize):
+    '''List blocks of surviving rows, as slices where the rows are contiguous'''
+    blocks = []
+    for start in range(0, len(self.survivors), blockSize):
+      rows = self.survivors[start: start + blockSize]
+      if(rows[-1] - rows[0] == len(rows) - 1):
+        rows = slice(int(rows[0]), int(rows[-1]) + 1)   # a view rather than a copy
+      blocks.append((rows, min(blockSize, len(self.survivors) - start)))
+    return(blocks)
+
+  ###########################################
+
+  def parallel_ground(self, threshold, sWidth = 0.5, memBudget = None, nWorkers = 4):
+    '''Find ground of row blocks in worker processes, sharing the waveforms rather than pickling them'''
+    self.zG = np.full((self.nWaves), -999.0, dtype = self.dtype)
+    # copy the inputs into shared memory once
+    shared = {}
+    arrays = {'waves': self.waves, 'lZ0': self.lZ0, 'lZN': self.lZN, 'meanNoise': self.meanNoise, 'threshold': threshold, 'rows': self.survivors}
+    try:
+      for name, data in arrays.items():
+        shared[name] = shared_memory.SharedMemory(create = True, size = max(1, data.nbytes))
+        np.ndarray(data.shape, dtype = data.dtype, buffer = shared[name].buf)[:] = data
+      specs = {name: (shared[name].name, data.shape, data.dtype.str) for name, data in arrays.items()}
+      # split the budget between workers, each reuses one block buffer
+      blockSize = self.block_size(BLOCK_BYTES if memBudget is None else memBudget // nWorkers)
+      blocks = [(start, min(start + blockSize, len(self.survivors))) for start in range(0, len(self.survivors), blockSize)]
+      sigma = sWidth / self.range_res()
+      with mp.get_context().Pool(nWorkers, initializer = attach_shared, initargs = (specs, blockSize, sigma, self.dtype.str, self.denoised_dtype(memBudget).str)) as pool:
+        # imap returns blocks in order
+        zG = list(tqdm(pool.imap(ground_rows, blocks), total = len(blocks)))
+    finally:
+      for shm in shared.values():
+        shm.close()
+        shm.unlink()
+    if(len(zG) > 0):
+      self.zG[self.survivors] = np.concatenate(zG)
+    return(self.zG)
+
+  ###########################################
+
+  def block_size(self, memBudget):
+    '''Number of waveforms that can be denoised at once within a memory budget in bytes'''
+    # the denoised buffer plus temporaries from subtraction and smoothing
+    rowBytes = WORK_COPIES * self.nBins * self.dtype.itemsize
+    return(int(max(1, min(self.nWaves, memBudget // rowBytes))))
 
   ###########################################
 
@@ -36,53 +145,189 @@ class processLVIS(readLVIS):
 
   ###########################################
 
-  def centre_gravity(self):
+  def range_res(self):
+    '''Return range resolution, from the first waveform'''
+    return((self.lZ0[0] - self.lZN[0]) / self.nBins)
+
+  ###########################################
+
+  def centre_gravity(self, engine = 'batch'):
     '''Find centre of gravity of denoised waveforms to return array of ground elevation estimates'''
+    self.zG = np.full((self.nWaves), -999.0, dtype = self.dtype)
+    for rows, nRows in self.row_blocks(self.block_size(BLOCK_BYTES)):
+      self.zG[rows] = self.centre_gravity_block(rows, self.denoised[rows], engine = engine)
+    return(self.zG)
+
+  ###########################################
+
+  def centre_gravity_block(self, rows, denoised, engine = 'batch'):
+    '''Find centre of gravity of a block of denoised waveforms'''
+    if(engine == 'batch'):
+      return(centre_gravity_waves(denoised, self.lZ0[rows], self.lZN[rows], self.dtype))
     # allocate space and set no data
-    self.zG = np.full((self.nWaves), -999.0)
+    zG = np.full((denoised.shape[0]), -999.0, dtype = self.dtype)
     # loop over waveforms
-    for i in range(0, self.nWaves):
-      if(np.sum(self.denoised[i]) > 0.0):                                # avoid empty waveforms (clouds etc)
-        self.zG[i] = np.average(self.z[i], weights = self.denoised[i])   # calculte centre of gravity
-    return(self.zG)
+    for j, i in enumerate(np.arange(self.nWaves)[rows]):
+      if(np.sum(denoised[j]) > 0.0):                                 # avoid empty waveforms (clouds etc)
+        zG[j] = self.z.weighted_mean(denoised[j], rows = i)          # calculte centre of gravity
+    return(zG)
 
   ###########################################
 
-  def find_stats(self, statsLen = 10):
+  def find_stats(self, statsLen = 10, engine = 'batch'):
     '''Calculate standard deviation and mean of noise'''
     # make empty arrays
-    self.meanNoise = np.empty(self.nWaves)
-    self.stdevNoise = np.empty(self.nWaves)
+    self.meanNoise = np.empty(self.nWaves, dtype = self.dtype)
+    self.stdevNoise = np.empty(self.nWaves, dtype = self.dtype)
     # determine number of bins to calculate stats over
-    res = (self.z[0,0] - self.z[0,-1]) / self.nBins    # range resolution
+    res = self.range_res()                             # range resolution
     noiseBins = int(statsLen / res)                    # number of bins within "statsLen"
+    if(engine == 'batch'):
+      # whole blocks of waveforms at once
+      blockSize = self.block_size(BLOCK_BYTES)
+      for start in range(0, self.nWaves, blockSize):
+        stop = min(start + blockSize, self.nWaves)
+        self.meanNoise[start: stop], self.stdevNoise[start: stop] = noise_stats(self.waves[start: stop], noiseBins, self.dtype)
+      return
     # loop over waveforms
     for i in range(0, self.nWaves):
-      self.meanNoise[i] = np.mean(self.waves[i, 0: noiseBins])
-      self.stdevNoise[i] = np.std(self.waves[i, 0: noiseBins])
+      self.meanNoise[i] = np.mean(self.waves[i, 0: noiseBins], dtype = self.dtype)
+      self.stdevNoise[i] = np.std(self.waves[i, 0: noiseBins], dtype = self.dtype)
 
   ###########################################
 
-  def denoise(self, threshold, sWidth = 0.5, minWidth = 3):
+  def denoise(self, threshold, sWidth = 0.5, minWidth = 3, engine = 'batch'):
     '''Remove noise in waveform data'''
-    res = (self.z[0,0] - self.z[0,-1]) / self.nBins    # range resolution
-    # make array for output
-    self.denoised = np.full((self.nWaves, self.nBins), 0)
+    # make array for output, rejected waveforms stay empty
+    self.denoised = np.zeros((self.nWaves, self.nBins), dtype = self.denoised_dtype())
+    for rows, nRows in tqdm(self.row_blocks(self.block_size(BLOCK_BYTES))):
+      # contiguous blocks are views of the output, others are copied back
+      out = self.denoised[rows]
+      self.denoise_block(rows, threshold, out, sWidth = sWidth, minWidth = minWidth, engine = engine)
+      if(isinstance(rows, np.ndarray)):
+        self.denoised[rows] = out
+
+  ###########################################
+
+  def denoise_block(self, rows, threshold, out, sWidth = 0.5, minWidth = 3, engine = 'batch'):
+    '''Remove noise in a block of waveforms, writing in place to a preallocated array'''
+    res = self.range_res()                             # range resolution
+    if(engine == 'batch'):
+      denoise_waves(self.waves[rows], self.meanNoise[rows], threshold[rows], sWidth / res, out)
+      return
     # loop over waves
-    for i in tqdm(range(0, self.nWaves)):
-      # print("Denoising wave", i+1, "of", self.nWaves)
-      # subtract mean background noise
-      self.denoised[i] = self.waves[i] - self.meanNoise[i]
+    for j, i in enumerate(np.arange(self.nWaves)[rows]):
+      # subtract mean background noise, truncated if the output holds whole numbers
+      np.subtract(self.waves[i], self.meanNoise[i], out = out[j], casting = 'unsafe')
       # set all values less than threshold to zero
-      self.denoised[i, self.denoised[i] < threshold[i]] = 0.0
+      out[j, out[j] < threshold[i]] = 0.0
       # minimum acceptable width
-      binList = np.where(self.denoised[i] > 0.0)[0]
-      for j in range(0, binList.shape[0]):                                        # loop over waveforms
-        if((j > 0) & (j < (binList.shape[0] -1))):                                # if middle of array
-          if((binList[j] != binList[j-1] +1) | (binList[j] != binList[j+1] -1)):  # if bins are consecutive
-            self.denoised[i, binList[j]] = 0.0                                    # if not, set to zero
+      binList = np.where(out[j] > 0.0)[0]
+      for k in range(0, binList.shape[0]):                                        # loop over waveforms
+        if((k > 0) & (k < (binList.shape[0] -1))):                                # if middle of array
+          if((binList[k] != binList[k-1] +1) | (binList[k] != binList[k+1] -1)):  # if bins are consecutive
+            out[j, binList[k]] = 0.0                                              # if not, set to zero
       # smooth
-      self.denoised[i] = gaussian_filter1d(self.denoised[i], sWidth / res)
+      out[j] = gaussian_filter1d(out[j], sWidth / res)
+
+###########################################
+
+def noise_stats(waves, noiseBins, dtype):
+  '''Function to return mean and standard deviation of the noise bins of a block of waveforms'''
+  noise = waves[:, 0: noiseBins]
+  return(np.mean(noise, axis = 1, dtype = dtype), np.std(noise, axis = 1, dtype = dtype))
+
+###########################################
+
+def denoise_waves(waves, meanNoise, threshold, sigma, out):
+  '''Function to remove noise in a block of waveforms with whole-array operations'''
+  # subtract mean background noise, truncated if the output holds whole numbers
+  np.subtract(waves, meanNoise[:, np.newaxis], out = out, casting = 'unsafe')
+  # set all values less than threshold to zero
+  out[out < threshold[:, np.newaxis]] = 0.0
+  # minimum acceptable width: keep signal bins with signal either side...
+  signal = out > 0.0
+  keep = np.zeros_like(signal)
+  keep[:, 1: -1] = signal[:, 0: -2] & signal[:, 2:]
+  # ...and the first and last signal bin of each waveform, as the loop did
+  rows = np.arange(out.shape[0])
+  keep[rows, np.argmax(signal, axis = 1)] = True
+  keep[rows, out.shape[1] - 1 - np.argmax(signal[:, ::-1], axis = 1)] = True
+  out[signal & ~keep] = 0.0
+  # smooth along the bins of every waveform
+  out[:] = gaussian_filter1d(out, sigma, axis = 1)
+  return(out)
+
+###########################################
+
+def centre_gravity_waves(denoised, lZ0, lZN, dtype):
+  '''Function to return centre of gravity elevation of a block of denoised waveforms'''
+  # allocate space and set no data
+  zG = np.full(denoised.shape[0], -999.0, dtype = dtype)
+  # avoid empty waveforms (clouds etc)
+  useInd = np.where(np.sum(denoised, axis = 1) > 0.0)[0]
+  z = elevationAxis(lZ0, lZN, denoised.shape[1], dtype = dtype)
+  zG[useInd] = z.weighted_mean(denoised[useInd], rows = useInd)
+  return(zG)
+
+###########################################
+
+def attach_shared(specs, blockSize, sigma, dtype, denoisedType):
+  '''Function to attach a worker process to the shared waveform arrays'''
+  _WORKER['shm'] = []
+  for name, (shmName, shape, arrayType) in specs.items():
+    try:
+      shm = shared_memory.SharedMemory(name = shmName, track = False)   # the parent owns the block
+    except TypeError:
+      shm = shared_memory.SharedMemory(name = shmName)
+    _WORKER['shm'].append(shm)
+    _WORKER[name] = np.ndarray(shape, dtype = np.dtype(arrayType), buffer = shm.buf)
+  _WORKER['dtype'] = np.dtype(dtype)
+  _WORKER['sigma'] = sigma
+  _WORKER['buffer'] = np.empty((blockSize, specs['waves'][1][1]), dtype = np.dtype(denoisedType))
+
+###########################################
+
+def ground_rows(block):
+  '''Function to return ground estimates of one block of surviving rows, in a worker process'''
+  start, stop = block
+  rows = _WORKER['rows'][start: stop]
+  out = _WORKER['buffer'][0: stop - start]
+  denoise_waves(_WORKER['waves'][rows], _WORKER['meanNoise'][rows], _WORKER['threshold'][rows], _WORKER['sigma'], out)
+  return(centre_gravity_waves(out, _WORKER['lZ0'][rows], _WORKER['lZN'][rows], _WORKER['dtype']))
+
+###########################################
+
+def compare_ground(zG, zRef, noData = -999.0):
+  '''Function to measure how far ground estimates are from a reference, eg. float32 against float64'''
+  # compare only footprints with a ground estimate in both
+  both = (zG != noData) & (zRef != noData)
+  diff = np.abs(np.asarray(zG[both], dtype = np.float64) - np.asarray(zRef[both], dtype = np.float64))
+  return({'maxError': float(np.max(diff)) if diff.size > 0 else 0.0,
+          'rmse': float(np.sqrt(np.mean(diff**2))) if diff.size > 0 else 0.0,
+          'noDataMismatch': int(np.sum((zG == noData) != (zRef == noData)))})
 
 ###########################################
 
+if __name__ == '__main__':
+
+  # Regression check of the batch engine against the per-waveform loops
+  parser = argparse.ArgumentParser(description = 'Check batch ground estimates match the per-waveform loops')
+  parser.add_argument('lvis_file', type = str, help = 'Path to the LVIS file')
+  parser.add_argument('--bbox', type = float, nargs = 4, metavar = ('minX', 'minY', 'maxX', 'maxY'), help = 'Subset to check, defaults to a 0.1 degree box in the file corner')
+  parser.add_argument('--tolerance', type = float, default = 1e-6, help = 'Largest accepted difference in metres')
+  args = parser.parse_args()
+  if args.bbox is None:
+    bounds = processLVIS(args.lvis_file, onlyBounds = True).bounds
+    args.bbox = [bounds[0], bounds[1], bounds[0] + 0.1, bounds[1] + 0.1]
+  LVIS = processLVIS(args.lvis_file, minX = args.bbox[0], minY = args.bbox[1], maxX = args.bbox[2], maxY = args.bbox[3], setElev = True)
+  if LVIS.nWaves == 0:
+    raise SystemExit('No waveforms in the subset to check')
+  LVIS.estimate_ground(engine = 'loop', triage = False)
+  zRef = LVIS.zG.copy()
+  LVIS.estimate_ground(engine = 'batch')
+  error = compare_ground(LVIS.zG, zRef)
+  print(error)
+  if((error['maxError'] > args.tolerance) | (error['noDataMismatch'] > 0)):
+    raise SystemExit('Batch ground estimates differ from the per-waveform loops')
+  print('Batch ground estimates match the per-waveform loops')
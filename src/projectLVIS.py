@@ -0,0 +1,104 @@
+'''
+Methods to Reproject LVIS Coordinates
+'''
+
+# Import libraries
+import numpy as np
+from pyproj import Transformer
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+
+
+# footprints reprojected per call to PROJ
+CHUNK_SIZE = 1000000
+
+# transformers already set up by each thread, per (source, destination), freed with the thread
+_LOCAL = threading.local()
+
+# thread pools kept for the life of the process, per number of threads, so their threads keep their transformers
+_POOLS = {}
+_LOCK = threading.Lock()
+
+
+###########################################
+
+def get_transformer(inEPSG, outEPSG):
+  '''Function to return a cached transformer between two EPSG codes, in x/y (lon/lat) order'''
+  # transformers are not shared between threads, so each thread sets up its own once
+  if not hasattr(_LOCAL, 'transformers'):
+    _LOCAL.transformers = {}
+  key = (int(inEPSG), int(outEPSG))
+  transformer = _LOCAL.transformers.get(key)
+  if(transformer is None):
+    transformer = Transformer.from_crs(f'EPSG:{key[0]}', f'EPSG:{key[1]}', always_xy = True)
+    _LOCAL.transformers[key] = transformer
+  return(transformer)
+
+###########################################
+
+def get_pool(nThreads):
+  '''Function to return the long-lived pool of nThreads threads of this process'''
+  with _LOCK:
+    pool, pid = _POOLS.get(nThreads, (None, None))
+    # threads are not copied into a forked process, so a pool from the parent is replaced
+    if(pid != os.getpid()):
+      pool = ThreadPoolExecutor(max_workers = nThreads)
+      _POOLS[nThreads] = (pool, os.getpid())
+  return(pool)
+
+###########################################
+
+def reproject(x, y, inEPSG, outEPSG, chunkSize = CHUNK_SIZE, nThreads = 1):
+  '''Function to reproject coordinates in chunks, optionally on a pool of threads'''
+  # output arrays are transformed in place, chunk by chunk
+  outX = np.array(x, dtype = np.float64, copy = True).reshape(-1)
+  outY = np.array(y, dtype = np.float64, copy = True).reshape(-1)
+  if(int(inEPSG) == int(outEPSG)):
+    return(outX, outY)
+  chunks = [slice(start, start + chunkSize) for start in range(0, len(outX), chunkSize)]
+  def transform_chunk(chunk):
+    get_transformer(inEPSG, outEPSG).transform(outX[chunk], outY[chunk], inplace = True)
+  # PROJ releases the GIL, so threads transform chunks at the same time
+  if((nThreads > 1) & (len(chunks) > 1)):
+    list(get_pool(nThreads).map(transform_chunk, chunks))
+  else:
+    for chunk in chunks:
+      transform_chunk(chunk)
+  return(outX, outY)
+
+###########################################
+
+def reproject_bounds(bounds, inEPSG, outEPSG, densify = 21):
+  '''Function to reproject [minX, minY, maxX, maxY], following the box edges'''
+  if(int(inEPSG) == int(outEPSG)):
+    return(list(bounds))
+  return(list(get_transformer(inEPSG, outEPSG).transform_bounds(*bounds, densify_pts = densify)))
+
+###########################################
+
+def inside_box(lon, lat, minX, minY, maxX, maxY, epsg = 4326, nThreads = 1):
+  '''Function to flag footprints inside a box given in any coordinate system'''
+  x, y = (lon, lat) if int(epsg) == 4326 else reproject(lon, lat, 4326, epsg, nThreads = nThreads)
+  # same test as readLVIS
+  return((x >= minX) & (x < maxX) & (y >= minY) & (y < maxY))
+
+###########################################
+
+def lonlat_boxes(minX, minY, maxX, maxY, epsg, wrap360 = False, margin = 1e-6):
+  '''Function to return the longitude/latitude boxes covering a projected box'''
+  lon0, lat0, lon1, lat1 = reproject_bounds([minX, minY, maxX, maxY], epsg, 4326)
+  lat0, lat1 = lat0 - margin, lat1 + margin
+  # a box around a pole covers every longitude
+  if((lon0 <= -180.0) & (lon1 >= 180.0)):
+    return([(-1000.0, lat0, 1000.0, lat1)])
+  # LVIS files may give longitude from 0 to 360 degrees
+  if(wrap360):
+    lon0, lon1 = lon0 % 360.0, lon1 % 360.0
+  lo, hi = (0.0, 360.0) if wrap360 else (-180.0, 180.0)
+  if(lon0 <= lon1):
+    return([(lon0 - margin, lat0, lon1 + margin, lat1)])
+  # the box crosses the edge of the longitude range, so is split in two
+  return([(lon0 - margin, lat0, hi + margin, lat1), (lo - margin, lat0, lon1 + margin, lat1)])
+
+###########################################
@@ -5,12 +5,20 @@ Class to Read LVIS File
 # Import libraries
 import numpy as np
 import h5py as h5
-from pyproj import Proj, transform
+from pyproj import Proj
 from pprint import pprint
 import pandas as pd
 import time
 import psutil
 import os
+from indexLVIS import indexLVIS
+from cacheLVIS import cacheLVIS
+from projectLVIS import inside_box
+from manageRAM import stage, count_items
+
+
+# rows bridged between wanted rows of unchunked datasets
+GAP_ROWS = 256
 
 
 # Define class
@@ -19,69 +27,137 @@ class readLVIS():
 
   ###########################################
 
-  def __init__(self, filename, setElev = False, minX = -100000000, maxX = 100000000, minY = -1000000000, maxY = 100000000, onlyBounds = False):
+  def __init__(self, filename, setElev = False, minX = -100000000, maxX = 100000000, minY = -1000000000, maxY = 100000000, onlyBounds = False, subsetRead = True, useIndex = False, indexDir = None, dtype = np.float64, cacheDir = None, cacheBytes = 10 * 1024**3, rows = None, bboxEPSG = 4326):
     '''Class initialiser: Read spatial subset of LVIS data'''
+    self.dtype = np.dtype(dtype)    # working precision of elevations and processing, float32 to save RAM
+    self.subsetRead = subsetRead    # read only the rows in the subset, rather than whole datasets
+    self.useIndex = useIndex        # find the subset from the spatial index sidecar
+    self.indexDir = indexDir        # where sidecars are kept, if not next to the file
+    self.cacheDir = cacheDir        # keep read subsets as memory-mapped arrays, for repeated runs
+    self.cacheBytes = cacheBytes    # size limit of the cache
+    self.rows = rows                # read these sorted rows, rather than a spatial subset
+    self.bboxEPSG = bboxEPSG        # coordinate system of the bounding box, eg. 3031 to subset in metres
     self.read_LVIS(filename, minX, minY, maxX, maxY, onlyBounds)
-    if(setElev):            # to save time, only read elevation if wanted
+    if(setElev and (getattr(self, 'nWaves', 0) > 0)):   # to save time, only read elevation if wanted, and there are waves
       self.set_elevations()
 
   ###########################################
 
+  @stage('read_LVIS')
   def read_LVIS(self, filename, minX, minY, maxX, maxY, onlyBounds):
     '''Read LVIS file'''
-    f = h5.File(filename, 'r')
     # set projection
     self.projection = Proj("epsg:4326")
+    # use the cached subset if this file and region have been read before
+    useCache = (self.cacheDir is not None) & (self.rows is None) & (not onlyBounds)
+    if(useCache):
+      cache = cacheLVIS(self.cacheDir, self.cacheBytes)
+      key = cache.key(filename, minX, minY, maxX, maxY, self.dtype, self.bboxEPSG)
+      arrays = cache.load(key)
+      if(arrays is not None):
+        self.set_arrays(arrays)
+        count_items(self.nWaves)
+        return
+    f = h5.File(filename, 'r')
     # determine how many bins (vertical points)
     self.nBins = f['RXWAVE'].shape[1]
-    # read coordinates for subsetting
-    lon0 = np.array(f['LON0'])                      # longitude of waveform top
-    lat0 = np.array(f['LAT0'])                      # lattitude of waveform top
-    lonN = np.array(f['LON' + str(self.nBins -1)])  # longitude of waveform bottom
-    latN = np.array(f['LAT' + str(self.nBins -1)])  # lattitude of waveform bottom
-    # find a single coordinate per footprint
-    tempLon = (lon0 + lonN) / 2.0
-    tempLat = (lat0 + latN) / 2.0
-    # write out bounds and leave if needed
-    if(onlyBounds):
-      self.lon = tempLon
-      self.lat = tempLat
-      self.bounds = self.dump_bounds()
-      return
-    # determine which are in region of interest
-    useInd = np.where((tempLon >= minX) & (tempLon < maxX) & (tempLat >= minY) & (tempLat < maxY))
-    if(len(useInd) > 0):
-      useInd = useInd[0]
+    # find footprints in region of interest
+    if(self.rows is not None):
+      # only the coordinates of the given rows are read, an empty selection gives an empty subset
+      useInd = np.asarray(self.rows, dtype = np.int64)
+      tempLon = (self.read_rows(f['LON0'], useInd) + self.read_rows(f['LON' + str(self.nBins -1)], useInd)) / 2.0
+      tempLat = (self.read_rows(f['LAT0'], useInd) + self.read_rows(f['LAT' + str(self.nBins -1)], useInd)) / 2.0
+    elif(self.useIndex):
+      index = indexLVIS(filename, indexDir = self.indexDir)
+      # write out bounds and leave if needed
+      if(onlyBounds):
+        self.lon, self.lat = index.dump_coords()
+        self.bounds = index.bounds
+        f.close()
+        return
+      # only cells overlapping the region are read from the sidecar
+      if(self.bboxEPSG == 4326):
+        useInd, tempLon, tempLat = index.query(minX, minY, maxX, maxY)
+      else:
+        useInd, tempLon, tempLat = index.query_projected(minX, minY, maxX, maxY, self.bboxEPSG)
+    else:
+      # read coordinates for subsetting
+      lon0 = np.array(f['LON0'])                      # longitude of waveform top
+      lat0 = np.array(f['LAT0'])                      # lattitude of waveform top
+      lonN = np.array(f['LON' + str(self.nBins -1)])  # longitude of waveform bottom
+      latN = np.array(f['LAT' + str(self.nBins -1)])  # lattitude of waveform bottom
+      # find a single coordinate per footprint
+      tempLon = (lon0 + lonN) / 2.0
+      tempLat = (lat0 + latN) / 2.0
+      # write out bounds and leave if needed
+      if(onlyBounds):
+        self.lon = tempLon
+        self.lat = tempLat
+        self.bounds = self.dump_bounds()
+        f.close()
+        return
+      # determine which are in region of interest
+      useInd = np.where(inside_box(tempLon, tempLat, minX, minY, maxX, maxY, epsg = self.bboxEPSG))[0]
+      tempLon = tempLon[useInd]
+      tempLat = tempLat[useInd]
     # check data is in region of interest
     if(len(useInd) == 0):
       print("No data contained in that region")
       self.nWaves = 0
+      f.close()
       return
     # save the subset of all data
     self.nWaves = len(useInd)
     print("Number of waves in subset:", self.nWaves)
-    self.lon = tempLon[useInd]
-    self.lat = tempLat[useInd]
+    self.lon = tempLon
+    self.lat = tempLat
     # load sliced arrays, to save RAM
-    self.lfid = np.array(f['LFID'])[useInd]          # LVIS flight ID number
-    self.lShot = np.array(f['SHOTNUMBER'])[useInd]   # the LVIS shot number, a label
-    self.waves = np.array(f['RXWAVE'])[useInd]       # the recieved waveforms, the data
+    self.lfid = self.read_rows(f['LFID'], useInd)          # LVIS flight ID number
+    self.lShot = self.read_rows(f['SHOTNUMBER'], useInd)   # the LVIS shot number, a label
+    self.waves = self.read_rows(f['RXWAVE'], useInd)       # the recieved waveforms, the data
     self.nBins = self.waves.shape[1]
     # these variables will be converted to easier variables
-    self.lZN = np.array(f['Z' + str(self.nBins -1)])[useInd]       # The elevation of the waveform bottom
-    self.lZ0 = np.array(f['Z0'])[useInd]                           # The elevation of the waveform top
+    self.lZN = self.read_rows(f['Z' + str(self.nBins -1)], useInd).astype(self.dtype, copy = False)   # The elevation of the waveform bottom
+    self.lZ0 = self.read_rows(f['Z0'], useInd).astype(self.dtype, copy = False)                         # The elevation of the waveform top
     # close file, return to initialiser
     f.close()
+    count_items(self.nWaves)
+    if(useCache):
+      cache.store(key, self.dump_arrays())
     return
 
   ###########################################
 
+  def dump_arrays(self):
+    '''Return the arrays of a subset, to cache'''
+    return({'lon': self.lon, 'lat': self.lat, 'lfid': self.lfid, 'lShot': self.lShot, 'waves': self.waves, 'lZ0': self.lZ0, 'lZN': self.lZN})
+
+  ###########################################
+
+  def set_arrays(self, arrays):
+    '''Set the arrays of a subset from the cache, as zero-copy views'''
+    for name, data in arrays.items():
+      setattr(self, name, data)
+    self.nWaves = len(self.lon)
+    self.nBins = self.waves.shape[1]
+    print("Number of waves in subset:", self.nWaves)
+
+  ###########################################
+
+  def read_rows(self, dataset, useInd):
+    '''Read the subset rows of a HDF5 dataset'''
+    if(self.subsetRead):
+      return(read_rows(dataset, useInd))
+    # otherwise read the whole dataset and slice in RAM
+    return(np.array(dataset)[useInd])
+
+  ###########################################
+
+  @stage('set_elevations')
   def set_elevations(self):
-    '''Creates an array of elevations per waveform'''
-    self.z = np.empty((self.nWaves, self.nBins))
-    # loop over waves, return array of elevations (floats)
-    for i in range(0, self.nWaves): 
-      self.z[i] = np.linspace(self.lZ0[i], self.lZN[i],  self.nBins)
+    '''Creates the elevations per waveform, computed from lZ0 and lZN when asked for'''
+    count_items(self.nWaves)
+    self.z = elevationAxis(self.lZ0, self.lZN, self.nBins, dtype = self.dtype)
 
   ###########################################
 
@@ -102,3 +178,103 @@ class readLVIS():
      return[np.min(self.lon), np.min(self.lat), np.max(self.lon), np.max(self.lat)]  # this returns a list rather than a tuple
 
   ###########################################
+
+###########################################
+
+class elevationAxis():
+  '''Class to give waveform bin elevations without storing them'''
+
+  ###########################################
+
+  def __init__(self, lZ0, lZN, nBins, dtype = np.float64):
+    '''Class initialiser: Keep the top and bottom elevation of each waveform'''
+    self.lZ0 = lZ0
+    self.lZN = lZN
+    self.nBins = nBins
+    self.dtype = np.dtype(dtype)
+    self.shape = (len(lZ0), nBins)
+
+  ###########################################
+
+  def __len__(self):
+    return(self.shape[0])
+
+  ###########################################
+
+  def __getitem__(self, key):
+    '''Return elevations of a row, slice or (rows, bins) selection, like the old z array'''
+    rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+    bins = np.arange(self.nBins)[cols]
+    z0 = np.asarray(self.lZ0[rows], dtype = self.dtype)
+    zN = np.asarray(self.lZN[rows], dtype = self.dtype)
+    # broadcast waveforms down the rows and bins along the columns
+    if(np.ndim(bins) > 0):
+      z0 = z0[..., np.newaxis]
+      zN = zN[..., np.newaxis]
+    z = bins.astype(self.dtype) * ((zN - z0) / self.dtype.type(self.nBins - 1)) + z0
+    # the bottom bin is exactly lZN, as with np.linspace
+    return(np.where(bins == self.nBins - 1, zN, z))
+
+  ###########################################
+
+  def __array__(self, dtype = None):
+    return(self.materialise() if dtype is None else self.materialise().astype(dtype))
+
+  ###########################################
+
+  def materialise(self):
+    '''Return the full nWaves x nBins array of elevations in one operation'''
+    return(self[:])
+
+  ###########################################
+
+  def weighted_mean(self, weights, rows = slice(None)):
+    '''Return the weighted mean elevation of one or more waveforms, without expanding z'''
+    z0 = np.asarray(self.lZ0[rows], dtype = self.dtype)
+    zN = np.asarray(self.lZN[rows], dtype = self.dtype)
+    # elevation is linear in bin number, so only the mean bin number is needed
+    meanBin = np.dot(weights, np.arange(self.nBins, dtype = self.dtype)) / np.sum(weights, axis = -1, dtype = self.dtype)
+    return(z0 + meanBin * ((zN - z0) / self.dtype.type(self.nBins - 1)))
+
+###########################################
+
+def coalesce_rows(useInd, maxGap = 0, maxRows = None):
+  '''Function to group sorted row indices into contiguous [start, stop) blocks'''
+  if(len(useInd) == 0):
+    return(np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+  # split wherever the gap to the next wanted row is larger than allowed
+  breaks = np.where(np.diff(useInd) > (maxGap + 1))[0]
+  starts = np.concatenate(([useInd[0]], useInd[breaks + 1]))
+  stops = np.concatenate((useInd[breaks] + 1, [useInd[-1] + 1]))
+  if(maxRows is None):
+    return(starts, stops)
+  # cap the block length so bridged gaps never pull in a large slab
+  blocks = [(b, min(b + maxRows, stop)) for start, stop in zip(starts, stops) for b in range(start, stop, maxRows)]
+  return(np.array([b[0] for b in blocks]), np.array([b[1] for b in blocks]))
+
+###########################################
+
+def read_rows(dataset, useInd, maxGap = None, maxRows = None):
+  '''Function to read selected rows of a HDF5 dataset as hyperslabs'''
+  # bridge gaps within one chunk, so each chunk is only decompressed once
+  chunkRows = dataset.chunks[0] if dataset.chunks is not None else GAP_ROWS
+  if(maxGap is None):
+    maxGap = chunkRows
+  if(maxRows is None):
+    maxRows = 4 * max(chunkRows, GAP_ROWS)
+  # allocate output of the subset size only
+  out = np.empty((len(useInd),) + dataset.shape[1:], dtype = dataset.dtype)
+  starts, stops = coalesce_rows(useInd, maxGap, maxRows)
+  pos = 0
+  for start, stop in zip(starts, stops):
+    nUse = np.searchsorted(useInd, stop) - pos
+    if(nUse == stop - start):
+      # contiguous block, read straight into the output
+      dataset.read_direct(out, np.s_[start:stop], np.s_[pos:pos + nUse])
+    else:
+      # bridged block, read the slab and keep the wanted rows
+      out[pos:pos + nUse] = dataset[start:stop][useInd[pos:pos + nUse] - start]
+    pos += nUse
+  return(out)
+
+###########################################
@@ -0,0 +1,295 @@
+'''
+Class to Schedule LVIS Tiles Across Processes and Hosts
+'''
+
+# Import libraries
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import socket
+import psutil
+import fcntl
+import json
+import time
+import os
+from plotLVIS import plotLVIS
+from tileLVIS import plan_tiles
+
+
+# files kept in the shared work directory
+TASK_FILE = 'tasks.json'
+MANIFEST_FILE = 'manifest.jsonl'
+CLAIM_DIR = 'claims'
+
+# settings of the tasks of a worker process
+_WORKER = {}
+
+
+###########################################
+
+class fileLock():
+  '''Class to hold an exclusive lock on a file in the shared work directory, across processes and hosts'''
+
+  ###########################################
+
+  def __init__(self, filename):
+    '''Class initialiser: Name the lock file'''
+    self.filename = filename
+
+  ###########################################
+
+  def __enter__(self):
+    # POSIX record locks, which NFS passes between hosts
+    self.f = open(self.filename, 'a')
+    fcntl.lockf(self.f, fcntl.LOCK_EX)
+    return(self)
+
+  ###########################################
+
+  def __exit__(self, *args):
+    fcntl.lockf(self.f, fcntl.LOCK_UN)
+    self.f.close()
+
+###########################################
+
+class schedulerLVIS():
+  '''Class to run every (file, tile) task of a campaign on a pool of processes, resuming from a manifest of finished tasks'''
+
+  ###########################################
+
+  def __init__(self, workDir, outputDir, year, nWorkers = 1, res = 30, dtype = 'float64', memBudget = None, tileBudget = 2048 * 1024**2,
+               indexDir = None, cog = False, claimTimeout = 7200):
+    '''Class initialiser: Set the shared work directory and the settings of every task'''
+    self.workDir = workDir            # shared by all hosts, eg. on NFS
+    self.outputDir = outputDir        # where DEM subsets are written
+    self.year = year
+    self.nWorkers = nWorkers          # processes on this host
+    self.claimTimeout = claimTimeout  # seconds after which a task claimed by another host is taken as abandoned
+    self.settings = {'outputDir': outputDir, 'year': year, 'res': res, 'dtype': dtype, 'memBudget': memBudget, 'indexDir': indexDir, 'cog': cog}
+    self.tileBudget = tileBudget
+    self.host = socket.gethostname()
+    os.makedirs(os.path.join(workDir, CLAIM_DIR), exist_ok = True)
+    os.makedirs(outputDir, exist_ok = True)
+
+  ###########################################
+
+  def plan(self, lvis_files):
+    '''Plan the tasks of every file once, the first host to get here writes them for the others'''
+    taskFile = os.path.join(self.workDir, TASK_FILE)
+    # the files and settings that decide the tasks and their outputs
+    definition = {'files': [os.path.abspath(f) for f in lvis_files], 'year': str(self.year), 'res': self.settings['res'],
+                  'dtype': self.settings['dtype'], 'memBudget': self.settings['memBudget'], 'tileBudget': self.tileBudget,
+                  'cog': self.settings['cog']}
+    with fileLock(taskFile + '.lock'):
+      if os.path.isfile(taskFile):
+        with open(taskFile) as f:
+          planned = json.load(f)
+        # tasks planned for other files or settings would be run, and named, as if they were these
+        if(planned.get('plan') != definition):
+          raise ValueError(f"Tasks in {taskFile} were planned for {planned.get('plan')}, not {definition}; "
+                           "run with the same files and settings, or start a new work directory")
+        self.tasks = planned['tasks']
+        print(f"Read {len(self.tasks)} planned tasks from", taskFile)
+        return(self.tasks)
+      self.tasks = []
+      for lvis_file in lvis_files:
+        # each worker grounds its tile on its own, so tiles are planned for one process
+        tiles = plan_tiles(lvis_file, self.tileBudget, dtype = self.settings['dtype'], memBudget = self.settings['memBudget'], indexDir = self.settings['indexDir'])
+        name = os.path.basename(lvis_file).replace('.h5', '')
+        for i, tile in enumerate(tiles):
+          self.tasks.append({'id': f'{name}.{i}', 'filename': lvis_file, 'bounds': tile['bounds'], 'nWaves': tile['nWaves']})
+      with open(taskFile + '.tmp', 'w') as f:
+        json.dump({'plan': definition, 'tasks': self.tasks}, f)
+      os.replace(taskFile + '.tmp', taskFile)
+    print(f"Planned {len(self.tasks)} tasks of {len(lvis_files)} files to", taskFile)
+    return(self.tasks)
+
+  ###########################################
+
+  def completed(self):
+    '''Return the finished tasks of all hosts, from the manifest'''
+    return(read_manifest(self.workDir))
+
+  ###########################################
+
+  def run(self):
+    '''Run the unfinished tasks on a pool of processes, reporting progress and throughput'''
+    clear_stale(self.workDir, self.host, self.claimTimeout)
+    done = self.completed()
+    todo = [task for task in self.tasks if task['id'] not in done]
+    print(f"{len(done)} of {len(self.tasks)} tasks already finished, {len(todo)} to run on {self.nWorkers} processes of {self.host}")
+    start = time.perf_counter()
+    nRun, nWaves, failed = 0, 0, []
+    # a worker that dies, eg. killed out of memory, breaks the pool and fails the run, which can then be resumed
+    with ProcessPoolExecutor(self.nWorkers, initializer = open_worker, initargs = (self.workDir, self.host, self.settings)) as pool:
+      # tasks claimed by other hosts are skipped by the workers
+      for future in as_completed([pool.submit(run_task, task) for task in todo]):
+        result = future.result()
+        if(result is None):
+          continue
+        if('error' in result):
+          failed.append(result)
+          print(f"Task {result['id']} failed: {result['error']}")
+          continue
+        self.record(result)
+        nRun += 1
+        nWaves += result['nWaves']
+        self.progress(nRun, nWaves, time.perf_counter() - start)
+    if(len(failed) > 0):
+      print(f"{len(failed)} tasks failed, and will be run again on restart:", [result['id'] for result in failed])
+    return(failed)
+
+  ###########################################
+
+  def record(self, result):
+    '''Append a finished task to the manifest, then release its claim'''
+    manifest = os.path.join(self.workDir, MANIFEST_FILE)
+    with fileLock(manifest + '.lock'):
+      with open(manifest, 'a+b') as f:
+        # a line cut short by a crash is ended first, so it cannot swallow this record
+        f.seek(0, os.SEEK_END)
+        if(f.tell() > 0):
+          f.seek(-1, os.SEEK_END)
+          if(f.read(1) != b'\n'):
+            f.write(b'\n')
+        f.write((json.dumps(result) + '\n').encode())
+        f.flush()
+        os.fsync(f.fileno())
+    release_task(self.workDir, result['id'])
+
+  ###########################################
+
+  def progress(self, nRun, nWaves, seconds):
+    '''Print progress of all hosts and throughput of this one'''
+    done = self.completed()
+    hosts = {}
+    for record in done.values():
+      hosts[record['host']] = hosts.get(record['host'], 0) + 1
+    # throughput of all hosts, from the first start to the last finish in the manifest
+    span = max(r['finished'] for r in done.values()) - min(r['finished'] - r['seconds'] for r in done.values())
+    allWaves = sum(r['nWaves'] for r in done.values())
+    print(f"Progress: {len(done)}/{len(self.tasks)} tasks ({100 * len(done) / max(1, len(self.tasks)):.1f}%) | "
+          f"this host: {nRun / seconds * 60:.1f} tasks/min, {nWaves / seconds:.0f} waves/s | "
+          f"all hosts: {allWaves / max(span, 1e-9):.0f} waves/s, tasks per host {hosts}")
+
+###########################################
+
+def read_manifest(workDir):
+  '''Function to return the finished tasks in the manifest of a work directory, by task'''
+  manifest = os.path.join(workDir, MANIFEST_FILE)
+  if not os.path.isfile(manifest):
+    return({})
+  done = {}
+  with open(manifest) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # a line cut short by a crash, its task is run again
+        continue
+      done[record['id']] = record
+  return(done)
+
+###########################################
+
+def open_worker(workDir, host, settings):
+  '''Function to keep the work directory and task settings once in each worker process'''
+  _WORKER['workDir'] = workDir
+  _WORKER['host'] = host
+  _WORKER['settings'] = settings
+
+###########################################
+
+def run_task(task):
+  '''Function to claim a task, and read, ground and grid its tile to a DEM subset'''
+  workDir, settings = _WORKER['workDir'], _WORKER['settings']
+  if not claim_task(workDir, task['id'], _WORKER['host']):
+    return(None)
+  # another host may have finished it since this run started
+  if(task['id'] in read_manifest(workDir)):
+    release_task(workDir, task['id'])
+    return(None)
+  start = time.perf_counter()
+  try:
+    x0, y0, x1, y1 = task['bounds']
+    LVIS = plotLVIS(task['filename'], minX = x0, minY = y0, maxX = x1, maxY = y1, setElev = True, useIndex = True,
+                    indexDir = settings['indexDir'], dtype = settings['dtype'])
+    outName = None
+    if(LVIS.nWaves > 0):
+      # worker processes cannot start processes of their own, so each tile is grounded in one
+      LVIS.estimate_ground(memBudget = settings['memBudget'])
+      LVIS.reproject_coords(3031)
+      outName = os.path.join(settings['outputDir'], f"DEM_subset_{settings['year']}.x.{x0}.y.{y0}.tif")
+      # written under a hidden name and renamed, so a crash never leaves a partial DEM subset
+      tempName = os.path.join(settings['outputDir'], f'.{os.getpid()}.' + os.path.basename(outName))
+      LVIS.write_tiff(LVIS.zG, LVIS.x, LVIS.y, res = settings['res'], filename = tempName, epsg = 3031, cog = settings['cog'])
+      os.replace(tempName, outName)
+  except Exception as error:
+    release_task(workDir, task['id'])
+    return({'id': task['id'], 'error': f'{type(error).__name__}: {error}'})
+  return({'id': task['id'], 'output': outName, 'nWaves': int(LVIS.nWaves), 'seconds': time.perf_counter() - start,
+          'finished': time.time(), 'host': _WORKER['host'], 'pid': os.getpid()})
+
+###########################################
+
+def claim_name(workDir, taskId):
+  '''Function to return the claim file of a task'''
+  return(os.path.join(workDir, CLAIM_DIR, taskId + '.claim'))
+
+###########################################
+
+def claim_task(workDir, taskId, host):
+  '''Function to claim a task, returning False if another process holds it'''
+  try:
+    # creating the file is atomic, so only one process on any host wins
+    fd = os.open(claim_name(workDir, taskId), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+  except FileExistsError:
+    return(False)
+  with os.fdopen(fd, 'w') as f:
+    json.dump({'host': host, 'pid': os.getpid(), 'time': time.time()}, f)
+  return(True)
+
+###########################################
+
+def release_task(workDir, taskId):
+  '''Function to release the claim of a task'''
+  try:
+    os.remove(claim_name(workDir, taskId))
+  except FileNotFoundError:
+    pass
+
+###########################################
+
+def clear_stale(workDir, host, claimTimeout = 7200):
+  '''Function to release claims of crashed runs: dead processes of this host, or claims older than the timeout'''
+  claimDir = os.path.join(workDir, CLAIM_DIR)
+  for file in os.listdir(claimDir):
+    try:
+      with open(os.path.join(claimDir, file)) as f:
+        claim = json.load(f)
+    except FileNotFoundError:
+      continue
+    except ValueError:
+      # a claim being written, or cut short by a crash, is aged by its file
+      claim = {'host': None, 'pid': None, 'time': os.path.getmtime(os.path.join(claimDir, file))}
+    dead = (claim['host'] == host) and (not psutil.pid_exists(claim['pid']))
+    if(dead or (time.time() - claim['time'] > claimTimeout)):
+      release_task(workDir, file[:-len('.claim')])
+      print("Released stale claim of task", file[:-len('.claim')], "from", claim['host'])
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Report the progress of a campaign from its shared work directory
+  parser = argparse.ArgumentParser(description = 'Report progress of scheduled LVIS tasks')
+  parser.add_argument('work_dir', help = 'Shared work directory of the campaign')
+  args = parser.parse_args()
+  with open(os.path.join(args.work_dir, TASK_FILE)) as f:
+    tasks = json.load(f)['tasks']
+  done = read_manifest(args.work_dir)
+  claims = os.listdir(os.path.join(args.work_dir, CLAIM_DIR))
+  waves = sum(r['nWaves'] for r in done.values())
+  print(f"{len(done)}/{len(tasks)} tasks finished, {len(claims)} running, {waves} of {sum(t['nWaves'] for t in tasks)} waveforms")
+  for host in sorted(set(r['host'] for r in done.values())):
+    records = [r for r in done.values() if r['host'] == host]
+    print(f"{host:<24s} tasks: {len(records):<6d} waves/s per process: {sum(r['nWaves'] for r in records) / max(1e-9, sum(r['seconds'] for r in records)):.0f}")
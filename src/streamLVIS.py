@@ -0,0 +1,110 @@
+'''
+Methods to Stream LVIS Files to Footprints
+'''
+
+# Import libraries
+import numpy as np
+import h5py as h5
+import os
+from indexLVIS import indexLVIS
+from plotLVIS import plotLVIS
+from projectLVIS import inside_box
+
+
+# fields of a footprint record
+FOOTPRINT_FIELDS = [('X', 'f8'), ('Y', 'f8'), ('ZG', 'f8'), ('LFID', 'i8'), ('SHOTNUMBER', 'i8')]
+
+
+###########################################
+
+def find_rows(filename, minX = -100000000, minY = -100000000, maxX = 100000000, maxY = 100000000, useIndex = False, indexDir = None, bboxEPSG = 4326):
+  '''Function to return the sorted rows of a LVIS file inside a box'''
+  if(useIndex):
+    index = indexLVIS(filename, indexDir = indexDir)
+    if(bboxEPSG == 4326):
+      return(index.query(minX, minY, maxX, maxY)[0])
+    return(index.query_projected(minX, minY, maxX, maxY, bboxEPSG)[0])
+  # otherwise read the midpoints once, as readLVIS does
+  f = h5.File(filename, 'r')
+  nBins = f['RXWAVE'].shape[1]
+  lon = (np.array(f['LON0']) + np.array(f['LON' + str(nBins -1)])) / 2.0
+  lat = (np.array(f['LAT0']) + np.array(f['LAT' + str(nBins -1)])) / 2.0
+  f.close()
+  return(np.where(inside_box(lon, lat, minX, minY, maxX, maxY, epsg = bboxEPSG))[0])
+
+###########################################
+
+def stream_footprints(filename, blockSize = 50000, minX = -100000000, minY = -100000000, maxX = 100000000, maxY = 100000000,
+                      epsg = 3031, useIndex = False, indexDir = None, dtype = np.float64, keepNoData = False, bboxEPSG = 4326, **groundArgs):
+  '''Generator of (x, y, zG, lfid, shotN) blocks of a LVIS file, holding one block of waveforms at a time'''
+  useInd = find_rows(filename, minX, minY, maxX, maxY, useIndex = useIndex, indexDir = indexDir, bboxEPSG = bboxEPSG)
+  for start in range(0, len(useInd), blockSize):
+    # read, ground and reproject one block of waveforms
+    block = plotLVIS(filename, rows = useInd[start: start + blockSize], setElev = True, dtype = dtype)
+    block.estimate_ground(**groundArgs)
+    block.reproject_coords(epsg)
+    # drop footprints without a ground estimate (clouds etc)
+    use = np.ones(block.nWaves, dtype = bool) if keepNoData else (block.zG != -999.0)
+    yield(np.asarray(block.x)[use], np.asarray(block.y)[use], block.zG[use], block.lfid[use], block.lShot[use])
+
+###########################################
+
+class footprintWriter():
+  '''Class to append footprint records to a HDF5 file, block by block'''
+
+  ###########################################
+
+  def __init__(self, filename, chunkSize = 65536):
+    '''Class initialiser: Create resizable datasets for each field'''
+    self.filename = filename
+    self.nFootprints = 0
+    self.f = h5.File(filename, 'w')
+    for name, dtype in FOOTPRINT_FIELDS:
+      self.f.create_dataset(name, shape = (0,), maxshape = (None,), dtype = dtype, chunks = (chunkSize,))
+
+  ###########################################
+
+  def __enter__(self):
+    return(self)
+
+  ###########################################
+
+  def __exit__(self, *args):
+    self.close()
+
+  ###########################################
+
+  def write(self, x, y, zG, lfid, shotN):
+    '''Append one block of footprint records'''
+    n = len(x)
+    for (name, dtype), data in zip(FOOTPRINT_FIELDS, (x, y, zG, lfid, shotN)):
+      self.f[name].resize((self.nFootprints + n,))
+      self.f[name][self.nFootprints: self.nFootprints + n] = data
+    self.nFootprints += n
+
+  ###########################################
+
+  def close(self):
+    '''Close the footprint file'''
+    if(self.f is not None):
+      self.f.close()
+      self.f = None
+      print(f"Success writing {self.nFootprints} footprints to", self.filename)
+
+###########################################
+
+def stream_file(filename, outName, blockSize = 50000, **streamArgs):
+  '''Function to stream the footprints of a LVIS file to a footprint file'''
+  with footprintWriter(outName) as writer:
+    for x, y, zG, lfid, shotN in stream_footprints(filename, blockSize = blockSize, **streamArgs):
+      writer.write(x, y, zG, lfid, shotN)
+  return(writer.nFootprints)
+
+###########################################
+
+def read_footprints(filename):
+  '''Function to read a footprint file as a dictionary of arrays'''
+  with h5.File(filename, 'r') as f:
+    return({name: np.array(f[name]) for name, dtype in FOOTPRINT_FIELDS})
+
+###########################################
@@ -0,0 +1,111 @@
+'''
+Methods to Write Synthetic LVIS Files
+'''
+
+# Import libraries
+import numpy as np
+import h5py as h5
+import argparse
+
+
+# vertical spacing of waveform bins in metres
+BIN_SPACING = 0.3
+
+# waveforms generated and written at a time
+WRITE_BLOCK = 50000
+
+
+###########################################
+
+def surface_elevation(lon, lat, dz = 0.0):
+  '''Function to return a smooth synthetic ice surface elevation, rising inland'''
+  return(150.0 + 400.0 * (lat - np.floor(lat)) + 25.0 * np.sin(lon * 7.0) * np.cos(lat * 11.0) + dz)
+
+###########################################
+
+def flight_lines(nWaves, bounds, nLines, swath, rng):
+  '''Function to return footprint coordinates, flight IDs and shot numbers of zig-zag scanning flight lines'''
+  minX, minY, maxX, maxY = bounds
+  line = np.repeat(np.arange(nLines), int(np.ceil(nWaves / nLines)))[:nWaves]
+  shot = np.arange(nWaves) - np.searchsorted(line, line)
+  nShots = np.bincount(line)[line]
+  along = shot / np.maximum(nShots - 1, 1)
+  # lines run south to north, spread across the box
+  centre = minX + (maxX - minX) * (line + 0.5) / nLines
+  lon = centre + swath * np.sin(shot * 0.35) + rng.normal(0.0, swath * 0.02, nWaves)
+  lat = minY + (maxY - minY) * along
+  lfid = 1400000000 + line
+  return(lon, lat, lfid, shot)
+
+###########################################
+
+def synthetic_waves(z0, surface, nBins, noise, cloudy, empty, rng):
+  '''Function to return waveforms with a ground return, or cloud or noise only'''
+  nWaves = len(z0)
+  bins = np.arange(nBins)
+  # background noise
+  waves = rng.normal(10.0, noise, (nWaves, nBins))
+  # ground return at the bin of the surface
+  groundBin = (z0 - surface) / BIN_SPACING
+  width = rng.uniform(2.0, 5.0, nWaves)
+  amplitude = rng.uniform(40.0, 200.0, nWaves)
+  amplitude[cloudy] *= 0.05
+  amplitude[empty] = 0.0
+  waves += amplitude[:, None] * np.exp(-0.5 * ((bins[None, :] - groundBin[:, None]) / width[:, None])**2)
+  # clouds give broad returns high in the waveform
+  cloudBin = rng.uniform(5.0, nBins / 3.0, nWaves)
+  waves[cloudy] += 80.0 * np.exp(-0.5 * ((bins[None, :] - cloudBin[cloudy, None]) / 20.0)**2)
+  return(np.clip(np.rint(waves), 0, 65535).astype(np.uint16))
+
+###########################################
+
+def write_synthetic(filename, nWaves = 100000, nBins = 500, noise = 2.0, cloudFraction = 0.05, emptyFraction = 0.02,
+                    bounds = [258.0, -75.5, 262.0, -74.5], nLines = 4, swath = 0.02, dz = 0.0, seed = 0, chunkRows = None):
+  '''Function to write a synthetic LVIS file with the datasets readLVIS expects, a block of waveforms at a time'''
+  rng = np.random.default_rng(seed)
+  lon, lat, lfid, shot = flight_lines(nWaves, bounds, nLines, swath, rng)
+  with h5.File(filename, 'w') as f:
+    chunks = None if chunkRows is None else (min(chunkRows, nWaves), nBins)
+    f.create_dataset('RXWAVE', shape = (nWaves, nBins), dtype = np.uint16, chunks = chunks)
+    for name in ['LON0', 'LAT0', 'LON' + str(nBins -1), 'LAT' + str(nBins -1), 'Z0', 'Z' + str(nBins -1)]:
+      f.create_dataset(name, shape = (nWaves,), dtype = np.float64, chunks = None if chunkRows is None else (min(chunkRows, nWaves),))
+    f['LFID'] = lfid
+    f['SHOTNUMBER'] = shot
+    for start in range(0, nWaves, WRITE_BLOCK):
+      rows = slice(start, min(start + WRITE_BLOCK, nWaves))
+      n = rows.stop - rows.start
+      # the beam is slightly off nadir, so top and bottom positions differ a little
+      tilt = rng.normal(0.0, 2e-5, (n, 2))
+      surface = surface_elevation(lon[rows], lat[rows], dz)
+      z0 = surface + rng.uniform(0.2, 0.5, n) * BIN_SPACING * nBins
+      state = rng.random(n)
+      cloudy = state < cloudFraction
+      empty = (state >= cloudFraction) & (state < cloudFraction + emptyFraction)
+      f['RXWAVE'][rows] = synthetic_waves(z0, surface, nBins, noise, cloudy, empty, rng)
+      f['LON0'][rows] = lon[rows] - tilt[:, 0]
+      f['LAT0'][rows] = lat[rows] - tilt[:, 1]
+      f['LON' + str(nBins -1)][rows] = lon[rows] + tilt[:, 0]
+      f['LAT' + str(nBins -1)][rows] = lat[rows] + tilt[:, 1]
+      f['Z0'][rows] = z0
+      f['Z' + str(nBins -1)][rows] = z0 - BIN_SPACING * (nBins - 1)
+  print(f"Success writing {nWaves} synthetic waveforms to", filename)
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Write a synthetic LVIS file
+  parser = argparse.ArgumentParser(description = 'Write a synthetic LVIS file with the layout of the real data')
+  parser.add_argument('filename', help = 'Path of the synthetic LVIS file')
+  parser.add_argument('--waves', type = int, default = 100000, help = 'Number of footprints')
+  parser.add_argument('--bins', type = int, default = 500, help = 'Number of bins per waveform')
+  parser.add_argument('--noise', type = float, default = 2.0, help = 'Standard deviation of background noise')
+  parser.add_argument('--cloud_fraction', type = float, default = 0.05, help = 'Fraction of cloud-contaminated waveforms')
+  parser.add_argument('--empty_fraction', type = float, default = 0.02, help = 'Fraction of waveforms without a return')
+  parser.add_argument('--lines', type = int, default = 4, help = 'Number of flight lines')
+  parser.add_argument('--dz', type = float, default = 0.0, help = 'Change in surface elevation, eg. for a later year')
+  parser.add_argument('--seed', type = int, default = 0, help = 'Random seed')
+  parser.add_argument('--chunk_rows', type = int, help = 'Rows per HDF5 chunk, if chunked')
+  args = parser.parse_args()
+  write_synthetic(args.filename, nWaves = args.waves, nBins = args.bins, noise = args.noise, cloudFraction = args.cloud_fraction,
+                  emptyFraction = args.empty_fraction, nLines = args.lines, dz = args.dz, seed = args.seed, chunkRows = args.chunk_rows)
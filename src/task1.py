@@ -55,6 +55,9 @@ def main():
     ram = psutil.Process().memory_info().rss
     print(f"RAM usage: {convert_bytes(ram)}")
 
+    # Report wall time, CPU time, peak RAM and throughput of each stage
+    write_report('profile_task1.json')
+
 
 if __name__ == '__main__':
 
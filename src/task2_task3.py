@@ -11,6 +11,11 @@ from processLVIS import *
 from plotLVIS import *
 from methodsDEM import *
 from manageRAM import *
+from catalogLVIS import catalogLVIS
+from streamLVIS import *
+from gridLVIS import mosaicGrid, shape_bounds, lonlat_bounds
+from tileLVIS import plan_tiles
+from schedulerLVIS import schedulerLVIS
 
 ###########################################
 
@@ -23,57 +28,137 @@ def main():
     parser.add_argument("year", help = "Year of LVIS data, 2009 or 2015")
     parser.add_argument("--single_file", action = "store_true", help = "Process only one LVIS file to DEM")
     parser.add_argument("--res", type = int, default = 30, help = "Spatial resolution of DEM in meters")
-    parser.add_argument("--output_dir", help = "Output directory for DEM(s)")
+    parser.add_argument("--output_dir", default = ".", help = "Output directory for DEM(s)")
+    parser.add_argument("--index_dir", help = "Directory for spatial index sidecars, by default lvis_index in the output directory")
+    parser.add_argument("--catalog", help = "Path of the LVIS catalogue table, by default lvis_catalog_{year}.csv in the output directory")
+    parser.add_argument("--shape", help = "Only process LVIS files with footprints inside this shapefile")
+    parser.add_argument("--dtype", default = "float64", choices = ["float32", "float64"], help = "Working precision of ground estimation")
+    parser.add_argument("--workers", type = int, default = 1, help = "Number of processes for ground estimation")
+    parser.add_argument("--mem_budget", type = float, help = "Memory budget for denoising in MB, blocks of waveforms are denoised in place")
+    parser.add_argument("--tile_budget", type = float, default = 2048, help = "Memory budget of each tile in MB, tiles are planned with balanced footprint counts")
+    parser.add_argument("--stream", action = "store_true", help = "Stream each file in blocks of waveforms, rather than fixed tiles")
+    parser.add_argument("--block_size", type = int, default = 50000, help = "Number of waveforms per block when streaming")
+    parser.add_argument("--mosaic", action = "store_true", help = "Accumulate all footprints onto one campaign grid and write a single DEM")
+    parser.add_argument("--mosaic_dir", help = "Directory to keep the mosaic grid on disk, rather than in RAM")
+    parser.add_argument("--cog", action = "store_true", help = "Write DEMs as cloud optimized GeoTIFFs: tiled, compressed float32 with overviews")
+    parser.add_argument("--work_dir", help = "Shared work directory to run (file, tile) tasks on a pool of processes, resuming from its manifest; give the same one on each host")
+    parser.add_argument("--processes", type = int, default = 1, help = "Number of processes running tasks on this host, with --work_dir")
+    parser.add_argument("--resume", action = "store_true", help = "Continue the mosaic grid kept in --mosaic_dir, skipping files already added")
     args = parser.parse_args()
+    if args.work_dir and (args.mosaic or args.stream):
+        parser.error("--work_dir writes DEM subsets of planned tiles, so cannot be used with --mosaic or --stream")
+    if args.mosaic and args.single_file and not args.stream:
+        # a file the mosaic grid only holds some tiles of would be recorded as added, and skipped on resume
+        parser.error("--single_file grids only part of a file's tiles, so cannot be used with --mosaic unless streaming with --stream")
     
     # Start CPU runtime
     start = time.process_time()
 
     # Identify directory containing LVIS files
     dir = f'/geos/netdata/oosa/assignment/lvis/{args.year}/'
-    lvis_files = [f for f in os.listdir(dir) if f.endswith('.h5')]
+    # sidecars and the catalogue are kept with the outputs, so the shared data directory is never written to
+    if args.index_dir is None:
+        args.index_dir = os.path.join(args.output_dir, 'lvis_index')
+    if args.catalog is None:
+        args.catalog = os.path.join(args.output_dir, f'lvis_catalog_{args.year}.csv')
+    os.makedirs(args.index_dir, exist_ok = True)
+    catalog = catalogLVIS(dir, catalogFile = args.catalog, indexDir = args.index_dir)
+    if args.shape:
+        lvis_files = [hit['filename'] for hit in catalog.query_shape(args.shape)]
+    else:
+        lvis_files = [os.path.join(dir, f) for f in catalog.table.filename]
     print('Number of LVIS files: ', len(lvis_files))
+    memBudget = None if args.mem_budget is None else int(args.mem_budget * 1024**2)
+    tileBudget = int(args.tile_budget * 1024**2)
 
-    # Isolate one LVIS file
-    for file in lvis_files:
-        lvis_file = os.path.join(dir, file)
+    # Run (file, tile) tasks on a pool of processes, resuming from the manifest of the shared work directory
+    mosaic = None
+    if args.work_dir:
+        scheduler = schedulerLVIS(args.work_dir, args.output_dir, args.year, nWorkers = args.processes, res = args.res, dtype = args.dtype,
+                                  memBudget = memBudget, tileBudget = tileBudget, indexDir = args.index_dir, cog = args.cog)
+        scheduler.plan(lvis_files[:1] if args.single_file else lvis_files)
+        scheduler.run()
+    else:
+        # Define one grid over the shapefile or the whole campaign, shared by all files
+        if args.mosaic:
+            if args.shape:
+                grid_bounds = shape_bounds(args.shape, epsg = 3031)
+            else:
+                t = catalog.table
+                grid_bounds = lonlat_bounds([t.minX.min(), t.minY.min(), t.maxX.max(), t.maxY.max()], epsg = 3031)
+            mosaic = mosaicGrid(grid_bounds, res = args.res, epsg = 3031, workDir = args.mosaic_dir, resume = args.resume)
 
-        # Initialize class
-        LVIS = plotLVIS(lvis_file, onlyBounds = True)
-    
-        # Define subset size, RAM < 2 GB
-        subset_size = (LVIS.bounds[2] - LVIS.bounds[0]) / 16
-        for x0 in np.arange(LVIS.bounds[0], LVIS.bounds[2], subset_size):
-            x1 = x0 + subset_size
-            for y0 in np.arange(LVIS.bounds[1], LVIS.bounds[3], subset_size):
-                y1 = y0 + subset_size
+        # Isolate one LVIS file
+        for lvis_file in lvis_files:
+
+            # Files already in a resumed mosaic grid are not added twice
+            if (mosaic is not None) and mosaic.is_done(lvis_file):
+                print('Already in the mosaic grid:', lvis_file)
+                continue
+
+            # Stream blocks of waveforms to footprints and DEM subsets, memory depends on block size only
+            if args.stream:
+                name = os.path.basename(lvis_file).replace('.h5', '')
+                with footprintWriter(f'{args.output_dir}/footprints_{args.year}.{name}.h5') as writer:
+                    blocks = stream_footprints(lvis_file, blockSize = args.block_size, useIndex = True, indexDir = args.index_dir,
+                                               dtype = args.dtype, memBudget = memBudget, nWorkers = args.workers)
+                    for n, (x, y, zG, lfid, shotN) in enumerate(blocks):
+                        writer.write(x, y, zG, lfid, shotN)
+                        if mosaic is not None:
+                            mosaic.add(x, y, zG)
+                        elif len(zG) > 0:
+                            outName = f'{args.output_dir}/DEM_subset_{args.year}.{name}.block.{n}.tif'
+                            footprints_to_tiff(zG, x, y, res = args.res, filename = outName, epsg = 3031, cog = args.cog)
+                if mosaic is not None:
+                    mosaic.commit(lvis_file)
+                print(f'-----------------LVIS FILE DEM COMPLETE-----------------\n')
+                if args.single_file:
+                    break
+                continue
+
+            # Plan tiles with balanced footprint counts from the index, each fitting in the tile budget
+            tiles = plan_tiles(lvis_file, tileBudget, dtype = args.dtype, memBudget = memBudget, nWorkers = args.workers, indexDir = args.index_dir)
+            for tile in tiles:
+                x0, y0, x1, y1 = tile['bounds']
 
                 # Read subset of LVIS data
-                LVIS_subset = plotLVIS(lvis_file, minX = x0, minY = y0, maxX = x1, maxY = y1, setElev = True)
+                LVIS_subset = plotLVIS(lvis_file, minX = x0, minY = y0, maxX = x1, maxY = y1, setElev = True, useIndex = True, indexDir = args.index_dir, dtype = args.dtype)
                 if LVIS_subset.nWaves == 0:
                     continue
-            
+
                 # Calculate footprint ground estimates
                 LVIS_subset.set_elevations()
-                LVIS_subset.estimate_ground()
+                LVIS_subset.estimate_ground(memBudget = memBudget, nWorkers = args.workers)
                 print(f'DEM subset ground estimates: {LVIS_subset.zG[:5]}')
 
                 # Convert footprints to DEM
                 LVIS_subset.reproject_coords(3031)
-                outName = f'{args.output_dir}/DEM_subset_{args.year}.x.{x0}.y.{y0}.tif'
-                LVIS_subset.write_tiff(LVIS_subset.zG, LVIS_subset.x, LVIS_subset.y, res = args.res, filename = outName, epsg = 3031)
+                if mosaic is not None:
+                    mosaic.add(LVIS_subset.x, LVIS_subset.y, LVIS_subset.zG)
+                else:
+                    outName = f'{args.output_dir}/DEM_subset_{args.year}.x.{x0}.y.{y0}.tif'
+                    LVIS_subset.write_tiff(LVIS_subset.zG, LVIS_subset.x, LVIS_subset.y, res = args.res, filename = outName, epsg = 3031, cog = args.cog)
 
                 # Produce DEM for one LVIS file if condition is applied
                 if args.single_file:
                     break
 
-        print(f'-----------------LVIS FILE DEM COMPLETE-----------------\n')
+            print(f'-----------------LVIS FILE DEM COMPLETE-----------------\n')
+            if mosaic is not None:
+                mosaic.commit(lvis_file)
+
+    # Write the campaign DEM once, overlapping flight lines are averaged per pixel
+    if mosaic is not None:
+        mosaic.write(f'{args.output_dir}/LVIS_DEM_{args.year}_MOSAIC.tif', cog = args.cog)
 
     # Calculate CPU runtime and RAM usage
     print(f"CPU runtime: {round(((time.process_time() - start) / 60), 2)} minutes")
     ram = psutil.Process().memory_info().rss
     print(f"RAM usage: {convert_bytes(ram)}")
 
+    # Report wall time, CPU time, peak RAM and throughput of each stage
+    write_report(os.path.join(args.output_dir, f'profile_task2_task3_{args.year}.json'))
+
 ###########################################
     
 if __name__ == '__main__':
@@ -22,6 +22,12 @@ def main():
     parser.add_argument("year", help = "Year of LVIS data, 2009 or 2015")
     parser.add_argument("--smooth", action = "store_true", help = "Perform gap-filling algorithm to smooth LVIS DEMs")
     parser.add_argument("--output_dir", help = "Output directory for DEM(s)")
+    parser.add_argument("--workers", type = int, default = 8, help = "Number of threads reading DEM subset headers and processes mosaicking them")
+    parser.add_argument("--res", type = int, default = 30, help = "Spatial resolution of the mosaicked DEM in meters")
+    parser.add_argument("--max_distance", type = float, default = 100, help = "Only gap fill pixels within this many pixels of data when smoothing")
+    parser.add_argument("--tile_size", type = int, default = 1024, help = "Size of tiles gap filled in parallel, in pixels")
+    parser.add_argument("--compress", default = "DEFLATE", help = "Compression of the mosaicked DEM, eg. DEFLATE, LZW or ZSTD")
+    parser.add_argument("--valid_extent", action = "store_true", help = "Drop DEM subsets whose valid data misses the study area")
     args = parser.parse_args()
 
     # Start CPU runtime
@@ -31,13 +37,11 @@ def main():
     dem_list = glob.glob(f'DEM_subset_{args.year}.*.tif')
     print(f'Number of DEM subsets: {len(dem_list)}')
     shape = '.../shapes/pine_island_glacier.shp'
-    filtered_subsets = filter_tiffs(dem_list, shape)
+    index_file = os.path.join(args.output_dir, f'DEM_subset_index_{args.year}.csv')
+    filtered_subsets = filter_tiffs(dem_list, shape, index_file = index_file, n_workers = args.workers, valid_extent = args.valid_extent)
 
-    # Batch merge filtered subsets (to merge all 244 subsets at once, RAM = ~9GB)
-    merge_tiffs(filtered_subsets, args.output_dir, step_size = 10, label = f'initial_{args.year}')
-    merged_list = glob.glob(f'initial_{args.year}_*.tif')
-    merge_tiffs(merged_list, args.output_dir, step_size = len(merged_list), label = f'final_{args.year}')
-    os.rename(f'final_{args.year}_merged_subsets_0.tif', f'LVIS_DEM_{args.year}_RAW.tif')
+    # Mosaic filtered subsets in one pass, window by window
+    mosaic_tiffs(filtered_subsets, f'LVIS_DEM_{args.year}_RAW.tif', res = args.res, compress = args.compress, n_workers = args.workers)
 
     # Crop merged LVIS DEM to study area
     lvis_dem = f'LVIS_DEM_{args.year}_RAW.tif'
@@ -48,7 +52,7 @@ def main():
     if args.smooth:
         raw_dem = f'LVIS_DEM_{args.year}.tif'
         smooth_dem = str(args.output_dir) + f'LVIS_DEM_{args.year}_SMOOTH.tif' 
-        smooth_tiff(raw_dem, smooth_dem, window_size = 1)
+        smooth_tiff(raw_dem, smooth_dem, window_size = 1, max_distance = args.max_distance, tile_size = args.tile_size, n_workers = args.workers)
 
         # Crop smoothed DEM to Pine Island Glacier
         final_dem = str(args.output_dir) + f'LVIS_DEM_{args.year}_FINAL.tif'
@@ -59,6 +63,9 @@ def main():
     ram = psutil.Process().memory_info().rss
     print(f"RAM usage: {convert_bytes(ram)}")
 
+    # Report wall time, CPU time, peak RAM and throughput of each stage
+    write_report(os.path.join(args.output_dir, f'profile_task4_{args.year}.json'))
+
 
 if __name__ == '__main__':
      
@@ -20,6 +20,10 @@ def main():
     # Define command line parser to use for multiple LVIS years
     parser = argparse.ArgumentParser(description = "Process LVIS files from a specified year.")
     parser.add_argument("--output_dir", help = "Output directory for DEM(s)")
+    parser.add_argument("--zones", help = "Shapefile of polygon zones for change statistics, eg. glacier trunk and tributaries")
+    parser.add_argument("--zone_field", help = "Attribute of the zones shapefile naming each zone")
+    parser.add_argument("--workers", type = int, default = 1, help = "Number of processes computing zonal statistics")
+    parser.add_argument("--cog", action = "store_true", help = "Write the elevation change as a cloud optimized GeoTIFF")
     args = parser.parse_args()
 
     # Start CPU runtime
@@ -36,15 +40,15 @@ def main():
     clip_tiff(dem_09, shape, output_dem_09, reference_raster = dem_15)
     clip_tiff(dem_15, shape, output_dem_15, reference_raster = dem_15)
 
-    # Read DEMs and calculate elevation change
-    dem_09_tiff = methodsDEM(output_dem_09)
-    dem_15_tiff = methodsDEM(output_dem_15)
-    elevation_avg, elevation_change = dem_09_tiff.calculate_change(dem_15_tiff, avg = True)
+    # Difference the DEMs block by block, writing the change and accumulating its statistics
+    output_tiff = f'{args.output_dir}LVIS_ELEVATION_CHANGE.tif'
+    change = stream_change(output_dem_09, output_dem_15, output_tiff, histRange = (-75, 75), histBins = 30, cog = args.cog)
+    elevation_avg = change['mean']
     print('Average Elevation Change, 2009-2015: ', round(elevation_avg, 3), 'metres')
 
     # Create histogram for elevation change
-    valid_change = elevation_change[(elevation_change != -999) & (elevation_change <= 75) & (elevation_change >= -75)]
-    plt.hist(valid_change.flatten(), bins = 30, color = 'teal')
+    edges = change['histEdges']
+    plt.bar(edges[:-1], change['histCounts'], width = np.diff(edges), align = 'edge', color = 'teal')
     plt.xticks(np.arange(-75, 76, 25))
     plt.title('LVIS Elevation Change of Pine Island Glacier, 2009-2015')
     plt.xlabel('Elevation Change (meters)')
@@ -52,25 +56,16 @@ def main():
     plt.savefig(f'{args.output_dir}/lvis_dem_change_histogram.png')
     plt.show()
 
-    # Write elevation change data to geotiff
-    output_tiff = f'{args.output_dir}LVIS_ELEVATION_CHANGE.tif'
-    dem_09_tiff.write_tiff(elevation_change, output_tiff, epsg = 3031)
-    
-    # Express elevation change in ice volume
-    surface_area = (dem_09_tiff.nX * 30) * (dem_09_tiff.nY * 30)  # in square meters
-    print(f'Surface Area: {surface_area} m²')
-
-    # Calculate valid elevation change (excluding -999 values)
-    valid_change = elevation_change[elevation_change != -999]
-
-    # Calculate volume change in meters
-    volume_change = np.sum(valid_change) * surface_area
-    print(f'Ice Volume Change: {round(volume_change, 3)} m³')
+    # Change statistics, volume and mass per zone, in one block-wise pass over the change raster
+    zones = args.zones if args.zones else shape
+    table = zonal_stats(output_tiff, zones, zone_field = args.zone_field, n_workers = args.workers, years = 6)
+    print(table.to_string(index = False))
+    table.to_csv(f'{args.output_dir}/lvis_zonal_change.csv', index = False)
 
-    # Convert ice volume change to mass of water equivalent
-    ice_density = 0.917 / 1000                       # convert density from g/cm³ to kg/m³
-    water_density = 1.000 / 1000                     # convert density from g/cm³ to kg/m³
-    mass_change = volume_change * (ice_density / water_density)
+    # Express elevation change in ice volume and mass, from the real pixel area
+    print(f"Surface Area: {table['area'].sum()} m²")
+    print(f"Ice Volume Change: {round(table['volume'].sum(), 3)} m³")
+    mass_change = table['mass'].sum()
     print(f'Ice Mass Change: {round(mass_change, 3)} kg')
     print(f'Ice Mass Change per year: {round((mass_change / 6), 3)} kg/year')
 
@@ -79,6 +74,9 @@ def main():
     ram = psutil.Process().memory_info().rss
     print(f"RAM usage: {convert_bytes(ram)}")
 
+    # Report wall time, CPU time, peak RAM and throughput of each stage
+    write_report(os.path.join(args.output_dir, 'profile_task5.json'))
+
 
 if __name__ == '__main__':
      
@@ -0,0 +1,121 @@
+'''
+Methods to Plan LVIS Tiles Within a Memory Budget
+'''
+
+# Import libraries
+import numpy as np
+import h5py as h5
+import argparse
+from indexLVIS import indexLVIS
+from processLVIS import BLOCK_BYTES
+from manageRAM import convert_bytes
+
+
+# bytes of the per footprint arrays held with each waveform: coordinates, elevations, noise, ground and labels
+SCALAR_BYTES = 14 * 8
+
+
+###########################################
+
+def wave_bytes(nBins, waveDtype, dtype = np.float64, memBudget = None, nWorkers = 1):
+  '''Function to return the bytes held per waveform while a tile is read and grounded'''
+  rowBytes = nBins * np.dtype(waveDtype).itemsize
+  # worker processes share a copy of the waveforms
+  if(nWorkers > 1):
+    rowBytes *= 2
+  # without a budget or workers, the whole denoised array is held
+  elif(memBudget is None):
+    rowBytes += nBins * np.dtype(dtype).itemsize
+  return(rowBytes + SCALAR_BYTES)
+
+###########################################
+
+def work_bytes(memBudget = None, nWorkers = 1):
+  '''Function to return the fixed working memory of denoising, whatever the tile size'''
+  if(memBudget is not None):
+    return(int(memBudget))
+  # each process denoises blocks of its own
+  return(max(1, nWorkers) * BLOCK_BYTES)
+
+###########################################
+
+def split_tiles(lon, lat, maxWaves):
+  '''Function to split footprints into boxes of at most maxWaves footprints, cutting at quantiles of the longer side'''
+  # boxes hold footprints with minX <= lon < maxX and minY <= lat < maxY, as readLVIS, so no footprint is in two boxes
+  box = [np.min(lon), np.min(lat), np.nextafter(np.max(lon), np.inf), np.nextafter(np.max(lat), np.inf)]
+  stack = [(box, np.arange(len(lon)))]
+  tiles = []
+  while(len(stack) > 0):
+    box, ind = stack.pop()
+    nParts = int(np.ceil(len(ind) / maxWaves))
+    split = None
+    if(nParts > 1):
+      # cut so each side holds a whole number of tiles, giving balanced counts
+      k = int(len(ind) * (nParts // 2) / nParts)
+      # longer side first, in metres rather than degrees of longitude
+      widths = [(box[2] - box[0]) * np.cos(np.radians(np.mean(lat[ind]))), box[3] - box[1]]
+      for axis in np.argsort(widths)[::-1]:
+        coord = (lon if axis == 0 else lat)[ind]
+        cut = np.partition(coord, k)[k]
+        left = coord < cut
+        # footprints sharing the cut coordinate all go one way, so move the cut if a side is empty
+        if(not np.any(left)):
+          above = coord[coord > cut]
+          if(len(above) == 0):
+            continue
+          cut = np.min(above)
+          left = coord < cut
+        split = (axis, cut, left)
+        break
+    if(split is None):
+      # within budget, or footprints at one point that cannot be split
+      if(nParts > 1):
+        print(f"Tile of {len(ind)} footprints at one point is over budget")
+      tiles.append({'bounds': [float(b) for b in box], 'nWaves': len(ind)})
+      continue
+    axis, cut, left = split
+    lower, upper = list(box), list(box)
+    lower[axis + 2] = cut
+    upper[axis] = cut
+    # empty boxes are never made, as each side holds footprints
+    stack.append((upper, ind[~left]))
+    stack.append((lower, ind[left]))
+  return(tiles)
+
+###########################################
+
+def plan_tiles(filename, tileBudget, dtype = np.float64, memBudget = None, nWorkers = 1, indexDir = None):
+  '''Function to plan tiles of a LVIS file with balanced footprint counts, each fitting in a memory budget in bytes'''
+  # footprint midpoints from the spatial index sidecar, no waveforms are read
+  index = indexLVIS(filename, indexDir = indexDir)
+  lon, lat = index.dump_coords()
+  with h5.File(filename, 'r') as f:
+    waveDtype = f['RXWAVE'].dtype
+  if(len(lon) == 0):
+    return([])
+  perWave = wave_bytes(index.nBins, waveDtype, dtype = dtype, memBudget = memBudget, nWorkers = nWorkers)
+  free = tileBudget - work_bytes(memBudget = memBudget, nWorkers = nWorkers)
+  if(free < perWave):
+    raise ValueError(f"Tile budget of {convert_bytes(tileBudget)} is below the denoising memory, raise it or lower the denoising budget")
+  maxWaves = int(free // perWave)
+  tiles = split_tiles(lon, lat, maxWaves)
+  print(f"Planned {len(tiles)} tiles of at most {maxWaves} footprints ({convert_bytes(perWave)} each) for", filename)
+  return(tiles)
+
+###########################################
+
+if __name__ == '__main__':
+
+  # Print the tiles planned for a LVIS file
+  parser = argparse.ArgumentParser(description = 'Plan tiles of a LVIS file within a memory budget')
+  parser.add_argument('filename', help = 'Path of the LVIS file')
+  parser.add_argument('--tile_budget', type = float, default = 2048, help = 'Memory budget of each tile in MB')
+  parser.add_argument('--mem_budget', type = float, help = 'Memory budget for denoising in MB')
+  parser.add_argument('--dtype', default = 'float64', choices = ['float32', 'float64'], help = 'Working precision of ground estimation')
+  parser.add_argument('--workers', type = int, default = 1, help = 'Number of processes for ground estimation')
+  parser.add_argument('--index_dir', help = 'Directory for spatial index sidecars, if not next to the LVIS file')
+  args = parser.parse_args()
+  memBudget = None if args.mem_budget is None else int(args.mem_budget * 1024**2)
+  for tile in plan_tiles(args.filename, int(args.tile_budget * 1024**2), dtype = args.dtype, memBudget = memBudget,
+                         nWorkers = args.workers, indexDir = args.index_dir):
+    print(tile['nWaves'], tile['bounds'])
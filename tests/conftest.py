@@ -0,0 +1,8 @@
+'''
+Test Configuration: Import the Modules in src
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
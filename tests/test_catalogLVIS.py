@@ -0,0 +1,37 @@
+'''
+Tests of the LVIS Catalogue
+'''
+
+import numpy as np
+
+from catalogLVIS import catalogLVIS
+from syntheticLVIS import write_synthetic
+
+
+###########################################
+
+def test_query_longitude_from_0_to_360(tmp_path):
+  '''A box given from -180 to 180 degrees finds the footprints of files from 0 to 360 degrees'''
+  dataDir = tmp_path / 'lvis'
+  dataDir.mkdir()
+  write_synthetic(str(dataDir / 'synthetic.h5'), nWaves = 2000, nBins = 50, bounds = [258.0, -75.5, 262.0, -74.5])
+  catalog = catalogLVIS(str(dataDir), catalogFile = str(tmp_path / 'lvis_catalog.csv'), indexDir = str(tmp_path))
+  hits = catalog.query(-101.0, -75.2, -99.0, -74.8)
+  ref = catalog.query(259.0, -75.2, 261.0, -74.8)
+  assert len(ref) == 1
+  assert len(hits) == 1
+  np.testing.assert_array_equal(hits[0]['rows'], ref[0]['rows'])
+  # nothing is written to the data directory
+  assert sorted(p.name for p in dataDir.iterdir()) == ['synthetic.h5']
+
+###########################################
+
+def test_default_catalog_kept_with_index(tmp_path):
+  '''Without a catalogue path, the catalogue is kept with the index sidecars rather than the data'''
+  dataDir = tmp_path / '2009'
+  dataDir.mkdir()
+  write_synthetic(str(dataDir / 'synthetic.h5'), nWaves = 500, nBins = 50)
+  catalog = catalogLVIS(str(dataDir), indexDir = str(tmp_path))
+  assert catalog.catalogFile == str(tmp_path / 'lvis_catalog_2009.csv')
+  assert len(catalog.table) == 1
+  assert sorted(p.name for p in dataDir.iterdir()) == ['synthetic.h5']
@@ -0,0 +1,64 @@
+'''
+Tests of the Mosaic Grid
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+from gridLVIS import mosaicGrid
+
+
+BOUNDS = [0, 0, 3000, 3000]
+
+
+###########################################
+
+def footprints(seed = 0, nFiles = 3, nWaves = 5000):
+  '''Return random footprints of a few files'''
+  rng = np.random.default_rng(seed)
+  return({f'file{i}.h5': (rng.uniform(0, 3000, nWaves), rng.uniform(0, 3000, nWaves), rng.uniform(0, 100, nWaves)) for i in range(nFiles)})
+
+###########################################
+
+def test_resume_never_double_counts(tmp_path):
+  '''A resumed grid skips added files and undoes a file cut short by a crash'''
+  files = footprints()
+  ref = mosaicGrid(BOUNDS, res = 30)
+  for name, (x, y, z) in files.items():
+    ref.add(x, y, z)
+    ref.commit(name)
+
+  names = list(files)
+  mosaic = mosaicGrid(BOUNDS, res = 30, workDir = str(tmp_path))
+  mosaic.add(*files[names[0]])
+  mosaic.commit(names[0])
+  # crash after the second file is applied, but before it is recorded
+  mosaic.add(*files[names[1]])
+  def crash():
+    raise SystemExit('crash')
+  mosaic.write_state = crash
+  with pytest.raises(SystemExit):
+    mosaic.commit(names[1])
+  mosaic.flush()
+  del mosaic
+
+  mosaic = mosaicGrid(BOUNDS, res = 30, workDir = str(tmp_path), resume = True)
+  added = []
+  for name, (x, y, z) in files.items():
+    if mosaic.is_done(name):
+      continue
+    mosaic.add(x, y, z)
+    mosaic.commit(name)
+    added.append(name)
+  assert added == names[1:]
+  np.testing.assert_array_equal(np.asarray(mosaic.count), ref.count)
+  np.testing.assert_allclose(np.asarray(mosaic.sum), ref.sum)
+
+###########################################
+
+def test_resume_refuses_other_grid(tmp_path):
+  '''A grid kept on disk cannot be resumed with another resolution'''
+  mosaicGrid(BOUNDS, res = 30, workDir = str(tmp_path))
+  with pytest.raises(ValueError):
+    mosaicGrid(BOUNDS, res = 60, workDir = str(tmp_path), resume = True)
@@ -0,0 +1,53 @@
+'''
+Tests of Stage Profiling
+'''
+
+import threading
+import pytest
+
+import manageRAM
+from manageRAM import stage, count_items, write_report
+
+
+###########################################
+
+@pytest.fixture
+def records(monkeypatch):
+  '''Stage records of this test only'''
+  monkeypatch.setattr(manageRAM, '_RECORDS', [])
+  return(manageRAM._RECORDS)
+
+###########################################
+
+@stage('block')
+def block(n):
+  '''A small staged call, like those made per block, returning the threads running during it'''
+  count_items(n)
+  return(threading.active_count())
+
+###########################################
+
+def test_profiling_is_opt_in(records, tmp_path, monkeypatch):
+  '''Nothing is recorded or written unless profiling is switched on'''
+  monkeypatch.setattr(manageRAM, 'ENABLED', False)
+  before = threading.active_count()
+  with stage('outer'):
+    assert max(block(10) for i in range(100)) == before
+  assert records == []
+  assert write_report(str(tmp_path / 'profile.json')) is None
+  assert not (tmp_path / 'profile.json').exists()
+
+###########################################
+
+def test_one_sampler_per_process(records, monkeypatch):
+  '''Repeated and nested stages share one sampler thread'''
+  monkeypatch.setattr(manageRAM, 'ENABLED', True)
+  before = threading.active_count()
+  with stage('outer'):
+    assert max(block(10) for i in range(200)) <= before + 1
+  summary = manageRAM.report()['stages']
+  assert summary['block']['calls'] == 200
+  assert summary['block']['items'] == 2000
+  assert summary['outer']['calls'] == 1
+  assert summary['outer']['peakRSS'] > 0
+  assert manageRAM._SAMPLER['running'] == []
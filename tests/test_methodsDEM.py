@@ -0,0 +1,122 @@
+'''
+Tests of the DEM Methods
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+import methodsDEM
+from methodsDEM import fill_gaps, fill_tile, open_worker
+
+
+###########################################
+
+def write_holes(filename, nY = 300, nX = 400, seed = 0):
+  '''Write a smooth DEM with blocks, a long crack and single pixels of no data'''
+  rng = np.random.default_rng(seed)
+  yy, xx = np.mgrid[0:nY, 0:nX]
+  data = (100.0 + 0.1 * yy + 0.05 * xx + 5.0 * np.sin(xx / 30.0)).astype(np.float32)
+  for i in range(60):
+    row, col, size = rng.integers(0, nY), rng.integers(0, nX), rng.integers(1, 9)
+    data[max(0, row - size): row + size, max(0, col - size): col + size] = -999
+  data[150:153, 10:390] = -999
+  data[rng.random(data.shape) < 0.1] = -999
+  data[250:, :80] = -999
+  with rio.open(filename, 'w', driver = 'GTiff', height = nY, width = nX, count = 1, dtype = 'float32', crs = 'EPSG:3031',
+                transform = from_origin(0, 0, 30, 30), nodata = -999) as dst:
+    dst.write(data, 1)
+  return(data)
+
+###########################################
+
+def test_fill_gaps_same_for_any_tile_size(tmp_path):
+  '''Tiles and their seams give the same filled DEM as one tile'''
+  data = write_holes(str(tmp_path / 'holes.tif'))
+  filled = []
+  for tile_size, n_workers in [(4096, 1), (100, 3), (37, 2)]:
+    output = str(tmp_path / f'filled_{tile_size}.tif')
+    fill_gaps(str(tmp_path / 'holes.tif'), output, 5, tile_size = tile_size, n_workers = n_workers)
+    with rio.open(output) as src:
+      filled.append(src.read(1))
+  for other in filled[1:]:
+    np.testing.assert_array_equal(other, filled[0])
+  # valid pixels are kept, holes near data are filled and the far corner stays no data
+  valid = data != -999
+  np.testing.assert_array_equal(filled[0][valid], data[valid])
+  assert (filled[0][~valid] != -999).sum() > 0
+  assert (filled[0][270:, :40] == -999).all()
+
+###########################################
+
+class readLog():
+  '''Raster that records the pixels of every read'''
+
+  def __init__(self, src):
+    self.src = src
+    self.reads = []
+
+  def __getattr__(self, name):
+    return(getattr(self.src, name))
+
+  def read(self, band, window):
+    self.reads.append(window.width * window.height)
+    return(self.src.read(band, window = window))
+
+###########################################
+
+def test_fill_gaps_reads_within_halo_of_strip(tmp_path):
+  '''A flight strip, with its band of gaps along both edges, is filled reading each tile and its halo once'''
+  nY = nX = 600
+  yy, xx = np.mgrid[0:nY, 0:nX]
+  plane = (200.0 + 0.2 * yy - 0.1 * xx).astype(np.float32)
+  data = np.where(np.abs(yy - xx) < 60, plane, -999).astype(np.float32)
+  rng = np.random.default_rng(1)
+  holes = (rng.random(data.shape) < 0.2) & (np.abs(yy - xx) < 50)
+  data[holes] = -999
+  filename = str(tmp_path / 'strip.tif')
+  with rio.open(filename, 'w', driver = 'GTiff', height = nY, width = nX, count = 1, dtype = 'float32', crs = 'EPSG:3031',
+                transform = from_origin(0, 0, 30, 30), nodata = -999) as dst:
+    dst.write(data, 1)
+  tile_size, max_distance = 128, 10
+  halo = 2 * max_distance + 1
+  open_worker(filename)
+  methodsDEM._WORKER['src'] = log = readLog(methodsDEM._WORKER['src'])
+  filled = np.full(data.shape, -999, dtype = np.float32)
+  for row in range(0, nY, tile_size):
+    for col in range(0, nX, tile_size):
+      window = Window(col, row, min(tile_size, nX - col), min(tile_size, nY - row))
+      filled[row: row + window.height, col: col + window.width] = fill_tile((window, halo, max_distance, -999, 20))
+  log.src.close()
+  assert len(log.reads) == len(range(0, nY, tile_size))**2
+  assert max(log.reads) <= (tile_size + 2 * halo)**2
+  # holes inside the strip are filled exactly from the plane, and the far side of the band stays no data
+  np.testing.assert_allclose(filled[holes], plane[holes], rtol = 1e-5)
+  assert (filled[np.abs(yy - xx) > 60 + max_distance] == -999).all()
+  # the same as fill_gaps on a pool of workers
+  output = str(tmp_path / 'filled.tif')
+  fill_gaps(filename, output, max_distance, tile_size = tile_size, n_workers = 2)
+  with rio.open(output) as src:
+    np.testing.assert_array_equal(src.read(1), filled)
+
+###########################################
+
+def test_index_tiffs_scans_empty_tiffs_once(tmp_path, monkeypatch):
+  '''A geotiff without valid data keeps its empty extent in the index, rather than being scanned on every run'''
+  profile = {'driver': 'GTiff', 'width': 20, 'height': 10, 'count': 1, 'dtype': 'float32', 'crs': 'EPSG:3031',
+             'transform': from_origin(0, 300, 30, 30), 'nodata': -999}
+  tiffs = [str(tmp_path / 'empty.tif'), str(tmp_path / 'data.tif')]
+  for tiff, value in zip(tiffs, [-999, 5]):
+    with rio.open(tiff, 'w', **profile) as dst:
+      dst.write(np.full((1, 10, 20), value, dtype = np.float32))
+  index_file = str(tmp_path / 'index.csv')
+  index = methodsDEM.index_tiffs(tiffs, index_file = index_file, valid_extent = True)
+  assert np.isnan(index.validMinX.values[0]) and not np.isnan(index.validMinX.values[1])
+  scanned = []
+  monkeypatch.setattr(methodsDEM, 'tiff_header', lambda tiff, valid_extent = False: scanned.append(tiff))
+  index = methodsDEM.index_tiffs(tiffs, index_file = index_file, valid_extent = True)
+  assert scanned == []
+  assert np.isnan(index.validMinX.values[0]) and index.validChecked.all()
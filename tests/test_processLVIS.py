@@ -0,0 +1,135 @@
+'''
+Tests of Ground Estimation
+'''
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter1d
+
+from processLVIS import processLVIS, compare_ground
+from syntheticLVIS import write_synthetic
+
+
+TOLERANCE = 1e-9
+
+# working memory of 97 waveforms of 300 bins, so there are many blocks
+BUDGET = 97 * 3 * 300 * 8
+
+
+###########################################
+
+@pytest.fixture(scope = 'module')
+def lvis(tmp_path_factory):
+  '''A small synthetic file, with waveforms at the edge cases of denoising written over its first rows'''
+  filename = str(tmp_path_factory.mktemp('lvis') / 'synthetic.h5')
+  write_synthetic(filename, nWaves = 3000, nBins = 300, cloudFraction = 0.1, emptyFraction = 0.05, seed = 1)
+  LVIS = processLVIS(filename, setElev = True)
+  # float waveforms, so the noise bins can hold non-finite values
+  LVIS.waves = LVIS.waves.astype(np.float64)
+  nBins = LVIS.nBins
+  rng = np.random.default_rng(2)
+  LVIS.waves[0] = 0.0                               # empty waveform
+  LVIS.waves[1] = 10.0                              # flat noise with a single isolated signal bin
+  LVIS.waves[1, 150] = 80.0
+  LVIS.waves[2] = 10.0                              # signal in the first bin, which is also a noise bin
+  LVIS.waves[2, 0] = 300.0
+  LVIS.waves[3] = rng.normal(10.0, 2.0, nBins)      # signal in the last bin
+  LVIS.waves[3, nBins - 1] = 300.0
+  LVIS.waves[4] = 10.0                              # signal in the first and last bins only
+  LVIS.waves[4, [0, nBins - 1]] = 300.0
+  LVIS.waves[5] = rng.normal(10.0, 2.0, nBins)      # non-finite noise statistics
+  LVIS.waves[5, 3] = np.nan
+  LVIS.waves[6] = rng.normal(10.0, 2.0, nBins)
+  LVIS.waves[6, 5] = np.inf
+  LVIS.waves[7] = 10.0                              # an isolated bin between two returns is dropped
+  LVIS.waves[7, 100: 110] = 200.0
+  LVIS.waves[7, 150] = 200.0
+  LVIS.waves[7, 200: 210] = 200.0
+  return(LVIS)
+
+###########################################
+
+@pytest.fixture(scope = 'module')
+def zRef(lvis):
+  '''Ground estimates of the per-waveform loops, without triage'''
+  lvis.estimate_ground(engine = 'loop', triage = False)
+  return(lvis.zG.copy())
+
+###########################################
+
+def assert_matches(zG, zRef):
+  '''Ground estimates agree with the loops, including where there is no estimate'''
+  error = compare_ground(zG, zRef)
+  assert error['noDataMismatch'] == 0
+  assert error['maxError'] <= TOLERANCE
+
+###########################################
+
+def test_edge_cases_of_loops(lvis, zRef):
+  '''The reference gives no estimate without signal or noise statistics, and an estimate for signal at the ends'''
+  assert np.all(zRef[[0, 5, 6]] == -999.0)
+  assert np.all(zRef[[1, 2, 3, 4, 7]] != -999.0)
+  assert np.sum(zRef != -999.0) > lvis.nWaves // 2
+
+###########################################
+
+@pytest.mark.parametrize('triage', [True, False])
+def test_batch_matches_loop(lvis, zRef, triage):
+  '''The whole-array engine matches the per-waveform loops'''
+  lvis.estimate_ground(engine = 'batch', triage = triage)
+  assert_matches(lvis.zG, zRef)
+
+###########################################
+
+@pytest.fixture(scope = 'module')
+def zBudget(lvis):
+  '''Ground estimates of the per-waveform loops within a memory budget, without triage'''
+  lvis.estimate_ground(engine = 'loop', memBudget = BUDGET, triage = False)
+  return(lvis.zG.copy())
+
+###########################################
+
+@pytest.mark.parametrize('engine, triage', [('batch', True), ('batch', False), ('loop', True)])
+def test_mem_budget_matches_loop(lvis, zBudget, engine, triage):
+  '''Blocks denoised into a reused buffer within a memory budget match the loops'''
+  assert lvis.block_size(BUDGET) == 97             # many blocks, some of rows that are not contiguous
+  lvis.estimate_ground(engine = engine, memBudget = BUDGET, triage = triage)
+  assert lvis.denoised is None
+  assert_matches(lvis.zG, zBudget)
+
+###########################################
+
+def original_ground(LVIS, sigThresh = 5, statsLen = 10, sWidth = 0.5):
+  '''Ground estimates of the original code, which denoised into an array of whole numbers'''
+  res = (LVIS.lZ0[0] - LVIS.lZN[0]) / LVIS.nBins
+  noiseBins = int(statsLen / res)
+  zG = np.full((LVIS.nWaves), -999.0)
+  for i in range(0, LVIS.nWaves):
+    meanNoise, stdevNoise = np.mean(LVIS.waves[i, 0: noiseBins]), np.std(LVIS.waves[i, 0: noiseBins])
+    denoised = np.full(LVIS.nBins, 0)
+    denoised[:] = LVIS.waves[i] - meanNoise
+    denoised[denoised < meanNoise + sigThresh * stdevNoise] = 0.0
+    binList = np.where(denoised > 0.0)[0]
+    for j in range(1, binList.shape[0] - 1):
+      if((binList[j] != binList[j-1] +1) | (binList[j] != binList[j+1] -1)):
+        denoised[binList[j]] = 0.0
+    denoised = gaussian_filter1d(denoised, sWidth / res)
+    if(np.sum(denoised) > 0.0):
+      zG[i] = np.average(LVIS.z[i], weights = denoised)
+  return(zG)
+
+###########################################
+
+def test_default_matches_original(tmp_path):
+  '''The default float64 mode without a budget keeps the whole number denoising of the original code'''
+  filename = str(tmp_path / 'synthetic.h5')
+  write_synthetic(filename, nWaves = 500, nBins = 300, seed = 3)
+  LVIS = processLVIS(filename, setElev = True)
+  zRef = original_ground(LVIS)
+  for engine in ['batch', 'loop']:
+    LVIS.estimate_ground(engine = engine)
+    assert LVIS.denoised.dtype == np.int64
+    assert_matches(LVIS.zG, zRef)
+  # a budget, or float32, denoises in the working precision instead
+  LVIS.estimate_ground(memBudget = BUDGET)
+  assert compare_ground(LVIS.zG, zRef)['maxError'] > TOLERANCE
@@ -0,0 +1,43 @@
+'''
+Tests of the Reprojection Methods
+'''
+
+import numpy as np
+import threading
+import pyproj
+
+import projectLVIS
+from projectLVIS import reproject, get_transformer
+
+
+###########################################
+
+def test_threaded_reproject_matches_serial():
+  '''Chunks transformed on pools of threads match one transform, and every thread sets up its own transformer'''
+  rng = np.random.default_rng(0)
+  lon, lat = rng.uniform(258.0, 262.0, 20000), rng.uniform(-75.5, -74.5, 20000)
+  x, y = reproject(lon, lat, 4326, 3031)
+  for i in range(5):
+    xT, yT = reproject(lon, lat, 4326, 3031, chunkSize = 1000, nThreads = 4)
+    np.testing.assert_array_equal(xT, x)
+    np.testing.assert_array_equal(yT, y)
+  other = []
+  thread = threading.Thread(target = lambda: other.append(get_transformer(4326, 3031)))
+  thread.start()
+  thread.join()
+  assert get_transformer(4326, 3031) is get_transformer(4326, 3031)
+  assert other[0] is not get_transformer(4326, 3031)
+
+###########################################
+
+def test_threads_keep_transformers_between_calls(monkeypatch):
+  '''Threaded calls reuse the transformers set up by the threads of earlier calls, one per thread at most'''
+  lon, lat = np.linspace(258.0, 262.0, 8000), np.linspace(-75.5, -74.5, 8000)
+  made, original = [], pyproj.Transformer.from_crs
+  def from_crs(*args, **kwargs):
+    made.append(args)
+    return(original(*args, **kwargs))
+  monkeypatch.setattr(projectLVIS.Transformer, 'from_crs', from_crs)
+  for i in range(10):
+    reproject(lon, lat, 4326, 3413, chunkSize = 500, nThreads = 3)
+  assert 1 <= len(made) <= 3
@@ -0,0 +1,25 @@
+'''
+Tests of Reading LVIS Files
+'''
+
+import numpy as np
+
+from readLVIS import readLVIS, coalesce_rows
+from syntheticLVIS import write_synthetic
+
+
+###########################################
+
+def test_empty_rows_give_empty_subset(tmp_path):
+  '''An empty selection of rows, eg. a block with no hits, reads as an empty subset'''
+  filename = str(tmp_path / 'synthetic.h5')
+  write_synthetic(filename, nWaves = 500, nBins = 50)
+  starts, stops = coalesce_rows(np.array([], dtype = np.int64))
+  assert len(starts) == 0 and len(stops) == 0
+  LVIS = readLVIS(filename, rows = [], setElev = True)
+  assert LVIS.nWaves == 0
+  # as a box without footprints
+  assert readLVIS(filename, minX = 0, minY = 0, maxX = 1, maxY = 1, setElev = True).nWaves == 0
+  LVIS = readLVIS(filename, rows = np.array([3, 4, 5, 40]))
+  assert LVIS.nWaves == 4
+  assert LVIS.waves.shape == (4, 50)
@@ -0,0 +1,59 @@
+'''
+Tests of the Task Scheduler
+'''
+
+import os
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+pytest.importorskip('osgeo')
+import schedulerLVIS
+from schedulerLVIS import schedulerLVIS as scheduler
+from syntheticLVIS import write_synthetic
+
+
+###########################################
+
+@pytest.fixture
+def campaign(tmp_path):
+  '''Two small synthetic files and a work directory'''
+  files = [str(tmp_path / f'synthetic_{i}.h5') for i in range(2)]
+  for i, filename in enumerate(files):
+    write_synthetic(filename, nWaves = 2000, nBins = 100, seed = i)
+  return(files, str(tmp_path / 'work'), str(tmp_path / 'out'), str(tmp_path / 'index'))
+
+###########################################
+
+def test_plan_refuses_other_files_or_settings(campaign):
+  '''Tasks planned once are reused with the same files and settings, and refused otherwise'''
+  files, workDir, outputDir, indexDir = campaign
+  os.makedirs(indexDir)
+  settings = {'tileBudget': 1024**2 + 300000, 'memBudget': 1024**2, 'indexDir': indexDir}
+  tasks = scheduler(workDir, outputDir, 2009, **settings).plan(files)
+  assert len(tasks) > len(files)
+  assert scheduler(workDir, outputDir, 2009, **settings).plan(files) == tasks
+  with pytest.raises(ValueError):
+    scheduler(workDir, outputDir, 2009, **settings).plan(files[:1])
+  with pytest.raises(ValueError):
+    scheduler(workDir, outputDir, 2015, **settings).plan(files)
+  with pytest.raises(ValueError):
+    scheduler(workDir, outputDir, 2009, **dict(settings, tileBudget = 4 * 1024**2)).plan(files)
+
+###########################################
+
+def die(task):
+  '''A task whose worker is killed, eg. out of memory'''
+  os._exit(9)
+
+###########################################
+
+def test_run_fails_when_a_worker_dies(campaign, monkeypatch):
+  '''A dead worker fails the run, rather than leaving it waiting forever'''
+  files, workDir, outputDir, indexDir = campaign
+  os.makedirs(indexDir)
+  tasks = scheduler(workDir, outputDir, 2009, nWorkers = 2, tileBudget = 2 * 1024**2, memBudget = 1024**2, indexDir = indexDir)
+  tasks.plan(files)
+  monkeypatch.setattr(schedulerLVIS, 'run_task', die)
+  with pytest.raises(BrokenProcessPool):
+    tasks.run()
+  assert tasks.completed() == {}